@@ -0,0 +1,396 @@
+"""Benchmarks for process stats collection.
+
+Run with::
+
+    python -m process_stats_exporter.benchmark parse
+    python -m process_stats_exporter.benchmark scrapes
+
+The ``scrapes`` benchmark runs against a generated fake ``/proc`` tree.
+
+"""
+
+import argparse
+from collections import OrderedDict
+from functools import partial
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import random
+import re
+import sys
+import tempfile
+import time
+import timeit
+
+from lxstats.process import Process
+from prometheus_aioexporter.metric import MetricsRegistry
+
+from .metrics import ProcessMetricsHandler
+from .process import get_process_iterator
+from .procfs import (
+    find_key_value,
+    parse_value,
+    read_file)
+from .stats import ProcessStatsCollector
+
+# Whether higher values are better for scrapes results
+RESULTS_HIGHER_BETTER = OrderedDict([
+    ('scrapes_per_sec', True),
+    ('latency_p50', False),
+    ('latency_p99', False),
+    ('peak_rss', False)])
+
+
+def collect_lxstats(process, stats):
+    """Collect stats parsing all process files with lxstats."""
+    process.collect_stats()
+    return {stat.metric: process.get(stat.stat) for stat in stats}
+
+
+def benchmark_parse(processes, iterations):
+    """Compare collecting process stats with lxstats and the lean reader.
+
+    Return a dict mapping the collection method to the average time in
+    seconds for collecting stats for all processes once.
+
+    """
+    collector = ProcessStatsCollector()
+    stats = collector._STATS
+
+    def run_lxstats():
+        for process in processes:
+            collect_lxstats(process, stats)
+
+    def run_reader():
+        for process in processes:
+            collector.collect(process)
+
+    return {
+        name: timeit.timeit(func, number=iterations) / iterations
+        for name, func in (('lxstats', run_lxstats), ('reader', run_reader))}
+
+
+class FakeProc:
+    """Generate a fake ``/proc`` tree with processes.
+
+    Each process has ``cmdline``, ``comm``, ``stat``, ``status`` and
+    ``sched`` files, and a ``task`` directory with a ``stat`` file for each
+    thread.  Command lines are like ``app<N> --option...``, padded to the
+    specified length.
+
+    :param str path: the directory to create the tree in.
+    :param int threads: the number of threads for each process.
+    :param int cmdline_length: the length of processes command lines.
+    :param int apps: the number of distinct application names.
+    :param seed: the seed for random values.
+
+    """
+
+    def __init__(self, path, threads=1, cmdline_length=64, apps=10,
+                 seed=None):
+        self.path = Path(path)
+        self.pids = []
+        self._threads = threads
+        self._cmdline_length = cmdline_length
+        self._apps = apps
+        self._random = random.Random(seed)
+        self._next_pid = 1000
+        self._ticks = 0
+
+    def add_processes(self, count):
+        """Add the specified number of processes."""
+        for _ in range(count):
+            self.add_process()
+
+    def add_process(self):
+        """Add a process, returning its PID."""
+        pid = self._next_pid
+        # thread IDs follow the PID
+        self._next_pid += self._threads
+        self._ticks += 1
+        name = 'app{}'.format(self._random.randrange(self._apps))
+        cmdline = '{} --option'.format(name).ljust(self._cmdline_length, 'x')
+        process_dir = self.path / str(pid)
+        process_dir.mkdir(parents=True)
+        (process_dir / 'cmdline').write_bytes(
+            cmdline.replace(' ', '\x00').encode('ascii') + b'\x00')
+        (process_dir / 'comm').write_text(name + '\n')
+        (process_dir / 'stat').write_text(self._stat(pid, name, 'S'))
+        (process_dir / 'status').write_text(self._status(name))
+        (process_dir / 'sched').write_text(self._sched(pid, name))
+        for tid in range(pid, pid + self._threads):
+            task_dir = process_dir / 'task' / str(tid)
+            task_dir.mkdir(parents=True)
+            state = self._random.choice('RSSSSD')
+            (task_dir / 'stat').write_text(self._stat(tid, name, state))
+        self.pids.append(pid)
+        return pid
+
+    def remove_process(self, pid):
+        """Remove a process."""
+        for dirpath, dirnames, filenames in os.walk(
+                str(self.path / str(pid)), topdown=False):
+            for filename in filenames:
+                os.unlink(os.path.join(dirpath, filename))
+            os.rmdir(dirpath)
+        self.pids.remove(pid)
+
+    def churn(self, rate):
+        """Replace a fraction of processes with new ones.
+
+        Return the number of replaced processes.
+
+        """
+        count = round(len(self.pids) * rate)
+        for pid in self._random.sample(self.pids, count):
+            self.remove_process(pid)
+        self.add_processes(count)
+        return count
+
+    def _stat(self, pid, name, state):
+        """Return content for a stat file."""
+        values = [self._random.randrange(100000) for _ in range(41)]
+        values[18] = self._ticks  # starttime
+        return '{} ({}) {} {}\n'.format(
+            pid, name, state, ' '.join(str(value) for value in values))
+
+    def _status(self, name):
+        """Return content for a status file."""
+        rss = self._random.randrange(1000, 100000)
+        return (
+            'Name:\t{}\nState:\tS (sleeping)\nVmHWM:\t{:8d} kB\n'
+            'VmRSS:\t{:8d} kB\nThreads:\t{}\n'.format(
+                name, rss * 2, rss, self._threads))
+
+    def _sched(self, pid, name):
+        """Return content for a sched file."""
+        return (
+            '{} ({}, #threads: {})\n{}\n'
+            'nr_switches                                  :'
+            '{:>20d}\n'
+            'nr_voluntary_switches                        :'
+            '{:>20d}\n'
+            'nr_involuntary_switches                      :'
+            '{:>20d}\n'.format(
+                name, pid, self._threads, '-' * 59,
+                self._random.randrange(100000),
+                self._random.randrange(100000),
+                self._random.randrange(100000)))
+
+
+def percentile(values, percent):
+    """Return the percentile of values, with the nearest-rank method."""
+    values = sorted(values)
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank - 1, 0)]
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the current process to the current RSS.
+
+    This is not supported on kernels older than 4.0, where the peak stays
+    unchanged.
+
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+    except OSError:
+        pass
+
+
+def get_rss():
+    """Return a tuple with the current and peak RSS of the current process.
+
+    Values are in bytes.
+
+    """
+    content = read_file('/proc/self/status')
+    return (
+        parse_value(find_key_value(content, b'VmRSS')),
+        parse_value(find_key_value(content, b'VmHWM')))
+
+
+def benchmark_scrapes(fake_proc, scrapes, cmdline_regexps, churn=0.0,
+                      **handler_options):
+    """Benchmark updating metrics for processes in a fake ``/proc``.
+
+    Processes are replaced at the specified churn rate before each scrape.
+    Return a dict with scrapes per second, latency percentiles (in seconds)
+    and the peak RSS increase of the current process while running (in
+    bytes), so memory used to build the fake tree is not included.
+
+    """
+    reset_peak_rss()
+    start_rss, _ = get_rss()
+    handler = ProcessMetricsHandler(
+        logging.getLogger('benchmark'), cmdline_regexps=cmdline_regexps,
+        get_process_iterator=partial(
+            get_process_iterator, proc=str(fake_proc.path)),
+        **handler_options)
+    metrics = MetricsRegistry().create_metrics(handler.get_metric_configs())
+    latencies = []
+    try:
+        for _ in range(scrapes):
+            if churn:
+                fake_proc.churn(churn)
+            start = time.perf_counter()
+            handler.update_metrics(metrics)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        handler.close()
+
+    _, peak_rss = get_rss()
+    return {
+        'scrapes_per_sec': len(latencies) / sum(latencies),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'peak_rss': max(peak_rss - start_rss, 0)}
+
+
+def compare_results(results, baseline, threshold):
+    """Compare scrapes results with baseline ones.
+
+    Return a list of (name, baseline value, value, change) tuples for results
+    that are worse than the baseline by more than the threshold, as a fraction
+    of the baseline value.  Results missing from the baseline are skipped.
+
+    """
+    regressions = []
+    for name, higher_better in RESULTS_HIGHER_BETTER.items():
+        base_value = baseline.get(name)
+        if not base_value:
+            continue
+        value = results[name]
+        change = (value - base_value) / base_value
+        worse = -change if higher_better else change
+        if worse > threshold:
+            regressions.append((name, base_value, value, change))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parse_parser = subparsers.add_parser(
+        'parse', help='compare parsing process files with lxstats')
+    parse_parser.add_argument(
+        '--proc', default='/proc', help='path to the /proc directory')
+    parse_parser.add_argument(
+        '-P', '--pids', nargs='+', type=int, default=[os.getpid()],
+        metavar='pid', help='PIDs of processes to collect stats for')
+    parse_parser.add_argument(
+        '-n', '--iterations', type=int, default=1000,
+        help='number of iterations')
+
+    scrapes_parser = subparsers.add_parser(
+        'scrapes', help='update metrics for processes in a fake /proc')
+    scrapes_parser.add_argument(
+        '--processes', type=int, default=1000, help='number of processes')
+    scrapes_parser.add_argument(
+        '--threads', type=int, default=4,
+        help='number of threads for each process')
+    scrapes_parser.add_argument(
+        '--cmdline-length', type=int, default=64,
+        help='length of processes command lines')
+    scrapes_parser.add_argument(
+        '--churn', type=float, default=0.0,
+        help='fraction of processes replaced before each scrape')
+    scrapes_parser.add_argument(
+        '-R', '--cmdline-regexp', default=r'^(?P<app>app\d+)',
+        help='regexp to match processes command line')
+    scrapes_parser.add_argument(
+        '--collect-workers', type=int,
+        help='number of threads to collect process stats with')
+    scrapes_parser.add_argument(
+        '--max-open-files', type=int,
+        help='maximum number of process files to keep open')
+    scrapes_parser.add_argument(
+        '-n', '--scrapes', type=int, default=100, help='number of scrapes')
+    scrapes_parser.add_argument(
+        '--seed', type=int, help='seed for generating processes')
+    scrapes_parser.add_argument(
+        '-o', '--output', help='file to save results to, as JSON')
+    scrapes_parser.add_argument(
+        '--baseline', metavar='FILE',
+        help=('JSON file with saved results to compare with, exiting with '
+              'an error status on regressions'))
+    scrapes_parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help=('fraction by which results can be worse than the baseline '
+              '(default: %(default)s)'))
+    args = parser.parse_args(args)
+
+    if args.benchmark == 'parse':
+        return run_parse(args)
+    return run_scrapes(args)
+
+
+def run_parse(args):
+    """Run the parse benchmark."""
+    processes = [
+        Process(pid, os.path.join(args.proc, str(pid))) for pid in args.pids]
+    timings = benchmark_parse(processes, args.iterations)
+    for name, timing in sorted(timings.items()):
+        print('{:<10} {:10.1f} us'.format(name, timing * 1e6))
+    speedup = timings['lxstats'] / timings['reader']
+    print('speedup    {:10.1f}x'.format(speedup))
+    return 0
+
+
+def run_scrapes(args):
+    """Run the scrapes benchmark.
+
+    Return 1 if results are worse than the baseline, 0 otherwise.
+
+    """
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+    params = {
+        'processes': args.processes, 'threads': args.threads,
+        'cmdline_length': args.cmdline_length, 'churn': args.churn,
+        'cmdline_regexp': args.cmdline_regexp, 'scrapes': args.scrapes,
+        'collect_workers': args.collect_workers,
+        'max_open_files': args.max_open_files, 'seed': args.seed}
+    with tempfile.TemporaryDirectory() as tempdir:
+        fake_proc = FakeProc(
+            tempdir, threads=args.threads,
+            cmdline_length=args.cmdline_length, seed=args.seed)
+        fake_proc.add_processes(args.processes)
+        results = benchmark_scrapes(
+            fake_proc, args.scrapes, [re.compile(args.cmdline_regexp)],
+            churn=args.churn, collect_workers=args.collect_workers,
+            max_open_files=args.max_open_files)
+
+    print('scrapes/sec {:10.1f}'.format(results['scrapes_per_sec']))
+    print('p50         {:10.1f} ms'.format(results['latency_p50'] * 1e3))
+    print('p99         {:10.1f} ms'.format(results['latency_p99'] * 1e3))
+    print('peak RSS    {:10.1f} MiB'.format(results['peak_rss'] / 2**20))
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(
+                {'params': params, 'results': results}, fd, indent=2,
+                sort_keys=True)
+    if baseline is None:
+        return 0
+
+    if baseline.get('params') != params:
+        print('warning: baseline parameters differ', file=sys.stderr)
+    regressions = compare_results(
+        results, baseline['results'], args.threshold)
+    for name, base_value, value, change in regressions:
+        print(
+            'regression: {} {:g} -> {:g} ({:+.1%})'.format(
+                name, base_value, value, change),
+            file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
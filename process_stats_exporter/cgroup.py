@@ -0,0 +1,177 @@
+"""Select processes and read aggregate stats from cgroups."""
+
+import os
+
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily)
+
+from .procfs import read_file
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Fields from cpu.stat exported as counters, in seconds
+CPU_STAT_FIELDS = (
+    ('usage_usec', 'proc_cgroup_cpu_usage_seconds',
+     'Total CPU time used by processes in the cgroup'),
+    ('user_usec', 'proc_cgroup_cpu_user_seconds',
+     'CPU time used in user mode by processes in the cgroup'),
+    ('system_usec', 'proc_cgroup_cpu_system_seconds',
+     'CPU time used in kernel mode by processes in the cgroup'),
+    ('throttled_usec', 'proc_cgroup_cpu_throttled_seconds',
+     'Time processes in the cgroup were throttled for'))
+
+MEMORY_CURRENT_METRIC = (
+    'proc_cgroup_mem_current',
+    'Memory used by processes in the cgroup, in bytes')
+
+
+def get_cgroup_path(cgroup, root=CGROUP_ROOT):
+    """Return the path of a cgroup directory.
+
+    Relative cgroup paths are relative to the cgroup filesystem root.
+
+    """
+    return os.path.normpath(os.path.join(root, cgroup))
+
+
+def get_cgroup_name(cgroup, root=CGROUP_ROOT):
+    """Return the name of a cgroup.
+
+    For cgroups under the root this is the path relative to it, as in
+    ``/proc/<pid>/cgroup`` (e.g. ``/system.slice/foo.service``).
+
+    """
+    path = get_cgroup_path(cgroup, root=root)
+    relpath = os.path.relpath(path, os.path.normpath(root))
+    if relpath == os.curdir:
+        return '/'
+    if relpath.startswith(os.pardir):
+        return path
+    return '/' + relpath
+
+
+def get_cgroup_pids(path):
+    """Return a sorted list of PIDs of processes in a cgroup.
+
+    Processes in descendant cgroups are also included.  If the cgroup
+    doesn't exist, an empty list is returned.
+
+    """
+    pids = set()
+    for dirpath, _, filenames in os.walk(path):
+        if 'cgroup.procs' not in filenames:
+            continue
+        try:
+            content = read_cgroup_file(os.path.join(dirpath, 'cgroup.procs'))
+        except OSError:
+            # the cgroup was removed
+            continue
+        pids.update(int(pid) for pid in content.split())
+    return sorted(pids)
+
+
+def parse_flat_keyed(content):
+    """Return a dict with integer values from a flat keyed cgroup file.
+
+    These files have a "key value" pair on each line (e.g. ``cpu.stat``).
+
+    """
+    values = {}
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) != 2:
+            continue
+        try:
+            values[fields[0].decode('ascii')] = int(fields[1])
+        except ValueError:
+            continue
+    return values
+
+
+def read_cgroup_file(path, size=65536):
+    """Return the content of a cgroup file.
+
+    Files are read in chunks, since their size is not known in advance.
+
+    """
+    chunks = []
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        while True:
+            chunk = os.read(fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
+class CgroupStatsCollector:
+    """A Prometheus collector exporting aggregate stats for cgroups (v2).
+
+    CPU times from ``cpu.stat`` and memory usage from ``memory.current`` are
+    read once for each cgroup, including all its processes and descendant
+    cgroups.  Stats not available (e.g. for disabled controllers) are not
+    exported.
+
+    :param list cgroups: paths of cgroups.
+    :param dict labels: static labels for metrics.
+    :param str root: the path of the cgroup filesystem root.
+
+    """
+
+    def __init__(self, cgroups, labels=None, root=CGROUP_ROOT):
+        self._cgroups = [
+            (get_cgroup_name(cgroup, root=root),
+             get_cgroup_path(cgroup, root=root))
+            for cgroup in cgroups]
+        self.set_labels(labels)
+
+    def set_labels(self, labels):
+        """Change static labels for metrics."""
+        labels = dict(labels or {})
+        self._label_names = self._get_label_names(labels)
+        self._labels = labels
+
+    def collect(self):
+        static_labels = self._labels
+        label_names = self._get_label_names(static_labels)
+        cpu_families = [
+            CounterMetricFamily(name, description, labels=label_names)
+            for _, name, description in CPU_STAT_FIELDS]
+        memory_family = GaugeMetricFamily(
+            *MEMORY_CURRENT_METRIC, labels=label_names)
+        for name, path in self._cgroups:
+            labels = dict(static_labels, cgroup=name)
+            label_values = [labels[label] for label in label_names]
+            cpu_stat = parse_flat_keyed(self._read(path, 'cpu.stat') or b'')
+            for (field, _, _), family in zip(CPU_STAT_FIELDS, cpu_families):
+                value = cpu_stat.get(field)
+                if value is not None:
+                    family.add_metric(label_values, value / 1000000)
+            memory = self._read(path, 'memory.current')
+            if memory:
+                memory_family.add_metric(label_values, int(memory))
+        yield from cpu_families
+        yield memory_family
+
+    def describe(self):
+        return [
+            CounterMetricFamily(name, description, labels=self._label_names)
+            for _, name, description in CPU_STAT_FIELDS] + [
+                GaugeMetricFamily(
+                    *MEMORY_CURRENT_METRIC, labels=self._label_names)]
+
+    def _get_label_names(self, labels):
+        """Return sorted label names for metrics, given static labels."""
+        return sorted(set(labels) | {'cgroup'})
+
+    def _read(self, path, filename):
+        """Return the content of a cgroup file, or None if not available."""
+        try:
+            return read_file(os.path.join(path, filename))
+        except OSError:
+            return None
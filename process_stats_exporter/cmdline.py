@@ -7,6 +7,46 @@ from argparse import Action
 LABEL_RE = re.compile(r'[a-z][a-z0-9_]+$')
 
 
+def parse_label(value):
+    """Return a tuple with (name, value) for a "name=value" label.
+
+    A :class:`ValueError` is raised if the label is not valid.
+
+    """
+    try:
+        label, value = value.split('=')
+    except ValueError:
+        raise ValueError(
+            'labels must be in the form "name=value": {}'.format(value))
+    check_label_name(label)
+    return label, value
+
+
+def check_label_name(label):
+    """Raise a :class:`ValueError` if a label name is not valid."""
+    if not LABEL_RE.match(label):
+        raise ValueError('invalid label: {}'.format(label))
+
+
+def compile_regexp(value):
+    """Return a compiled regexp for process command lines.
+
+    A :class:`ValueError` is raised if the regexp is not valid, or if its
+    groups are not valid as labels.
+
+    """
+    try:
+        regexp = re.compile(value)
+    except Exception as e:
+        raise ValueError('compiling regexp {!r}: {}'.format(value, e))
+
+    for groupname in regexp.groupindex:
+        if not LABEL_RE.match(groupname):
+            raise ValueError(
+                'regexp group not valid as label: {}'.format(groupname))
+    return regexp
+
+
 class LabelAction(Action):
     """Action to parse and save labels from the command line."""
 
@@ -14,15 +54,9 @@ class LabelAction(Action):
         labels = {}
         for value in values:
             try:
-                label, value = value.split('=')
-            except ValueError:
-                parser.error(
-                    'labels must be in the form "name=value": {}'.format(
-                        value))
-                return
-            if not LABEL_RE.match(label):
-                parser.error(
-                    'invalid label: {}'.format(label))
+                label, value = parse_label(value)
+            except ValueError as e:
+                parser.error(str(e))
                 return
             labels[label] = value
 
@@ -36,18 +70,11 @@ class CmdlineRegexpAction(Action):
         regexps = []
         for value in values:
             try:
-                regexp = re.compile(value)
-            except Exception as e:
-                parser.error('compiling regexp {!r}: {}'.format(value, e))
+                regexp = compile_regexp(value)
+            except ValueError as e:
+                parser.error(str(e))
                 return
 
-            for groupname in regexp.groupindex:
-                if not LABEL_RE.match(groupname):
-                    parser.error(
-                        'regexp group not valid as label: {}'.format(
-                            groupname))
-                    return
-
             regexps.append(regexp)
 
         setattr(namespace, self.dest, regexps)
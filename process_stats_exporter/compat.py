@@ -0,0 +1,84 @@
+"""Compatibility with prometheus_aioexporter releases.
+
+The exporter serves metrics from an :class:`ExpositionCache`, by replacing
+the metrics handler of the web application created by
+:class:`PrometheusExporterScript`.  The library has no public hook for it,
+and the application is created in a private method which changed in 1.4:
+before, ``_create_application`` returns a
+``PrometheusExporterApplication``, an :class:`aiohttp.web.Application`
+subclass; from 1.4, ``_get_exporter`` returns a ``PrometheusExporter``,
+which creates the application.  2.0 moved modules and changed the script
+API, and is not supported.
+
+The base class and method for the installed version are looked up on
+import, and :class:`UnsupportedVersion` is raised if they're not found.
+
+"""
+
+import prometheus_aioexporter
+
+
+AIOEXPORTER_VERSION = str(prometheus_aioexporter.__version__)
+
+# Tuples with the name of the PrometheusExporterScript method creating the
+# web application and the name of the class it creates, newest first
+_WEB_FACTORIES = (
+    ('_get_exporter', 'PrometheusExporter'),
+    ('_create_application', 'PrometheusExporterApplication'))
+
+
+class UnsupportedVersion(Exception):
+    """The installed prometheus_aioexporter version is not supported."""
+
+    def __init__(self, missing, version=AIOEXPORTER_VERSION):
+        self.missing = missing
+        self.version = version
+        super().__init__(
+            'prometheus_aioexporter {} is not supported: {} not found'.format(
+                version, missing))
+
+
+def get_web_factory(script_class, web_module):
+    """Return a tuple with the script method name and base web class.
+
+    The method is the one creating the web application in
+    ``script_class``, and the class is the one it creates, with a
+    ``_handle_metrics`` method handling metrics requests.
+
+    :raises UnsupportedVersion: if none of the known methods and classes is
+        found.
+
+    """
+    for method_name, class_name in _WEB_FACTORIES:
+        web_class = getattr(web_module, class_name, None)
+        if (hasattr(script_class, method_name) and
+                hasattr(web_class, '_handle_metrics')):
+            return method_name, web_class
+    raise UnsupportedVersion(
+        'web application factory (one of {})'.format(
+            ', '.join(method_name for method_name, _ in _WEB_FACTORIES)))
+
+
+def unregister_metric(registry, metric):
+    """Unregister a metric from a :class:`MetricsRegistry`.
+
+    The registry has no method to unregister metrics, so the metric is
+    removed from the underlying :class:`prometheus_client.CollectorRegistry`.
+    It's replaced in the registry when a metric with the same name is
+    created.
+
+    """
+    collector_registry = getattr(registry, 'registry', None)
+    if collector_registry is None:
+        raise UnsupportedVersion('MetricsRegistry.registry')
+    collector_registry.unregister(metric)
+
+
+try:
+    from prometheus_aioexporter import web as _web
+    from prometheus_aioexporter.script import PrometheusExporterScript
+except ImportError as error:
+    raise UnsupportedVersion(error.name)
+
+WEB_FACTORY, PrometheusExporterWeb = get_web_factory(
+    PrometheusExporterScript, _web)
@@ -0,0 +1,172 @@
+"""Load processes selectors and labels from a configuration file."""
+
+import asyncio
+import json
+import os
+from pathlib import Path
+import signal
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from .cmdline import (
+    check_label_name,
+    compile_regexp)
+
+
+# Keys allowed in configuration files
+CONFIG_KEYS = frozenset(['pids', 'cmdline_regexps', 'labels'])
+
+# Extensions for YAML configuration files
+YAML_SUFFIXES = frozenset(['.yaml', '.yml'])
+
+
+class ConfigError(Exception):
+    """A configuration file is not valid."""
+
+
+def load_config(path):
+    """Return a dict with options from a JSON or YAML configuration file.
+
+    Files with a ``.yaml`` or ``.yml`` extension are parsed as YAML (which
+    requires PyYAML), other ones as JSON.  A :class:`ConfigError` is raised
+    if the file can't be read or is not valid.
+
+    """
+    path = Path(path)
+    try:
+        content = path.read_text()
+    except OSError as e:
+        raise ConfigError('reading {}: {}'.format(path, e.strerror))
+
+    if path.suffix in YAML_SUFFIXES:
+        if yaml is None:
+            raise ConfigError('PyYAML is required for YAML config files')
+        try:
+            data = yaml.safe_load(content)
+        except yaml.YAMLError as e:
+            raise ConfigError('parsing {}: {}'.format(path, e))
+    else:
+        try:
+            data = json.loads(content)
+        except ValueError as e:
+            raise ConfigError('parsing {}: {}'.format(path, e))
+    return parse_config(data)
+
+
+def parse_config(data):
+    """Return a dict with options from configuration data.
+
+    Only options in the data are included.  PIDs are returned as a list of
+    ints, command line regexps as a list of compiled regexps and labels as
+    a dict.
+
+    """
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise ConfigError('config must be a mapping')
+    unknown = sorted(set(data) - CONFIG_KEYS)
+    if unknown:
+        raise ConfigError(
+            'unknown config keys: {}'.format(', '.join(unknown)))
+
+    config = {}
+    if 'pids' in data:
+        pids = _get_list(data, 'pids')
+        if not all(
+                isinstance(pid, int) and not isinstance(pid, bool)
+                for pid in pids):
+            raise ConfigError('pids must be integers')
+        config['pids'] = pids
+    if 'cmdline_regexps' in data:
+        regexps = _get_list(data, 'cmdline_regexps')
+        try:
+            config['cmdline_regexps'] = [
+                compile_regexp(str(regexp)) for regexp in regexps]
+        except ValueError as e:
+            raise ConfigError(str(e))
+    if 'labels' in data:
+        labels = data['labels'] or {}
+        if not isinstance(labels, dict):
+            raise ConfigError('labels must be a mapping')
+        try:
+            for label in labels:
+                check_label_name(str(label))
+        except ValueError as e:
+            raise ConfigError(str(e))
+        config['labels'] = {
+            str(label): str(value) for label, value in labels.items()}
+    return config
+
+
+def _get_list(data, key):
+    """Return a list value from configuration data."""
+    value = data[key] or []
+    if not isinstance(value, list):
+        raise ConfigError('{} must be a list'.format(key))
+    return value
+
+
+class ConfigWatcher:
+    """Call a function when a configuration file should be reloaded.
+
+    This happens when the process receives ``SIGHUP``, or when the file
+    changes (its modification time, size or inode), which is checked at the
+    specified interval.
+
+    :param str path: the path of the configuration file.
+    :param callable on_change: a callable to call with no arguments.
+    :param float interval: the interval between checks for changes, in
+        seconds.  If None, the file is not checked.
+
+    """
+
+    def __init__(self, path, on_change, interval=None):
+        self.path = str(path)
+        self._on_change = on_change
+        self._interval = interval
+        self._file_id = self._get_file_id()
+        self._task = None
+
+    def start(self):
+        """Start watching for changes."""
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGHUP, self._on_change)
+        if self._interval:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop watching for changes."""
+        asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def check(self):
+        """Call the function if the file has changed since the last check."""
+        file_id = self._get_file_id()
+        if file_id != self._file_id:
+            self._file_id = file_id
+            self._on_change()
+
+    async def _run(self):
+        """Check the file for changes periodically."""
+        while True:
+            await asyncio.sleep(self._interval)
+            self.check()
+
+    def _get_file_id(self):
+        """Return a tuple identifying the file content, or None if missing."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,253 @@
+"""Track cumulative counters from process stats."""
+
+from array import array
+
+from prometheus_client.core import CounterMetricFamily
+
+
+class CounterDeltas:
+    """Compute increments for cumulative counters since the last sample.
+
+    Values for each process are stored in a slot of per-counter arrays,
+    together with the process start time.  If the start time changes (e.g. a
+    restarted process with the same labels) or a value decreases, the counter
+    is considered reset, and the increment is the full value.
+
+    Slots for processes not seen in a cycle are released.
+
+    :param list names: names of the counters to track.
+
+    """
+
+    def __init__(self, names):
+        self._names = list(names)
+        self._slots = {}
+        self._free_slots = []
+        self._start_times = array('q')
+        self._cycles = array('Q')
+        self._values = {name: array('d') for name in self._names}
+        self._cycle = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def new_cycle(self):
+        """Start a new cycle, releasing slots for processes not seen."""
+        for key, slot in list(self._slots.items()):
+            if self._cycles[slot] != self._cycle:
+                del self._slots[key]
+                self._free_slots.append(slot)
+        self._cycle += 1
+
+    def deltas(self, key, start_time, values):
+        """Return a dict with increments for counter values.
+
+        :param key: a key identifying the process.
+        :param int start_time: the process start time.
+        :param dict values: a dict mapping counter names to current
+            cumulative values.  Values can be None if not available, and
+            counters not in the dict are not included in the result.
+
+        """
+        slot, reset = self._get_slot(key, start_time)
+        deltas = {}
+        for name in self._names:
+            if name not in values:
+                continue
+            value = values[name]
+            if value is None:
+                deltas[name] = None
+                continue
+            last_values = self._values[name]
+            delta = value - last_values[slot]
+            if reset or delta < 0:
+                delta = value
+            last_values[slot] = value
+            deltas[name] = delta
+        return deltas
+
+    def prune(self, keys):
+        """Release slots for processes not in the specified keys."""
+        for key in set(self._slots).difference(keys):
+            self._free_slots.append(self._slots.pop(key))
+
+    def _get_slot(self, key, start_time):
+        """Return a tuple with (slot, reset) for a process.
+
+        Reset is true if the process is new or its start time changed.
+
+        """
+        start_time = start_time or 0
+        slot = self._slots.get(key)
+        reset = slot is None or self._start_times[slot] != start_time
+        if slot is None:
+            slot = self._new_slot()
+            self._slots[key] = slot
+        self._start_times[slot] = start_time
+        self._cycles[slot] = self._cycle
+        return slot, reset
+
+    def _new_slot(self):
+        """Return a slot for a new process."""
+        if self._free_slots:
+            return self._free_slots.pop()
+        self._start_times.append(0)
+        self._cycles.append(0)
+        for values in self._values.values():
+            values.append(0)
+        return len(self._start_times) - 1
+
+
+class CounterRates(CounterDeltas):
+    """Compute per-second rates for cumulative counters between samples.
+
+    The rate is the increment since the previous sample for a process,
+    divided by the time elapsed between the two.  The timestamp of the
+    previous sample is stored in a per-process slot, along with values.
+
+    There's no rate for the first sample of a process, if the start time
+    changes (e.g. a PID reused by a different process) or if a value
+    decreases.
+
+    """
+
+    def __init__(self, names):
+        self._timestamps = array('d')
+        super().__init__(names)
+
+    def rates(self, key, start_time, timestamp, values):
+        """Return a dict with per-second rates for counter values.
+
+        :param key: a key identifying the process.
+        :param int start_time: the process start time.
+        :param float timestamp: the time values were read at, from a
+            monotonic clock.
+        :param dict values: a dict mapping counter names to current
+            cumulative values.  Counters without a rate are not included in
+            the result.
+
+        """
+        slot, reset = self._get_slot(key, start_time)
+        elapsed = timestamp - self._timestamps[slot]
+        self._timestamps[slot] = timestamp
+
+        rates = {}
+        for name in self._names:
+            value = values.get(name)
+            if value is None:
+                continue
+            last_values = self._values[name]
+            delta = value - last_values[slot]
+            last_values[slot] = value
+            if reset or delta < 0 or elapsed <= 0:
+                continue
+            rates[name] = delta / elapsed
+        return rates
+
+    def _new_slot(self):
+        if self._free_slots:
+            return self._free_slots.pop()
+        self._timestamps.append(0)
+        return super()._new_slot()
+
+
+class CumulativeCountersCollector:
+    """A Prometheus collector exporting cumulative values as counters.
+
+    Values are exported as they're read from process stats, without
+    tracking increments.  Values for processes with the same labels are
+    summed.
+
+    When a process with the same labels as others is gone (or restarted),
+    its last values are kept as an offset for the labels, so that the sum
+    doesn't decrease, which would look like a counter reset.  Offsets are
+    discarded with the series when no process has the labels.
+
+    :param list metric_configs: MetricConfigs for the counters.
+    :param list label_names: names of labels for the counters.
+
+    """
+
+    def __init__(self, metric_configs, label_names):
+        self._metric_configs = list(metric_configs)
+        self._names = [config.name for config in self._metric_configs]
+        self._label_names = sorted(label_names)
+        self._reset()
+
+    def set_label_names(self, label_names):
+        """Change names of labels, discarding current values."""
+        self._reset()
+        self._label_names = sorted(label_names)
+
+    def update(self, samples):
+        """Replace values for counters.
+
+        :param samples: an iterable of (labels, process key, values) tuples,
+            where labels is a dict with label values, the process key
+            identifies the process (e.g. its PID and start time) and values
+            is a dict mapping counter names to values.
+
+        """
+        # map label values to {process key: {counter name: value}}
+        last_values = {}
+        for labels, process_key, metric_values in samples:
+            label_values = tuple(
+                labels.get(name, '') for name in self._label_names)
+            previous = self._last_values.get(label_values, {}).get(
+                process_key, {})
+            process_values = {}
+            for name in self._names:
+                value = metric_values.get(name)
+                if value is None:
+                    # keep the last value, if any
+                    value = previous.get(name)
+                if value is not None:
+                    process_values[name] = value
+            last_values.setdefault(label_values, {})[process_key] = (
+                process_values)
+
+        offsets = {}
+        values = {name: {} for name in self._names}
+        for label_values, processes in last_values.items():
+            offset = dict(self._offsets.get(label_values, {}))
+            previous = self._last_values.get(label_values, {})
+            for process_key, process_values in previous.items():
+                if process_key in processes:
+                    continue
+                for name, value in process_values.items():
+                    offset[name] = offset.get(name, 0) + value
+            offsets[label_values] = offset
+            for name, series in values.items():
+                total = offset.get(name)
+                for process_values in processes.values():
+                    value = process_values.get(name)
+                    if value is not None:
+                        total = (total or 0) + value
+                if total is not None:
+                    series[label_values] = total
+        self._last_values = last_values
+        self._offsets = offsets
+        self._values = values
+
+    def collect(self):
+        values = self._values
+        for config in self._metric_configs:
+            family = CounterMetricFamily(
+                config.name, config.description, labels=self._label_names)
+            for label_values, value in values.get(config.name, {}).items():
+                family.add_metric(label_values, value)
+            yield family
+
+    def describe(self):
+        return [
+            CounterMetricFamily(
+                config.name, config.description, labels=self._label_names)
+            for config in self._metric_configs]
+
+    def _reset(self):
+        """Discard values and offsets."""
+        self._values = {}
+        # map label values to {process key: {counter name: value}}
+        self._last_values = {}
+        # map label values to {counter name: value} for processes gone
+        self._offsets = {}
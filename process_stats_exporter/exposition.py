@@ -0,0 +1,162 @@
+"""Render metrics in the text exposition format, caching rendered lines."""
+
+from collections import namedtuple
+import copy
+import gzip
+import threading
+
+from prometheus_client.exposition import generate_latest
+
+
+class ExpositionCache:
+    """Keep the text exposition for metrics in a registry.
+
+    The exposition is rendered on :meth:`update`, and served by
+    :meth:`get` until the next update, along with a gzip-compressed copy.
+
+    Metric families are collected from the registry, and the rendered line
+    for each series is cached.  Only lines for series whose value changed
+    since the previous update are rendered again, with a single call to
+    :func:`prometheus_client.generate_latest` for each family.  The output
+    is the same as rendering the whole registry.
+
+    :param registry: a :class:`prometheus_client.CollectorRegistry`.
+    :param int compress_level: the gzip compression level.
+
+    """
+
+    def __init__(self, registry, compress_level=6):
+        self._registry = registry
+        self._compress_level = compress_level
+        # map metric family names to rendered families
+        self._rendered = {}
+        self._body = None
+        self._compressed = None
+        self._lock = threading.Lock()
+
+    def update(self):
+        """Render the exposition for the current metric values."""
+        with self._lock:
+            body = self._render()
+            if body != self._body:
+                self._body = body
+                self._compressed = gzip.compress(
+                    body, compresslevel=self._compress_level)
+
+    def get(self, compressed=False):
+        """Return the rendered exposition, gzip-compressed if requested.
+
+        If the exposition hasn't been rendered yet, None is returned.
+
+        """
+        return self._compressed if compressed else self._body
+
+    def _render(self):
+        """Return the exposition for metrics in the registry."""
+        rendered = {}
+        for family in self._registry.collect():
+            rendered[family.name] = _render_family(
+                family, self._rendered.get(family.name))
+        self._rendered = rendered
+        return b''.join(family.text for family in rendered.values())
+
+
+# The rendered text for a metric family, with the HELP and TYPE lines, keys
+# for its series in order, and a dict mapping keys to tuples with (value,
+# rendered line).  If the output for the family doesn't have a line for each
+# series after the header, lines are None and the family samples are kept to
+# only reuse the text if they're all the same.
+_RenderedFamily = namedtuple(
+    '_RenderedFamily',
+    ['type', 'documentation', 'header', 'keys', 'lines', 'samples', 'text'])
+
+
+def _render_family(family, cached):
+    """Return a :class:`_RenderedFamily` for a metric family.
+
+    Lines from the cached family are reused for series with the same value.
+
+    """
+    if (cached is not None and cached.lines is None and
+            cached.samples == family.samples):
+        return cached
+    reuse = (
+        cached is not None and cached.lines is not None and
+        cached.type == family.type and
+        cached.documentation == family.documentation)
+    cached_lines = cached.lines if reuse else {}
+
+    keys = []
+    lines = {}
+    changed = []
+    for sample in family.samples:
+        # samples are (name, labels, value, ...) tuples
+        key = (sample[0], tuple(sample[1].items()))
+        value = sample[2:]
+        keys.append(key)
+        line = cached_lines.get(key)
+        if line is not None and line[0] == value:
+            lines[key] = line
+        else:
+            changed.append((key, value, sample))
+
+    if reuse and not changed:
+        if keys == cached.keys:
+            return cached
+        # series were only removed or reordered
+        return cached._replace(
+            keys=keys, lines=lines,
+            text=cached.header + b''.join(lines[key][1] for key in keys))
+
+    partial = family
+    if reuse:
+        partial = copy.copy(family)
+        partial.samples = [sample for _, _, sample in changed]
+    output = generate_latest(_FamilyRegistry(partial))
+    split = _split_output(output, len(changed))
+    if split is not None:
+        header, sample_lines = split
+        for (key, value, _), line in zip(changed, sample_lines):
+            lines[key] = (value, line)
+    if split is None or len(lines) != len(keys):
+        # lines don't match series one to one
+        if partial is not family:
+            output = generate_latest(_FamilyRegistry(family))
+        return _RenderedFamily(
+            family.type, family.documentation, None, keys, None,
+            family.samples, output)
+
+    if partial is not family:
+        output = header + b''.join(lines[key][1] for key in keys)
+    return _RenderedFamily(
+        family.type, family.documentation, header, keys, lines, None, output)
+
+
+def _split_output(output, count):
+    """Split the output for a family in the header and sample lines.
+
+    None is returned if the output doesn't have the specified number of
+    sample lines after the header.
+
+    """
+    output_lines = output.splitlines(True)
+    header_size = 0
+    for line in output_lines:
+        if not line.startswith(b'#'):
+            break
+        header_size += 1
+    sample_lines = output_lines[header_size:]
+    if len(sample_lines) != count or any(
+            line.startswith(b'#') for line in sample_lines):
+        return None
+    return b''.join(output_lines[:header_size]), sample_lines
+
+
+class _FamilyRegistry:
+    """A registry-like object with a single metric family."""
+
+    def __init__(self, family):
+        self._family = family
+
+    def collect(self):
+        return [self._family]
@@ -0,0 +1,98 @@
+"""Limit the number of series exported for processes."""
+
+import heapq
+from operator import itemgetter
+
+
+# Value for labels of the series processes not selected are folded into
+OTHER_LABEL_VALUE = 'other'
+
+# Map ranking criteria to metrics summed for the score
+RANK_METRICS = {
+    'rss': ('proc_mem_rss',),
+    'cpu': ('proc_time_user', 'proc_time_system')}
+
+
+def top_keys(scores, count):
+    """Return a list with keys with the highest scores.
+
+    :param scores: an iterable of (key, score) tuples.
+    :param int count: the number of keys to return.
+
+    A heap of at most ``count`` items is kept.  With equal scores, keys
+    that come first are preferred.  Keys are returned in the order they're
+    passed.
+
+    """
+    heap = []
+    for index, (key, score) in enumerate(scores):
+        # keys are never compared, since indexes are unique
+        item = (score, -index, key)
+        if len(heap) < count:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    heap.sort(key=itemgetter(1), reverse=True)
+    return [key for _, _, key in heap]
+
+
+class SeriesGuard:
+    """Select label sets for which series are exported.
+
+    With a top K, only the K label sets with the highest score in each cycle
+    are selected.  Scores are summed over processes with the same labels,
+    from the RSS (``rss``) or the CPU time since the previous cycle
+    (``cpu``).
+
+    With a maximum number of series, label sets that already have series
+    are always selected, and new ones only while below the maximum.  Only
+    label sets found in the cycle count towards the maximum.
+
+    :param int max_series: the maximum number of label sets with series.
+    :param int top_k: the number of label sets to select in each cycle.
+    :param str rank_by: the criteria to rank label sets by, for top K.
+
+    """
+
+    def __init__(self, max_series=None, top_k=None, rank_by='rss'):
+        self.max_series = max_series
+        self.top_k = top_k
+        self.rank_by = rank_by
+        self._rank_metrics = RANK_METRICS[rank_by]
+
+    def score(self, values, deltas):
+        """Return the rank score for a process.
+
+        :param dict values: current metric values for the process.
+        :param dict deltas: counter increments since the previous cycle.
+
+        """
+        source = deltas if self.rank_by == 'cpu' else values
+        return sum(source.get(name) or 0 for name in self._rank_metrics)
+
+    def select(self, scores, tracked_keys):
+        """Return a set with selected label sets keys.
+
+        :param scores: an iterable of (key, score) tuples for label sets
+            found in the cycle, in the order processes were found.  Scores
+            are only used with a top K.
+        :param set tracked_keys: keys of label sets that already have series.
+
+        """
+        if self.top_k is None:
+            keys = [key for key, _ in scores]
+        else:
+            keys = top_keys(scores, self.top_k)
+        if self.max_series is None:
+            return set(keys)
+
+        available = self.max_series - sum(
+            1 for key in keys if key in tracked_keys)
+        selected = set()
+        for key in keys:
+            if key in tracked_keys:
+                selected.add(key)
+            elif available > 0:
+                selected.add(key)
+                available -= 1
+        return selected
@@ -0,0 +1,98 @@
+"""Self-instrumentation of the cost of collecting stats."""
+
+from collections import defaultdict
+import threading
+
+from prometheus_aioexporter.metric import MetricConfig
+
+
+# Buckets for phase durations, in seconds
+PHASE_DURATION_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# Map names of counts to the metric reporting them
+COUNT_METRICS = {
+    'processes_scanned': 'proc_exporter_processes_scanned',
+    'processes_matched': 'proc_exporter_processes_matched',
+    'files_read': 'proc_exporter_files_read',
+    'bytes_read': 'proc_exporter_bytes_read',
+    'read_errors': 'proc_exporter_read_errors'}
+
+PHASE_DURATION_METRIC = 'proc_exporter_phase_duration_seconds'
+
+
+class Tally:
+    """Accumulate values by name, possibly from multiple threads.
+
+    Values are summed until they're taken with :meth:`take`.
+
+    """
+
+    def __init__(self):
+        self._values = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, **values):
+        """Add values for names."""
+        with self._lock:
+            for name, value in values.items():
+                self._values[name] += value
+
+    def take(self):
+        """Return a dict with accumulated values, and reset them."""
+        with self._lock:
+            values, self._values = self._values, defaultdict(int)
+        return dict(values)
+
+
+class Instrumentation:
+    """Track the cost of collecting stats.
+
+    Durations of collection phases and counts are accumulated in
+    :attr:`durations` and :attr:`counts`, and reported to metrics on
+    :meth:`update_metrics`.
+
+    """
+
+    def __init__(self):
+        self.durations = Tally()
+        self.counts = Tally()
+
+    def metrics(self):
+        """Return a list of MetricConfigs."""
+        return [
+            MetricConfig(
+                PHASE_DURATION_METRIC,
+                'Time spent in each phase of stats collection', 'histogram',
+                {'labels': ['phase'], 'buckets': PHASE_DURATION_BUCKETS}),
+            MetricConfig(
+                COUNT_METRICS['processes_scanned'],
+                'Number of processes scanned for matches', 'counter', {}),
+            MetricConfig(
+                COUNT_METRICS['processes_matched'],
+                'Number of processes stats are collected for', 'counter', {}),
+            MetricConfig(
+                COUNT_METRICS['files_read'],
+                'Number of process files read', 'counter', {}),
+            MetricConfig(
+                COUNT_METRICS['bytes_read'],
+                'Number of bytes read from process files', 'counter', {}),
+            MetricConfig(
+                COUNT_METRICS['read_errors'],
+                'Number of failed reads of process files (e.g. for exited '
+                'processes)', 'counter', {})]
+
+    def update_metrics(self, metrics):
+        """Report accumulated durations and counts, and reset them.
+
+        :param dict metrics: a dict mapping names to metrics.
+
+        """
+        histogram = metrics[PHASE_DURATION_METRIC]
+        for phase, duration in sorted(self.durations.take().items()):
+            histogram.labels(phase=phase).observe(duration)
+        counts = self.counts.take()
+        for name, metric_name in COUNT_METRICS.items():
+            count = counts.get(name)
+            if count:
+                metrics[metric_name].inc(count)
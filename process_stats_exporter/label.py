@@ -13,6 +13,21 @@ class PidLabeler:
         return {'pid'}
 
 
+class CgroupLabeler:
+    """Return labels with the name of the cgroup a process was found in."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, process):
+        """Return label values for the process."""
+        return {'cgroup': self.name}
+
+    def labels(self):
+        """Return label names."""
+        return {'cgroup'}
+
+
 class CmdlineLabeler:
     """Return labels based on process command line regexp.
 
@@ -27,10 +42,21 @@ class CmdlineLabeler:
     def __init__(self, regexp):
         self._regexp = regexp
 
-    def __call__(self, process):
-        """Return label values for the process."""
-        match = self._regexp.search(process.cmd)
+    @property
+    def pattern(self):
+        """The pattern of the regexp."""
+        return self._regexp.pattern
+
+    def match(self, cmd):
+        """Return the regexp match for the command line, or None."""
+        return self._regexp.search(cmd)
 
+    def match_labels(self, match, comm):
+        """Return label values from a regexp match.
+
+        The process command name is only used if the regexp has no groups.
+
+        """
         groupdict = match.groupdict()
         if groupdict:
             return groupdict
@@ -41,7 +67,18 @@ class CmdlineLabeler:
                 '{}_{}'.format(self._match_prefix, idx): group
                 for idx, group in enumerate(groups, 1)}
 
-        return {'cmd': process.get('comm')}
+        return {'cmd': comm}
+
+    def __call__(self, process):
+        """Return label values for the process.
+
+        If the process command line doesn't match, None is returned.
+
+        """
+        match = self.match(process.cmd)
+        if match is None:
+            return None
+        return self.match_labels(match, process.get('comm'))
 
     def labels(self):
         """Return label names."""
@@ -52,3 +89,24 @@ class CmdlineLabeler:
                 '{}_{}'.format(self._match_prefix, idx)
                 for idx in range(1, self._regexp.groups + 1)}
         return {'cmd'}
+
+
+class CachedLabeler:
+    """Return labels previously computed by another labeler.
+
+    This is used to avoid computing labels again for processes that have
+    already been labeled.
+
+    """
+
+    def __init__(self, labeler, labels):
+        self.labeler = labeler
+        self._labels = labels
+
+    def __call__(self, process):
+        """Return label values for the process."""
+        return self._labels
+
+    def labels(self):
+        """Return label names."""
+        return self.labeler.labels()
@@ -1,11 +1,33 @@
 """Expose a Prometheus metrics endpoint with process stats."""
 
-from prometheus_aioexporter.script import PrometheusExporterScript
+import os
+import resource
+import threading
 
+from lxstats.process import Process
+
+from .cgroup import CGROUP_ROOT
+from .compat import (
+    PrometheusExporterScript,
+    unregister_metric)
+from .config import (
+    ConfigError,
+    ConfigWatcher,
+    load_config)
+from .exposition import ExpositionCache
+from .guard import RANK_METRICS
 from .metrics import ProcessMetricsHandler
+from .stats import (
+    BACKENDS,
+    COLLECTORS,
+    DEFAULT_COLLECTORS,
+    EXPENSIVE,
+    ProcBackend)
+from .sampler import MetricsSampler
 from .cmdline import (
     CmdlineRegexpAction,
     LabelAction)
+from .web import CachedExpositionApplication
 
 
 class ProcessStatsExporter(PrometheusExporterScript):
@@ -20,32 +42,316 @@ class ProcessStatsExporter(PrometheusExporterScript):
         parser.add_argument(
             '-R', '--cmdline-regexps', nargs='+', action=CmdlineRegexpAction,
             metavar='regexp', help='regexp to match process command line')
+        parser.add_argument(
+            '-C', '--cgroups', nargs='+', metavar='cgroup',
+            help=('path of cgroup to track processes in, absolute or relative '
+                  'to {}'.format(CGROUP_ROOT)))
         parser.add_argument(
             '-l', '--labels', nargs='+', action=LabelAction, metavar='label',
             default={},
             help='add static label to all metrics (as "name=value")')
+        parser.add_argument(
+            '--config', metavar='file',
+            help=('JSON or YAML file with PIDs, command line regexps and '
+                  'labels, overriding ones from the command line. It\'s '
+                  'reloaded on SIGHUP or when changed'))
+        parser.add_argument(
+            '--config-check-interval', type=float, metavar='seconds',
+            default=5,
+            help=('interval between checks for changes of the config file, '
+                  '0 to only reload on SIGHUP (default: %(default)s)'))
+        parser.add_argument(
+            '--collectors', nargs='+', choices=sorted(COLLECTORS),
+            default=list(DEFAULT_COLLECTORS), metavar='collector',
+            help='stats collectors to enable (choices: {})'.format(
+                ', '.join(sorted(COLLECTORS))))
+        parser.add_argument(
+            '--backend', choices=sorted(BACKENDS), default=ProcBackend.name,
+            help=('backend to read process stats from. The taskstats '
+                  'backend requires the CAP_NET_ADMIN capability '
+                  '(default: %(default)s)'))
+        parser.add_argument(
+            '--cgroup-stats', action='store_true',
+            help=('also export aggregate CPU and memory stats for cgroups '
+                  '(requires cgroup v2)'))
+        parser.add_argument(
+            '--expensive-refresh-interval', type=float, metavar='seconds',
+            help=('minimum interval between collections from expensive '
+                  'collectors, serving cached values in between'))
+        parser.add_argument(
+            '--include-children', action='store_true',
+            help=('also track descendants of processes matching regexps, '
+                  'with the same labels'))
+        parser.add_argument(
+            '--sample-interval', type=float, metavar='seconds',
+            help=('collect stats in background at the specified interval, '
+                  'instead of on each request'))
+        parser.add_argument(
+            '--window-sample-interval', type=float, metavar='seconds',
+            help=('sample RSS at the specified interval between '
+                  'collections, reporting its maximum, minimum and average'))
+        parser.add_argument(
+            '--window-size', type=int, metavar='count', default=120,
+            help=('maximum number of samples kept for each process and gauge '
+                  'between collections (default: %(default)s)'))
+        parser.add_argument(
+            '--collect-workers', type=int, metavar='count',
+            help='number of threads to collect process stats with')
+        parser.add_argument(
+            '--collect-processes', type=int, metavar='count',
+            help=('number of worker processes to collect process stats with, '
+                  'each one for a partition of PIDs'))
+        parser.add_argument(
+            '--tasks-sample-size', type=int, metavar='count',
+            help=('maximum number of tasks to read states for, for each '
+                  'process. Counts are extrapolated for processes with more '
+                  'tasks'))
+        parser.add_argument(
+            '--max-open-files', type=int, metavar='count',
+            help='maximum number of process files to keep open across scrapes')
+        parser.add_argument(
+            '--series-ttl', type=int, metavar='cycles',
+            help=('remove series for processes not seen for the specified '
+                  'number of collection cycles'))
+        parser.add_argument(
+            '--max-series', type=int, metavar='count',
+            help=('maximum number of label sets to export series for. '
+                  'Values for other processes are summed in "other" series'))
+        parser.add_argument(
+            '--top-k', type=int, metavar='count',
+            help=('only export series for the label sets ranking highest in '
+                  'each collection. Values for other processes are summed in '
+                  '"other" series'))
+        parser.add_argument(
+            '--top-by', choices=sorted(RANK_METRICS), default='rss',
+            help='criteria to rank label sets by (default: %(default)s)')
+        parser.add_argument(
+            '--rates', action='store_true',
+            help=('also export CPU utilisation and per-second rates of faults '
+                  'and context switches, computed between collections'))
+        parser.add_argument(
+            '--raw-counters', action='store_true',
+            help=('export cumulative values from process stats for counters, '
+                  'instead of incrementing them'))
+        parser.add_argument(
+            '--aggregate', action='store_true',
+            help=('sum metrics for processes with the same labels, instead '
+                  'of reporting them per process'))
 
     def configure(self, args):
+        # selectors from the command line, for options not in the config
+        self._cmdline_selectors = {
+            'pids': args.pids, 'cmdline_regexps': args.cmdline_regexps,
+            'labels': args.labels}
+        if args.config:
+            try:
+                config = load_config(args.config)
+            except ConfigError as error:
+                self.exit('Error: {}'.format(error))
+            for key, value in config.items():
+                setattr(args, key, value)
+
         if args.pids:
             self.logger.info(
                 'tracking stats for PIDs [{}]'.format(
                     ', '.join(str(pid) for pid in args.pids)))
+        elif args.cgroups:
+            self.logger.info(
+                'tracking stats for processes in cgroups [{}]'.format(
+                    ', '.join(args.cgroups)))
         elif args.cmdline_regexps:
             self.logger.info(
                 'tracking stats for processes matching regexps [{}]'.format(
                     ', '.join(rexp.pattern for rexp in args.cmdline_regexps)))
         else:
-            self.exit('Error: no PID or process names specified')
+            self.exit('Error: no PID, cgroup or process names specified')
+
+        if args.cgroup_stats and not args.cgroups:
+            self.exit('Error: cgroup stats require cgroups')
+
+        if args.include_children and not args.cmdline_regexps:
+            self.exit(
+                'Error: including children requires command line regexps')
 
+        if args.window_sample_interval and args.window_size < 1:
+            self.exit('Error: window size must be positive')
+
+        if args.max_open_files:
+            files_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if args.max_open_files >= files_limit:
+                self.exit(
+                    'Error: maximum open files must be lower than the process '
+                    'limit ({})'.format(files_limit))
+
+        backend = self._get_backend(args.backend)
         self._metric_handler = ProcessMetricsHandler(
             logger=self.logger, pids=args.pids,
-            cmdline_regexps=args.cmdline_regexps, labels=args.labels)
-        self.create_metrics(self._metric_handler.get_metric_configs())
+            cmdline_regexps=args.cmdline_regexps, labels=args.labels,
+            collect_workers=args.collect_workers,
+            tasks_sample_size=args.tasks_sample_size,
+            max_open_files=args.max_open_files, series_ttl=args.series_ttl,
+            raw_counters=args.raw_counters, aggregate=args.aggregate,
+            collectors=args.collectors,
+            refresh_intervals={EXPENSIVE: args.expensive_refresh_interval},
+            include_children=args.include_children, backend=backend,
+            cgroups=args.cgroups, cgroup_stats=args.cgroup_stats,
+            max_series=args.max_series, top_k=args.top_k,
+            top_by=args.top_by,
+            window_size=(
+                args.window_size if args.window_sample_interval else None),
+            rates=args.rates, collect_processes=args.collect_processes)
+        metric_configs = self._metric_handler.get_metric_configs()
+
+        self._exposition = ExpositionCache(self.registry.registry)
+        self._sampler = None
+        if args.sample_interval:
+            self.logger.info(
+                'collecting stats every {} seconds'.format(
+                    args.sample_interval))
+            self._sampler = MetricsSampler(
+                self.logger, self._update_metrics,
+                args.sample_interval, on_sample=self._exposition.update)
+            metric_configs.extend(self._sampler.metrics())
+        self._window_sampler = None
+        if args.window_sample_interval:
+            self.logger.info(
+                'sampling gauges every {} seconds'.format(
+                    args.window_sample_interval))
+            self._window_sampler = MetricsSampler(
+                self.logger, self._sample_gauge_windows,
+                args.window_sample_interval)
+
+        self._config_lock = threading.Lock()
+        self._pending_config = None
+        self._cgroups = args.cgroups
+        self._include_children = args.include_children
+        self._config_watcher = None
+        if args.config:
+            self._config_watcher = ConfigWatcher(
+                args.config, self._reload_config,
+                interval=args.config_check_interval)
+
+        self._metrics = self.create_metrics(metric_configs)
+        if self._metric_handler.cumulative_counters is not None:
+            self.registry.register_additional_collector(
+                self._metric_handler.cumulative_counters)
+        if self._metric_handler.cgroup_stats is not None:
+            self.registry.register_additional_collector(
+                self._metric_handler.cgroup_stats)
+
+    def _get_backend(self, name):
+        """Return the stats backend, exiting if it can't be used."""
+        try:
+            backend = BACKENDS[name]()
+            # check that stats can be read
+            backend.make_reader(['stat.utime']).read(
+                Process(os.getpid(), '/proc/{}'.format(os.getpid())))
+            backend.check()
+        except OSError as error:
+            self.exit(
+                'Error: can\'t read stats with the {} backend: {}'.format(
+                    name, error))
+        self.logger.info('reading process stats with {}'.format(name))
+        return backend
+
+    def _create_application(self, args):
+        # called by prometheus_aioexporter before 1.4, see compat
+        return self._create_web(args)
+
+    def _get_exporter(self, args):
+        # called by prometheus_aioexporter 1.4 and later, see compat
+        return self._create_web(args)
+
+    def _create_web(self, args):
+        """Create the web application, serving the cached exposition."""
+        web = self._web = CachedExpositionApplication(
+            self.name, self.description, args.host, args.port, self.registry,
+            self._exposition)
+        app = getattr(web, 'app', web)
+        app.on_startup.append(self.on_application_startup)
+        app.on_shutdown.append(self.on_application_shutdown)
+        return web
+
+    def _reload_config(self):
+        """Load the config file, to apply it on the next update.
+
+        If the config is not valid, the current one is kept.
+
+        """
+        try:
+            config = load_config(self._config_watcher.path)
+        except ConfigError as error:
+            self.logger.error('not reloading config: {}'.format(error))
+            return
+        selectors = dict(self._cmdline_selectors, **config)
+        if not (selectors['pids'] or selectors['cmdline_regexps'] or
+                self._cgroups):
+            self.logger.error(
+                'not reloading config: no PID, cgroup or process names '
+                'specified')
+            return
+        if self._include_children and not selectors['cmdline_regexps']:
+            self.logger.error(
+                'not reloading config: including children requires command '
+                'line regexps')
+            return
+        self.logger.info(
+            'reloading config from {}'.format(self._config_watcher.path))
+        with self._config_lock:
+            self._pending_config = selectors
+
+    def _update_metrics(self, metrics):
+        """Update metrics, applying the reloaded config first if any."""
+        with self._config_lock:
+            config, self._pending_config = self._pending_config, None
+        if config is not None:
+            self._apply_config(config)
+            metrics = self.registry.get_metrics()
+        self._metric_handler.update_metrics(metrics)
+
+    def _apply_config(self, config):
+        """Apply a config to the handler.
+
+        Metrics whose labels change are registered again.
+
+        """
+        metrics = self.registry.get_metrics()
+        names = self._metric_handler.reconfigure(metrics, **config)
+        if not names:
+            return
+        for name in names:
+            unregister_metric(self.registry, metrics[name])
+        self._metrics.update(
+            self.create_metrics(
+                [metric_config
+                 for metric_config in self._metric_handler.get_metric_configs()
+                 if metric_config.name in names]))
+        self.logger.info('registered {} metrics again'.format(len(names)))
+
+    def _sample_gauge_windows(self, metrics):
+        """Sample gauges for processes between collections."""
+        self._metric_handler.gauge_windows.sample()
 
     async def on_application_startup(self, application):
-        # setup handler to update metrics on requests
-        application.set_metric_update_handler(
-            self._metric_handler.update_metrics)
+        if self._config_watcher:
+            self._config_watcher.start()
+        if self._window_sampler:
+            self._window_sampler.start({})
+        if self._sampler:
+            # metrics are updated in background, requests get the last sample
+            self._sampler.start(self._metrics)
+        else:
+            # setup handler to update metrics on requests
+            self._web.set_metric_update_handler(self._update_metrics)
+
+    async def on_application_shutdown(self, application):
+        if self._config_watcher:
+            await self._config_watcher.stop()
+        if self._sampler:
+            await self._sampler.stop()
+        if self._window_sampler:
+            await self._window_sampler.stop()
+        self._metric_handler.close()
 
 
 script = ProcessStatsExporter()
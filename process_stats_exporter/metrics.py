@@ -1,65 +1,806 @@
 """Create and update metrics."""
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
+import os
+import time
 
+from prometheus_aioexporter.metric import MetricConfig
+
+from .cgroup import (
+    CgroupStatsCollector,
+    get_cgroup_path)
+from .counters import (
+    CounterDeltas,
+    CumulativeCountersCollector)
+from .guard import (
+    OTHER_LABEL_VALUE,
+    SeriesGuard)
+from .instrument import Instrumentation
 from .stats import (
+    COLLECTORS,
+    DEFAULT_COLLECTORS,
+    ProcBackend,
     ProcessStatsCollector,
     ProcessTasksStatsCollector)
-from .process import get_process_iterator
+from .procfs import (
+    FileCache,
+    ProcStatsReader)
+from .process import (
+    ProcessCache,
+    get_process_iterator)
 from .label import (
+    CgroupLabeler,
     PidLabeler,
     CmdlineLabeler)
+from .workers import CollectWorkers
+from .window import (
+    NON_ADDITIVE_METRICS as NON_ADDITIVE_WINDOW_METRICS,
+    GaugeWindows,
+    window_values)
 
 
 class ProcessMetricsHandler:
-    """Handle metrics for processes."""
+    """Handle metrics for processes.
+
+    Stats are collected by the specified collectors (by name, from
+    :data:`COLLECTORS`).  Metrics that a collector doesn't report for a
+    process (e.g. because of missing permissions) are not updated.
+
+    If children are included, descendants of processes matching command
+    line regexps are also tracked, with the labels of the matching process.
+    With aggregation, their values are summed in the same group.
+
+    If cgroups are specified, processes in them are tracked, labeled with
+    the cgroup name.  If cgroup stats are enabled, aggregate stats for each
+    cgroup are exported by the :attr:`cgroup_stats` collector.
+
+    Process stats are read through the specified backend (by default, from
+    files under ``/proc``), which is closed along with the handler.
+
+    If refresh intervals are specified for collectors cost tiers, values
+    from collectors in those tiers are collected at most once per interval
+    for each process, and cached values are reported in between.
+
+    If a number of collect workers is specified, stats for processes are
+    collected in parallel by a pool of threads.
+
+    If a number of collect processes is specified, stats are collected by a
+    pool of long-lived :class:`CollectWorkers` processes, each one owning a
+    partition of PIDs, with its own copy of collectors and caches.  Each
+    worker process uses its own pool of collect threads, if enabled.
+
+    If a tasks sample size is specified, tasks states for processes with more
+    tasks are extrapolated from a sample of tasks.
+
+    If a maximum number of open files is specified, process files are kept
+    open across collections.
+
+    If rates are enabled, collectors report per-second rates for CPU time,
+    faults and context switches, computed from consecutive collections.
+
+    If a window size is specified, gauges are also sampled between
+    collections by the :attr:`gauge_windows` sampler, and their maximum,
+    minimum and average over samples are reported.  Sampling is driven by
+    calling :meth:`GaugeWindows.sample`.  Series for window metrics are
+    removed for label sets without samples since the previous update, and
+    aggregated values are computed on totals of samples taken together.
+
+    If a series TTL is specified, series that haven't been updated for the
+    specified number of cycles (e.g. because processes have exited) are
+    removed.
+
+    Counters are incremented by the difference between cumulative values
+    from process stats and the ones from the previous update.  If raw
+    counters are enabled, cumulative values are instead exported directly
+    by the :attr:`cumulative_counters` collector, and counters are not
+    included in MetricConfigs.
+
+    If aggregation is enabled, values for processes with the same labels are
+    summed, and a metric reports the number of processes in each group.
+    Metrics which can't be summed are not reported.
+
+    If a maximum number of series or a top K is specified, series are only
+    exported for label sets selected by a :class:`SeriesGuard`.  Values for
+    other processes are summed in series with all process labels set to
+    ``other``, so stats are still collected for all processes.
+
+    The time spent in each collection phase (process discovery, each stats
+    collector and metrics update) is reported, along with counts of
+    processes and files read.
+
+    """
+
+    _clock = time.monotonic  # For testing
+    _timer = time.perf_counter  # For testing
+
+    # metrics which can't be summed across processes
+    _NON_ADDITIVE_METRICS = NON_ADDITIVE_WINDOW_METRICS
 
     def __init__(self, logger, pids=None, cmdline_regexps=None, labels=None,
+                 collect_workers=None, tasks_sample_size=None,
+                 max_open_files=None, series_ttl=None, raw_counters=False,
+                 aggregate=False, collectors=DEFAULT_COLLECTORS,
+                 refresh_intervals=None, include_children=False,
+                 backend=None, cgroups=None, cgroup_stats=False,
+                 max_series=None, top_k=None, top_by='rss', window_size=None,
+                 rates=False, collect_processes=None,
                  get_process_iterator=get_process_iterator):
         self.logger = logger
         self._pids = pids or ()
         self._cmdline_regexps = cmdline_regexps or ()
         self._labels = labels or {}
+        self._include_children = include_children
+        self._cgroups = cgroups or ()
+        self._missing_cgroups = set()
         self._get_process_iterator = get_process_iterator
+        self._process_cache = ProcessCache()
+        self._executor = None
+        if collect_workers:
+            self._executor = ThreadPoolExecutor(max_workers=collect_workers)
 
-        label_names = self._get_label_names()
+        self._file_cache = None
+        if max_open_files:
+            self._file_cache = FileCache(max_open_files)
+
+        self._backend = backend if backend is not None else ProcBackend()
+        self._instrumentation = Instrumentation()
+        self._refresh_intervals = refresh_intervals or {}
+        # map (collector name, PID) to (timestamp, start time, values, delay)
+        self._cached_values = {}
+        label_names = self._label_names = self._get_label_names()
         self._collectors = [
-            ProcessStatsCollector(labels=label_names),
-            ProcessTasksStatsCollector(labels=label_names)]
+            self._make_collector(name, label_names, tasks_sample_size, rates)
+            # in the order they're defined, so that the start time is
+            # collected first
+            for name in COLLECTORS if name in collectors]
+        self._start_time_reader = None
+        if self._get_collector(ProcessStatsCollector.name) is None:
+            # the start time tells processes with the same PID apart, for
+            # counters and cached values
+            self._start_time_reader = ProcStatsReader(
+                ['stat.starttime'], file_cache=self._file_cache,
+                counts=self._instrumentation.counts)
+        self.gauge_windows = None
+        if window_size:
+            self.gauge_windows = GaugeWindows(
+                window_size, labels=label_names,
+                counts=self._instrumentation.counts)
+        counter_configs = [
+            config for config in self._collector_metric_configs()
+            if config.type == 'counter']
+        self._counter_names = [config.name for config in counter_configs]
+        self.cumulative_counters = None
+        if raw_counters:
+            self.cumulative_counters = CumulativeCountersCollector(
+                counter_configs, label_names)
+        self._aggregate = aggregate
+        self._metric_configs = self._make_metric_configs(label_names)
+        self.cgroup_stats = None
+        if cgroup_stats:
+            self.cgroup_stats = CgroupStatsCollector(
+                self._cgroups, labels=self._labels)
+        self._metric_names = [
+            config.name for config in self._metric_configs]
+        self._window_names = frozenset()
+        if self.gauge_windows is not None:
+            self._window_names = frozenset(
+                config.name for config in self.gauge_windows.metrics()
+                if config.name in self._metric_names)
+        # map Processes to window samples from the last collection
+        self._window_samples = {}
+        self._counter_deltas = CounterDeltas(self._counter_names)
+        # map process labels to tuples with (labels, series for each metric)
+        self._series = {}
+        self._series_ttl = series_ttl
+        self._guard = None
+        if max_series or top_k:
+            self._guard = SeriesGuard(
+                max_series=max_series, top_k=top_k, rank_by=top_by)
+        self._set_other_labels()
+        self._guard_tripped = False
+        self._other_collided = False
+        # map process labels to the last cycle series were updated
+        self._series_cycles = {}
+        self._cycle = 0
+        # whether series not updated in the next cycle must be removed
+        self._evict_unseen = False
+        self._workers = None
+        if collect_processes:
+            # workers are forked with a copy of the handler as it is now
+            value_names = [
+                config.name for config in self._collector_metric_configs()]
+            value_names.append('proc_start_time')
+            self._workers = CollectWorkers(
+                self.logger, collect_processes, value_names,
+                self._collect_partition, initializer=self._backend.reopen,
+                finalizer=self.close)
 
     def get_metric_configs(self):
         """Return a list of MetricConfigs."""
-        return list(chain(
-            *(collector.metrics() for collector in self._collectors)))
+        metric_configs = list(self._metric_configs)
+        metric_configs.extend(self._instrumentation.metrics())
+        if self._series_ttl:
+            metric_configs.append(
+                MetricConfig(
+                    'proc_exporter_evicted_series',
+                    'Number of series removed for stale processes',
+                    'counter', {}))
+        if self._guard is not None:
+            metric_configs.append(
+                MetricConfig(
+                    'proc_exporter_folded_series',
+                    'Number of label sets folded into "other" series',
+                    'counter', {}))
+        return metric_configs
+
+    def reconfigure(self, metrics, pids=None, cmdline_regexps=None,
+                    labels=None):
+        """Change PIDs and command line regexps to track, and static labels.
+
+        Cached command line matches for processes are kept, except for ones
+        matching new regexps.  Series for processes no longer tracked are
+        removed on the next update.
+
+        If label names change, all process series are discarded, and a list
+        of names of metrics to create again is returned: existing ones must
+        be unregistered, and new ones created from :meth:`get_metric_configs`
+        before the next update.  Otherwise, an empty list is returned, and if
+        static label values change, existing series are removed from the
+        specified metrics.
+
+        """
+        cmdline_regexps = list(cmdline_regexps or ())
+        old_patterns = {regexp.pattern for regexp in self._cmdline_regexps}
+        new_patterns = {regexp.pattern for regexp in cmdline_regexps}
+        if old_patterns != new_patterns:
+            self._process_cache.update_regexps(
+                old_patterns - new_patterns,
+                [regexp for regexp in cmdline_regexps
+                 if regexp.pattern not in old_patterns])
+        self._pids = pids or ()
+        self._cmdline_regexps = cmdline_regexps
+        labels = dict(labels or {})
+        labels_changed = labels != self._labels
+        self._labels = labels
+        if self.cgroup_stats is not None:
+            self.cgroup_stats.set_labels(labels)
+        self._evict_unseen = True
+
+        label_names = self._get_label_names()
+        if label_names == self._label_names:
+            if labels_changed:
+                self._remove_series(metrics, list(self._series))
+            return []
+
+        self.logger.info(
+            'label names changed from {} to {}'.format(
+                sorted(self._label_names), sorted(label_names)))
+        self._label_names = label_names
+        self._metric_configs = self._make_metric_configs(label_names)
+        self._set_other_labels()
+        self._series.clear()
+        self._series_cycles.clear()
+        return list(self._metric_names)
 
     def update_metrics(self, metrics):
         """Update the specified metrics for processes."""
+        self._cycle += 1
+        self._counter_deltas.new_cycle()
+        collected = self.collect()
+
+        start = time.perf_counter()
+        samples = self._get_samples(collected)
+        if self._guard is not None:
+            samples = self._fold_samples(samples, metrics)
+        cumulative_samples = []
+        # map process labels to [labels, series, metric values, processes]
+        # for aggregation
+        groups = OrderedDict()
+        # (process labels, metric name) for updated window metrics
+        windows_updated = set()
+        for key, process_labels, process, values, _ in samples:
+            labels, series = self._get_series(key, process_labels, metrics)
+            if self.cumulative_counters is not None:
+                cumulative_samples.append(
+                    (labels, (process.pid, values.get('proc_start_time')),
+                     values))
+            if self._aggregate or key == self._other_key:
+                self._add_to_group(
+                    groups, key, labels, series, process, values)
+                continue
+            for name in self._metric_names:
+                if name in values:
+                    self._update_metric(
+                        process, name,
+                        self._get_metric_series(metrics, labels, series, name),
+                        values[name])
+                    if name in self._window_names:
+                        windows_updated.add((key, name))
+
+        for key, (labels, series, values, processes) in groups.items():
+            if self._window_names:
+                values.update(
+                    window_values(
+                        [self._window_samples.get(process, {})
+                         for process in processes]))
+            for name in self._metric_names:
+                if (key == self._other_key and
+                        name in self._NON_ADDITIVE_METRICS):
+                    continue
+                if name not in values:
+                    continue
+                self._set_metric_value(
+                    self._get_metric_series(metrics, labels, series, name),
+                    values[name])
+                if name in self._window_names:
+                    windows_updated.add((key, name))
+        if self._window_names:
+            self._remove_window_series(metrics, windows_updated)
+        if self.cumulative_counters is not None:
+            self.cumulative_counters.update(cumulative_samples)
+        if self._series_ttl or self._evict_unseen:
+            self._evict_series(metrics)
+        self._instrumentation.durations.add(
+            update=time.perf_counter() - start)
+        self._instrumentation.update_metrics(metrics)
+
+    def collect(self):
+        """Collect stats for processes.
+
+        Return a list of tuples with (labelers, Process, metric_values), in
+        the order processes are found. Stats for a process matched by multiple
+        labelers are only collected once.
+
+        """
+        if self._file_cache is not None:
+            self._file_cache.new_cycle()
+        self._backend.new_cycle()
+        start = time.perf_counter()
+        if self._cgroups:
+            self._check_cgroups()
         process_iter = self._get_process_iterator(
-            pids=self._pids, cmdline_regexps=self._cmdline_regexps)
+            pids=self._pids, cmdline_regexps=self._cmdline_regexps,
+            cache=self._process_cache,
+            counts=self._instrumentation.counts,
+            include_children=self._include_children, cgroups=self._cgroups,
+            file_cache=self._file_cache)
+        process_labelers = OrderedDict()
         for labeler, process in process_iter:
-            metric_values = {}
-            for collector in self._collectors:
-                metric_values.update(collector.collect(process))
-            for name, metric in metrics.items():
-                self._update_metric(
-                    labeler, process, name, metric, metric_values[name])
-
-    def _update_metric(self, labeler, process, metric_name, metric, value):
+            process_labelers.setdefault(process, []).append(labeler)
+
+        processes = list(process_labelers)
+        self._instrumentation.durations.add(
+            discovery=time.perf_counter() - start)
+        self._instrumentation.counts.add(processes_matched=len(processes))
+        self._prune(processes)
+        if self.gauge_windows is not None:
+            self.gauge_windows.track(processes)
+        if self._workers is None:
+            self._backend.prefetch(processes)
+            values = self._collect_processes(processes)
+        else:
+            values, infos = self._workers.collect(processes)
+            for info in infos:
+                if info is not None:
+                    durations, counts = info
+                    self._instrumentation.durations.add(**durations)
+                    self._instrumentation.counts.add(**counts)
+        if self.gauge_windows is not None:
+            self._window_samples = {}
+            for process, metric_values in zip(processes, values):
+                samples = self.gauge_windows.take(process.pid)
+                self._window_samples[process] = samples
+                metric_values.update(window_values([samples]))
+        return [
+            (process_labelers[process], process, metric_values)
+            for process, metric_values in zip(processes, values)]
+
+    def close(self):
+        """Release resources used for collecting stats."""
+        if self._workers is not None:
+            self._workers.close()
+            self._workers = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._file_cache is not None:
+            self._file_cache.close()
+        self._backend.close()
+
+    def _check_cgroups(self):
+        """Log when cgroups are not found, or found again.
+
+        Missing cgroups have no processes.  This is only logged when their
+        state changes, rather than on every update.
+
+        """
+        missing = {
+            cgroup for cgroup in self._cgroups
+            if not os.path.isdir(get_cgroup_path(cgroup))}
+        for cgroup in sorted(missing - self._missing_cgroups):
+            self.logger.warning('cgroup not found: {}'.format(cgroup))
+        for cgroup in sorted(self._missing_cgroups - missing):
+            self.logger.info('cgroup found: {}'.format(cgroup))
+        self._missing_cgroups = missing
+
+    def _make_collector(self, name, label_names, tasks_sample_size, rates):
+        """Return a StatsCollector by name."""
+        counts = self._instrumentation.counts
+        collector_class = COLLECTORS[name]
+        if collector_class is ProcessTasksStatsCollector:
+            return collector_class(
+                labels=label_names, sample_size=tasks_sample_size,
+                counts=counts)
+        if issubclass(collector_class, ProcessStatsCollector):
+            return collector_class(
+                labels=label_names, file_cache=self._file_cache,
+                counts=counts, backend=self._backend, rates=rates)
+        return collector_class(
+            labels=label_names, file_cache=self._file_cache, counts=counts)
+
+    def _make_metric_configs(self, label_names):
+        """Return a list of MetricConfigs for process metrics.
+
+        Label names for collectors and samplers are also set.
+
+        """
+        for collector in self._collectors:
+            collector.labels = list(label_names)
+        metric_configs = self._collector_metric_configs()
+        if self.gauge_windows is not None:
+            self.gauge_windows.labels = list(label_names)
+            metric_configs.extend(self.gauge_windows.metrics())
+        if self.cumulative_counters is not None:
+            self.cumulative_counters.set_label_names(label_names)
+            metric_configs = [
+                config for config in metric_configs
+                if config.type != 'counter']
+        if self._aggregate:
+            metric_configs = [
+                config for config in metric_configs
+                if config.name not in self._NON_ADDITIVE_METRICS]
+            metric_configs.append(
+                MetricConfig(
+                    'proc_group_process_count',
+                    'Number of processes with the same labels', 'gauge',
+                    {'labels': list(label_names)}))
+        return metric_configs
+
+    def _set_other_labels(self):
+        """Set labels and key for the "other" series."""
+        self._other_labels = {
+            name: OTHER_LABEL_VALUE for name in self._label_names
+            if name not in self._labels}
+        self._other_key = tuple(sorted(self._other_labels.items()))
+
+    def _collect_processes(self, processes):
+        """Return a list of dicts with metric values for processes."""
+        if self._executor is None:
+            return [self._collect_process(process) for process in processes]
+        return list(self._executor.map(self._collect_process, processes))
+
+    def _collect_partition(self, processes):
+        """Collect stats for processes in a worker process.
+
+        Return a tuple with a list of dicts with metric values and a tuple
+        with durations and counts for instrumentation.
+
+        """
+        if self._file_cache is not None:
+            self._file_cache.new_cycle()
+        self._backend.new_cycle()
+        self._prune(processes)
+        self._backend.prefetch(processes)
+        values = self._collect_processes(processes)
+        return values, (
+            self._instrumentation.durations.take(),
+            self._instrumentation.counts.take())
+
+    def _get_collector(self, name):
+        """Return an enabled collector by name, or None."""
+        for collector in self._collectors:
+            if collector.name == name:
+                return collector
+        return None
+
+    def _collector_metric_configs(self):
+        """Return a list of MetricConfigs for collectors."""
+        return list(chain(
+            *(collector.metrics() for collector in self._collectors)))
+
+    def _collect_process(self, process):
+        """Return a dict with metric values for a process."""
+        metric_values = {}
+        durations = {}
+        now = self._clock()
+        if self._start_time_reader is not None:
+            metric_values['proc_start_time'] = self._start_time_reader.read(
+                process)['stat.starttime']
+        for collector in self._collectors:
+            values = self._get_cached_values(
+                collector, process, metric_values, now)
+            if values is not None:
+                metric_values.update(values)
+                continue
+
+            start = self._timer()
+            values = collector.collect(process)
+            elapsed = self._timer() - start
+            durations['collect_' + collector.name] = elapsed
+            metric_values.update(values)
+            delay = self._get_refresh_delay(collector, elapsed)
+            if delay:
+                self._cached_values[(collector.name, process.pid)] = (
+                    now, metric_values.get('proc_start_time'), values, delay)
+        self._instrumentation.durations.add(**durations)
+        return metric_values
+
+    def _get_refresh_delay(self, collector, elapsed):
+        """Return the delay before refreshing values from a collector.
+
+        This is the refresh interval for the collector cost tier, if set.
+        For collectors with a maximum duty cycle, it's extended so that the
+        time spent collecting for the process stays below that fraction, up
+        to the collector maximum back-off.
+
+        """
+        delay = self._refresh_intervals.get(collector.cost) or 0
+        if collector.max_duty:
+            backoff = min(elapsed / collector.max_duty, collector.max_backoff)
+            delay = max(delay, backoff)
+        return delay
+
+    def _get_cached_values(self, collector, process, metric_values, now):
+        """Return cached values from a collector for a process.
+
+        None is returned if values are not cached, they're older than the
+        refresh delay or they're for a different process with the same PID.
+
+        """
+        cached = self._cached_values.get((collector.name, process.pid))
+        if cached is None:
+            return None
+        timestamp, start_time, values, delay = cached
+        if now - timestamp >= delay:
+            return None
+        if start_time != metric_values.get('proc_start_time'):
+            return None
+        return values
+
+    def _prune(self, processes):
+        """Remove cached values and state for processes not found."""
+        pids = {process.pid for process in processes}
+        for key in list(self._cached_values):
+            if key[1] not in pids:
+                del self._cached_values[key]
+        for collector in self._collectors:
+            collector.prune(pids)
+
+    def _get_samples(self, collected):
+        """Return a list of samples for collected processes.
+
+        Samples are tuples with (key, process labels, Process, values,
+        deltas), one for each labeler matching a process.  Deltas are
+        increments for counters since the previous update.  If counters are
+        incremented, they're also included in values.
+
+        """
+        track_deltas = self.cumulative_counters is None or (
+            self._guard is not None and self._guard.rank_by == 'cpu')
+        samples = []
+        for labelers, process, metric_values in collected:
+            start_time = metric_values.get('proc_start_time')
+            for labeler in labelers:
+                process_labels = labeler(process)
+                if process_labels is None:
+                    continue
+                key = tuple(sorted(process_labels.items()))
+                values = metric_values.copy()
+                deltas = {}
+                if track_deltas:
+                    deltas = self._counter_deltas.deltas(
+                        (key, process.pid), start_time, metric_values)
+                if self.cumulative_counters is None:
+                    values.update(deltas)
+                samples.append((key, process_labels, process, values, deltas))
+        return samples
+
+    def _fold_samples(self, samples, metrics):
+        """Return samples, with ones not selected by the guard folded.
+
+        Folded samples get labels for the "other" series.  With a top K,
+        series for label sets not selected are removed.  With a maximum
+        number of series, series for label sets not found in this cycle are
+        removed when new label sets need their place.
+
+        Label sets with the same labels as "other" series are never
+        selected, so that their values are reported as folded.
+
+        """
+        rank = self._guard.top_k is not None
+        # keys of label sets in the order they're found, and their scores
+        keys = []
+        scores = {}
+        colliding = False
+        for key, _, _, values, deltas in samples:
+            if key == self._other_key:
+                colliding = True
+                continue
+            if key not in scores:
+                keys.append(key)
+                scores[key] = 0
+            if rank:
+                scores[key] += self._guard.score(values, deltas)
+        if colliding and not self._other_collided:
+            self.logger.warning(
+                'process labels are the same as for "other" series, '
+                'folding them')
+        self._other_collided = colliding
+
+        series_keys = set(self._series)
+        series_keys.discard(self._other_key)
+        selected = self._guard.select(
+            ((key, scores[key]) for key in keys), series_keys)
+        if rank:
+            # series for label sets no longer in the top K are removed, so
+            # that their values are only reported in "other" series
+            self._remove_series(metrics, series_keys.difference(selected))
+        else:
+            self._remove_unseen_series(
+                metrics, series_keys.difference(scores),
+                len(series_keys) + len(selected.difference(series_keys)) -
+                self._guard.max_series)
+        folded = len(keys) - len(selected) + colliding
+        if folded:
+            metrics['proc_exporter_folded_series'].inc(folded)
+            if not self._guard_tripped:
+                self.logger.warning(
+                    'series limit reached, folding {} label sets into '
+                    '"other" series'.format(folded))
+        self._guard_tripped = bool(folded)
+        return [
+            sample if sample[0] in selected
+            else (self._other_key, self._other_labels) + sample[2:]
+            for sample in samples]
+
+    def _remove_unseen_series(self, metrics, unseen_keys, count):
+        """Remove series for up to count label sets not found in this cycle.
+
+        Series least recently updated are removed first.
+
+        """
+        if count <= 0:
+            return
+        keys = sorted(unseen_keys, key=self._series_cycles.get)[:count]
+        self._remove_series(metrics, keys)
+
+    def _get_series(self, key, process_labels, metrics):
+        """Return series for process labels.
+
+        A tuple with (labels, series) is returned, where series is a dict
+        mapping metric names to series.
+
+        Series are cached based on labels for the process, so labels for
+        metrics are only resolved once for each set of labels.  Series for a
+        metric are only created once a value is reported for it.
+
+        """
+        self._series_cycles[key] = self._cycle
+        cached = self._series.get(key)
+        if cached is None:
+            labels = self._labels.copy()
+            labels.update(process_labels)
+            series = {}
+            self._series[key] = labels, series
+        else:
+            labels, series = cached
+        return labels, series
+
+    def _add_to_group(self, groups, key, labels, series, process, values):
+        """Add metric values for a process to the group for its labels.
+
+        Window metrics are not summed, since they're computed from samples
+        of all processes in the group.  Totals only include metrics that at
+        least one process in the group has a value for.
+
+        """
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [labels, series, {}, []]
+        totals = group[2]
+        group[3].append(process)
+        values['proc_group_process_count'] = 1
+        for name in self._metric_names:
+            if name not in values or name in self._window_names:
+                continue
+            value = values[name]
+            if value is None:
+                self._warn_empty_value(process, name)
+            else:
+                totals[name] = totals.get(name, 0) + value
+
+    def _evict_series(self, metrics):
+        """Remove series not updated within the TTL.
+
+        After a reconfiguration, series not updated in the last cycle are
+        removed.
+
+        """
+        ttl = 1 if self._evict_unseen else self._series_ttl
+        self._evict_unseen = False
+        stale_keys = [
+            key for key, cycle in self._series_cycles.items()
+            if self._cycle - cycle >= ttl]
+        removed = self._remove_series(metrics, stale_keys)
+
+        if stale_keys:
+            self.logger.debug(
+                'removed series for {} stale label sets'.format(
+                    len(stale_keys)))
+            if self._series_ttl:
+                metrics['proc_exporter_evicted_series'].inc(removed)
+
+    def _remove_series(self, metrics, keys):
+        """Remove series for process labels from metrics.
+
+        Return the number of removed series.
+
+        """
+        removed = 0
+        for key in keys:
+            self._series_cycles.pop(key, None)
+            labels, series = self._series.pop(key)
+            for name in series:
+                self._remove_metric_series(metrics[name], labels)
+            removed += len(series)
+        return removed
+
+    def _remove_window_series(self, metrics, updated):
+        """Remove series for window metrics not updated in this cycle.
+
+        :param set updated: (process labels, metric name) tuples for updated
+            series.
+
+        """
+        for key, (labels, series) in self._series.items():
+            for name in self._window_names:
+                if name in series and (key, name) not in updated:
+                    del series[name]
+                    self._remove_metric_series(metrics[name], labels)
+
+    def _get_metric_series(self, metrics, labels, series, name):
+        """Return the series for a metric, creating it if needed."""
+        metric_series = series.get(name)
+        if metric_series is None:
+            metric_series = series[name] = metrics[name].labels(**labels)
+        return metric_series
+
+    def _remove_metric_series(self, metric, labels):
+        """Remove the series for labels from a metric."""
+        metric.remove(*(labels[label] for label in metric._labelnames))
+
+    def _update_metric(self, process, metric_name, metric, value):
         """Update the value for a metrics."""
         if value is None:
-            self.logger.warning(
-                'empty value for metric "{}" on PID {}'.format(
-                    metric_name, process.pid))
+            self._warn_empty_value(process, metric_name)
             return
+        self._set_metric_value(metric, value)
 
-        labels = self._labels.copy()
-        labels.update(labeler(process))
-        metric = metric.labels(**labels)
+    def _set_metric_value(self, metric, value):
+        """Increment a counter or set a gauge to a value."""
         if metric._type == 'counter':
             metric.inc(value)
         elif metric._type == 'gauge':
             metric.set(value)
 
+    def _warn_empty_value(self, process, metric_name):
+        """Log a warning for a metric without value."""
+        self.logger.warning(
+            'empty value for metric "{}" on PID {}'.format(
+                metric_name, process.pid))
+
     def _get_label_names(self):
         """Return a set of label names."""
         labels = set(self._labels)
@@ -67,4 +808,6 @@ class ProcessMetricsHandler:
             labels.update(CmdlineLabeler(regexp).labels())
         if self._pids:
             labels.update(PidLabeler().labels())
+        if self._cgroups:
+            labels.update(CgroupLabeler(None).labels())
         return labels
@@ -1,39 +1,456 @@
 """Helpers to collect processes."""
 
-from itertools import chain
+from collections import (
+    defaultdict,
+    deque,
+    namedtuple)
+import os
+from pathlib import Path
 
-from lxstats.process import (
-    Collection,
-    Collector,
-    CommandLineFilter)
+from lxstats.process import Process
 
+from .cgroup import (
+    CGROUP_ROOT,
+    get_cgroup_name,
+    get_cgroup_path,
+    get_cgroup_pids)
 from .label import (
-    PidLabeler,
-    CmdlineLabeler)
+    CachedLabeler,
+    CgroupLabeler,
+    CmdlineLabeler,
+    PidLabeler)
+from .procfs import (
+    STAT_FIELDS,
+    parse_stat_field,
+    read_file,
+    split_stat)
 
 
-def get_process_iterator(proc='/proc', pids=None, cmdline_regexps=None):
+_PPID_INDEX = STAT_FIELDS.index('ppid')
+_START_TIME_INDEX = STAT_FIELDS.index('starttime')
+
+
+ProcessCacheEntry = namedtuple(
+    'ProcessCacheEntry', ['start_time', 'cmd', 'process', 'labelers'])
+
+
+class ProcessCache:
+    """Cache command line matches for processes.
+
+    Entries are keyed on the process PID and hold the process start time, so
+    that a PID reused by a different process is detected.
+
+    Each entry holds the process command line, the :class:`Process` and a
+    list of :class:`CachedLabeler` for regexps matching the command line.
+    Entries are kept also for processes not matching any regexp, so that
+    their command line doesn't need to be read again.
+
+    Note that a change of command line within the same process (e.g. from
+    an ``exec`` call without a ``fork``) is not detected.
+
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, pid, start_time):
+        """Return the entry for a process, or None if not found.
+
+        If a different process is cached for the PID, it's evicted.
+
+        """
+        entry = self._entries.get(pid)
+        if entry is None:
+            return None
+        if entry.start_time != start_time:
+            del self._entries[pid]
+            return None
+        return entry
+
+    def add(self, pid, entry):
+        """Add an entry for a process."""
+        self._entries[pid] = entry
+
+    def prune(self, pids):
+        """Evict entries for processes not in the specified PIDs."""
+        for pid in set(self._entries).difference(pids):
+            del self._entries[pid]
+
+    def update_regexps(self, removed, added):
+        """Update entries for changed command line regexps.
+
+        Labelers for regexps whose pattern is in ``removed`` are dropped from
+        entries.  Entries with a command line matching any of the ``added``
+        regexps are evicted, so that they're matched again.  Other entries
+        are kept as they are.
+
+        """
+        removed = set(removed)
+        for pid, entry in list(self._entries.items()):
+            if any(regexp.search(entry.cmd) for regexp in added):
+                del self._entries[pid]
+                continue
+            labelers = [
+                labeler for labeler in entry.labelers
+                if labeler.labeler.pattern not in removed]
+            if len(labelers) != len(entry.labelers):
+                self._entries[pid] = entry._replace(labelers=labelers)
+
+
+def get_process_iterator(proc='/proc', pids=None, cmdline_regexps=None,
+                         cache=None, counts=None, include_children=False,
+                         cgroups=None, cgroup_root=CGROUP_ROOT,
+                         file_cache=None):
     """Return an iterator yielding tuples with (Labeler, Process).
 
     :param str proc: the path to the ``/proc`` directory.
     :param list pids: a list of PIDs of process to return. If this is
         specified, other filters are ignored.
+    :param list cgroups: a list of paths of cgroups to return processes
+        in, absolute or relative to ``cgroup_root``. If this is specified,
+        command line regexps are ignored.
     :param list cmdline_regexps: a list of strings with regexps to filter
         process command line.
+    :param ProcessCache cache: an optional cache for processes command line
+        matches. It's updated during iteration.
+    :param Tally counts: an optional tally, to add the number of scanned
+        processes to.
+    :param bool include_children: whether to also return descendants of
+        processes matching command line regexps, with the same labels.
+    :param str cgroup_root: the path to the cgroup filesystem root.
+    :param FileCache file_cache: an optional cache to keep ``stat`` files
+        read while scanning ``/proc`` open across iterations.
 
     """
     if pids:
-        labeler = PidLabeler()
-        collection = Collection(collector=Collector(proc=proc, pids=pids))
-        return ((labeler, process) for process in collection)
+        return _pid_processes(Path(proc), pids, counts)
+    elif cgroups:
+        return _cgroup_processes(Path(proc), cgroups, cgroup_root, counts)
     elif cmdline_regexps:
-        collectors = []
-        for cmdline_re in cmdline_regexps:
-            collection = Collection(collector=Collector(proc=proc))
-            collection.add_filter(
-                CommandLineFilter(cmdline_re, include_args=True))
-            labeler = CmdlineLabeler(cmdline_re)
-            collectors.append((labeler, process) for process in collection)
-        return chain(*collectors)
+        labelers = [CmdlineLabeler(regexp) for regexp in cmdline_regexps]
+        if include_children:
+            return _match_process_tree(
+                Path(proc), labelers, cache, counts, file_cache=file_cache)
+        if cache is None:
+            return _match_processes(Path(proc), labelers, counts)
+        return _match_cached_processes(
+            Path(proc), labelers, cache, counts, file_cache=file_cache)
     else:
         return iter(())
+
+
+def _pid_processes(proc, pids, counts=None):
+    """Yield (Labeler, Process) tuples for processes with the specified PIDs.
+
+    Processes are returned without collecting their stats, which are read
+    by stats collectors.  PIDs with no directory in ``/proc`` are skipped.
+
+    """
+    if counts is not None:
+        counts.add(processes_scanned=len(pids))
+    labeler = PidLabeler()
+    for pid in sorted(int(pid) for pid in pids):
+        proc_dir = proc / str(pid)
+        if proc_dir.is_dir():
+            yield labeler, Process(pid, proc_dir)
+
+
+def _cgroup_processes(proc, cgroups, cgroup_root, counts=None):
+    """Yield (Labeler, Process) tuples for processes in cgroups.
+
+    PIDs are read from the ``cgroup.procs`` files of each cgroup and its
+    descendants, without scanning ``/proc``.  A process is yielded once for
+    each cgroup it's found in.
+
+    """
+    for cgroup in cgroups:
+        labeler = CgroupLabeler(get_cgroup_name(cgroup, root=cgroup_root))
+        pids = get_cgroup_pids(get_cgroup_path(cgroup, root=cgroup_root))
+        if counts is not None:
+            counts.add(processes_scanned=len(pids))
+        for pid in pids:
+            yield labeler, Process(pid, proc / str(pid))
+
+
+def _match_processes(proc, labelers, counts=None):
+    """Yield (Labeler, Process) tuples for processes matching labelers.
+
+    The ``/proc`` directory is scanned once, and the command line for each
+    process is read once and tested against all labelers. A process is
+    yielded once for each labeler it matches.
+
+    """
+    pids = get_pids(proc)
+    if counts is not None:
+        counts.add(processes_scanned=len(pids))
+    for pid in pids:
+        proc_dir = proc / str(pid)
+        cmd = read_cmd(proc_dir, counts=counts)
+        if cmd is None:
+            continue
+        matches = _match_labelers(labelers, cmd)
+        if not matches:
+            continue
+
+        cached_labelers = _label_matches(matches, proc_dir, counts=counts)
+        if cached_labelers is None:
+            continue
+        process = Process(pid, proc_dir)
+        for labeler in cached_labelers:
+            yield labeler, process
+
+
+def _match_cached_processes(proc, labelers, cache, counts=None,
+                            file_cache=None):
+    """Yield (Labeler, Process) tuples for processes matching labelers.
+
+    Only the start time is read for processes already in the cache.
+    Once all processes are scanned, entries for processes that don't exist
+    anymore are removed from the cache.
+
+    The ``stat`` file is read for every process in each scan.  If a
+    :class:`FileCache` is passed, it's kept open, so that a scan costs a
+    single ``pread`` for each process, otherwise it's also opened and closed.
+
+    """
+    pids = get_pids(proc)
+    if counts is not None:
+        counts.add(processes_scanned=len(pids))
+    for pid in pids:
+        proc_dir = proc / str(pid)
+        start_time = read_start_time(
+            proc_dir, counts=counts, file_cache=file_cache)
+        if start_time is None:
+            continue
+        entry = cache.get(pid, start_time)
+        if entry is None:
+            entry = _make_cache_entry(
+                pid, proc_dir, start_time, labelers, counts=counts)
+            if entry is None:
+                continue
+            cache.add(pid, entry)
+        for labeler in entry.labelers:
+            yield labeler, entry.process
+
+    cache.prune(pids)
+
+
+def _match_process_tree(proc, labelers, cache=None, counts=None,
+                        file_cache=None):
+    """Yield (Labeler, Process) tuples for processes matching labelers and
+    their descendants.
+
+    While scanning ``/proc``, an index of children for each process is
+    built, so that descendants are found without scanning again.  As in
+    :func:`_match_cached_processes`, ``stat`` files are kept open if a
+    :class:`FileCache` is passed.
+
+    Descendants are yielded with a labeler returning the labels of the
+    matching ancestor.  Descendants that match a labeler themselves are only
+    yielded with their own labels, along with their descendants, so that
+    each process is reported once for each matching ancestor regexp.
+
+    """
+    pids = get_pids(proc)
+    if counts is not None:
+        counts.add(processes_scanned=len(pids))
+    children = defaultdict(list)
+    entries = []
+    for pid in pids:
+        proc_dir = proc / str(pid)
+        stat = read_ppid_and_start_time(
+            proc_dir, counts=counts, file_cache=file_cache)
+        if stat is None:
+            continue
+        ppid, start_time = stat
+        children[ppid].append(pid)
+        entry = None if cache is None else cache.get(pid, start_time)
+        if entry is None:
+            entry = _make_cache_entry(
+                pid, proc_dir, start_time, labelers, counts=counts)
+            if entry is None:
+                continue
+            if cache is not None:
+                cache.add(pid, entry)
+        if entry.labelers:
+            entries.append(entry)
+    if cache is not None:
+        cache.prune(pids)
+
+    # PIDs of processes matching any labeler.  Cached entries hold labelers
+    # from previous iterations, so these can't be keyed on labelers
+    matched_pids = {entry.process.pid for entry in entries}
+
+    descendants = {}
+    for entry in entries:
+        for labeler in entry.labelers:
+            yield labeler, entry.process
+            for pid in _get_descendants(
+                    children, entry.process.pid, matched_pids):
+                process = descendants.get(pid)
+                if process is None:
+                    process = descendants[pid] = Process(pid, proc / str(pid))
+                yield labeler, process
+
+
+def _get_descendants(children, pid, skip_pids):
+    """Return an iterator of PIDs of descendants of a process.
+
+    Processes in ``skip_pids`` and their descendants are not included.
+
+    """
+    queue = deque(children.get(pid, ()))
+    while queue:
+        pid = queue.popleft()
+        if pid in skip_pids:
+            continue
+        yield pid
+        queue.extend(children.get(pid, ()))
+
+
+def _make_cache_entry(pid, proc_dir, start_time, labelers, counts=None):
+    """Return a ProcessCacheEntry for a process, or None if not found."""
+    cmd = read_cmd(proc_dir, counts=counts)
+    if cmd is None:
+        return None
+    matches = _match_labelers(labelers, cmd)
+    if not matches:
+        return ProcessCacheEntry(start_time, cmd, None, [])
+
+    cached_labelers = _label_matches(matches, proc_dir, counts=counts)
+    if cached_labelers is None:
+        return None
+    return ProcessCacheEntry(
+        start_time, cmd, Process(pid, proc_dir), cached_labelers)
+
+
+def _match_labelers(labelers, cmd):
+    """Return a list of (CmdlineLabeler, match) for labelers matching cmd."""
+    matches = [(labeler, labeler.match(cmd)) for labeler in labelers]
+    return [(labeler, match) for labeler, match in matches if match]
+
+
+def _label_matches(matches, proc_dir, counts=None):
+    """Return a list of CachedLabelers with labels from regexp matches.
+
+    Labels are computed from the command line that was matched, rather than
+    from the one read again for the process.  The command name is only read
+    if a regexp without groups matched.
+
+    If the process doesn't exist anymore, None is returned.
+
+    """
+    comm = None
+    if any(not match.re.groups for _, match in matches):
+        comm = read_comm(proc_dir, counts=counts)
+        if comm is None:
+            return None
+    return [
+        CachedLabeler(labeler, labeler.match_labels(match, comm))
+        for labeler, match in matches]
+
+
+def get_pids(proc):
+    """Return a sorted list of PIDs from the ``/proc`` directory."""
+    return sorted(
+        int(name) for name in os.listdir(str(proc)) if name.isdigit())
+
+
+def read_cmd(proc_dir, counts=None):
+    """Return the command line for the process at the specified directory.
+
+    The format is the same as :attr:`lxstats.process.Process.cmd`, with
+    arguments separated by spaces and the command name between brackets for
+    kernel tasks.
+
+    If the process doesn't exist anymore, None is returned.
+
+    Files and bytes read, and read errors, are added to the ``counts``
+    tally, if passed.
+
+    """
+    try:
+        content = _read_file(
+            proc_dir / 'cmdline', counts, read=Path.read_bytes)
+        content = content.decode('utf-8', errors='replace')
+        content = content.split('\n')[0].strip('\x00')
+        if not content:
+            comm = _read_file(proc_dir / 'comm', counts)
+    except OSError:
+        return None
+
+    if content:
+        return content.replace('\x00', ' ')
+    comm = comm.decode('utf-8', errors='replace').strip()
+    return '[{}]'.format(comm) if comm else ''
+
+
+def read_comm(proc_dir, counts=None):
+    """Return the command name for the process at the specified directory.
+
+    If the process doesn't exist anymore, None is returned.  Reads are
+    counted as in :func:`read_cmd`.
+
+    """
+    try:
+        content = _read_file(proc_dir / 'comm', counts)
+    except OSError:
+        return None
+    return content.decode('utf-8', errors='replace').strip()
+
+
+def read_ppid_and_start_time(proc_dir, counts=None, file_cache=None):
+    """Return a tuple with parent PID and start time for a process.
+
+    If the process doesn't exist anymore, None is returned.  Reads are
+    counted as in :func:`read_cmd`.  If a :class:`FileCache` is passed, the
+    file is read through it.
+
+    """
+    try:
+        content = _read_stat(proc_dir, counts, file_cache)
+    except OSError:
+        return None
+    fields = split_stat(content)
+    return (
+        parse_stat_field(fields, _PPID_INDEX),
+        parse_stat_field(fields, _START_TIME_INDEX))
+
+
+def read_start_time(proc_dir, counts=None, file_cache=None):
+    """Return the start time for the process at the specified directory.
+
+    This is the 22nd field in the ``stat`` file, in clock ticks since boot.
+
+    If the process doesn't exist anymore, None is returned.  Reads are
+    counted as in :func:`read_cmd`.  If a :class:`FileCache` is passed, the
+    file is read through it.
+
+    """
+    try:
+        content = _read_stat(proc_dir, counts, file_cache)
+    except OSError:
+        return None
+    return parse_stat_field(split_stat(content), _START_TIME_INDEX)
+
+
+def _read_stat(proc_dir, counts=None, file_cache=None):
+    """Return the content of the stat file for a process."""
+    read = read_file if file_cache is None else file_cache.read
+    return _read_file(proc_dir / 'stat', counts, read=read)
+
+
+def _read_file(path, counts=None, read=read_file):
+    """Return the content of a file, counting reads in the tally if passed."""
+    try:
+        content = read(path)
+    except OSError:
+        if counts is not None:
+            counts.add(read_errors=1)
+        raise
+    if counts is not None:
+        counts.add(files_read=1, bytes_read=len(content))
+    return content
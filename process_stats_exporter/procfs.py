@@ -0,0 +1,329 @@
+"""Lean readers for process files under ``/proc``.
+
+These read only the files needed for the requested stats, with a single
+``read`` call, and extract values by position or key without parsing the
+whole content.
+
+Stats are named as ``<file>.<field>`` (e.g. ``stat.utime`` or
+``status.VmHWM``), like for :meth:`lxstats.process.Process.get`.
+
+"""
+
+from collections import (
+    OrderedDict,
+    defaultdict)
+import os
+import threading
+
+
+# Fields in the stat file, in order
+STAT_FIELDS = (
+    'pid', 'comm', 'state', 'ppid', 'pgrp', 'session', 'tty_nr', 'tpgid',
+    'flags', 'minflt', 'cminflt', 'majflt', 'cmajflt', 'utime', 'stime',
+    'cutime', 'cstime', 'priority', 'nice', 'num_threads', 'itrealvalue',
+    'starttime', 'vsize', 'rss', 'rsslim', 'startcode', 'endcode',
+    'startstack', 'kstkesp', 'kstkeip', 'signal', 'blocked', 'sigignore',
+    'sigcatch', 'wchan', 'nswap', 'cnswap', 'exit_signal', 'processor',
+    'rt_priority', 'policy', 'delayacct_blkio_ticks', 'guest_time',
+    'cguest_time')
+
+# Files with "key: value" lines
+KEY_VALUE_FILES = frozenset(['status', 'sched', 'io'])
+
+# Maximum size of a file content, read in a single call
+READ_SIZE = 16384
+
+# Size of the stat file prefix that includes the state. The command name is
+# at most 15 characters long and PIDs have at most 7 digits.
+STATE_READ_SIZE = 64
+
+
+def process_dir(process):
+    """Return the path for the process ``/proc`` directory."""
+    # lxstats doesn't expose the path of the process directory
+    return process._dir.join()
+
+
+def process_file(process, name):
+    """Return the path for a file in the process ``/proc`` directory."""
+    # lxstats doesn't expose the path of the process directory
+    return process._dir.join(name)
+
+
+def read_file(path, size=READ_SIZE):
+    """Return the content of a file as bytes, read with a single call."""
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
+
+class FileCache:
+    """Keep files open, to read them again without reopening them.
+
+    Files are read again from the start with ``pread``.  If reading fails
+    (e.g. with ``ESRCH`` when the process has exited), the file is closed,
+    and reopened once if it was kept open from a previous read.
+
+    Collection happens in cycles (e.g. one per scrape).  At most
+    ``max_files`` files are kept open: when the limit is reached, the least
+    recently used file which hasn't been read in the current cycle is closed.
+    If all open files have been read in the current cycle, files are read
+    without caching them.  Files not read in a full cycle are closed.
+
+    Reads for the same file must not happen concurrently.
+
+    """
+
+    def __init__(self, max_files):
+        self._max_files = max_files
+        self._files = OrderedDict()  # map paths to [fd, last cycle]
+        self._cycle = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def new_cycle(self):
+        """Start a new collection cycle.
+
+        Files not read in the previous cycle are closed.
+
+        """
+        with self._lock:
+            for path, (fd, cycle) in list(self._files.items()):
+                if cycle < self._cycle:
+                    del self._files[path]
+                    os.close(fd)
+            self._cycle += 1
+
+    def read(self, path, size=READ_SIZE):
+        """Return the content of a file as bytes, read with a single call.
+
+        If reading from a file opened in a previous call fails (e.g. with
+        ``ESRCH`` when the process has exited and its PID was reused), the
+        file is reopened and read again once.
+
+        """
+        # pread allocates a buffer for each call, but the allocation is
+        # reused by malloc and is cheaper than preadv into a preallocated
+        # buffer, which needs a memoryview and a copy of the content.
+        path = str(path)
+        fd, reused = self._get_fd(path)
+        if fd is None:
+            return read_file(path, size=size)
+        try:
+            return os.pread(fd, size, 0)
+        except OSError:
+            self._discard(path)
+            if not reused:
+                raise
+        fd, _ = self._get_fd(path)
+        if fd is None:
+            return read_file(path, size=size)
+        try:
+            return os.pread(fd, size, 0)
+        except OSError:
+            self._discard(path)
+            raise
+
+    def close(self):
+        """Close all files."""
+        with self._lock:
+            for fd, _ in self._files.values():
+                os.close(fd)
+            self._files.clear()
+
+    def _get_fd(self, path):
+        """Return a tuple with an open file descriptor for the path.
+
+        The second element tells whether the file was already open.  The
+        file descriptor is None if the file can't be cached.
+
+        """
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None:
+                entry[1] = self._cycle
+                self._files.move_to_end(path)
+                return entry[0], True
+            if len(self._files) >= self._max_files and not self._evict():
+                return None, False
+
+        fd = os.open(path, os.O_RDONLY)
+        with self._lock:
+            self._files[path] = [fd, self._cycle]
+        return fd, False
+
+    def _evict(self):
+        """Close the least recently used file, if not read in this cycle.
+
+        Return whether a file was closed.
+
+        """
+        path, (fd, cycle) = next(iter(self._files.items()))
+        if cycle == self._cycle:
+            return False
+        del self._files[path]
+        os.close(fd)
+        return True
+
+    def _discard(self, path):
+        """Close a file and remove it from the cache."""
+        with self._lock:
+            entry = self._files.pop(path, None)
+        if entry is not None:
+            os.close(entry[0])
+
+
+def split_stat(content):
+    """Split the content of a stat file in fields.
+
+    The command name can contain spaces and parenthesis, so fields after the
+    name are split after the last closing parenthesis.
+
+    """
+    comm_end = content.rfind(b')')
+    if comm_end == -1:
+        return content.split()
+    head, comm = content[:comm_end].split(b'(', 1)
+    return head.split() + [comm] + content[comm_end + 1:].split()
+
+
+def parse_stat_field(fields, index):
+    """Return the value of a field from a split stat file."""
+    try:
+        value = fields[index]
+    except IndexError:
+        return None
+    if index in (1, 2):  # comm and state
+        return value.decode('utf-8', errors='replace')
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_state(content):
+    """Return the state from the beginning of a stat file content."""
+    comm_end = content.rfind(b')')
+    if comm_end == -1:
+        fields = content.split()
+        return fields[2] if len(fields) > 2 else None
+    return content[comm_end + 2:comm_end + 3] or None
+
+
+def find_key_value(content, key):
+    """Return the value for a key in a file with "key: value" lines.
+
+    The value is returned as stripped bytes, or None if the key is not found.
+
+    """
+    start = 0
+    while True:
+        pos = content.find(key, start)
+        if pos == -1:
+            return None
+        start = pos + len(key)
+        if pos != 0 and content[pos - 1] != ord('\n'):
+            continue
+        separator = content.find(b':', start)
+        line_end = content.find(b'\n', start)
+        if line_end == -1:
+            line_end = len(content)
+        if separator == -1 or separator > line_end:
+            continue
+        if content[start:separator].strip():
+            # only a prefix of another key
+            continue
+        return content[separator + 1:line_end].strip()
+
+
+def parse_value(value):
+    """Convert a value from a "key: value" file.
+
+    Sizes in kB are converted to bytes. None is returned for non-numeric
+    values.
+
+    """
+    if value is None:
+        return None
+    try:
+        if value.endswith(b' kB'):
+            return int(value[:-3]) * 1024
+        if b'.' in value:
+            return float(value)
+        return int(value)
+    except ValueError:
+        return None
+
+
+class ProcStatsReader:
+    """Read a set of stats for processes.
+
+    :param stats: an iterable of stat names in the ``<file>.<field>`` form.
+    :param FileCache file_cache: an optional cache to keep files open.
+    :param Tally counts: an optional tally for counts of files and bytes read,
+        and of read errors.
+
+    """
+
+    def __init__(self, stats, file_cache=None, counts=None):
+        self._read_file = read_file if file_cache is None else file_cache.read
+        self._counts = counts
+        self._files = defaultdict(list)
+        for stat in stats:
+            filename, field = stat.split('.', 1)
+            if filename == 'stat':
+                self._files[filename].append((stat, STAT_FIELDS.index(field)))
+            elif filename in KEY_VALUE_FILES:
+                self._files[filename].append((stat, field.encode('ascii')))
+            else:
+                raise ValueError('Unsupported stat: {}'.format(stat))
+
+    def files(self):
+        """Return a sorted list of names of files read for stats."""
+        return sorted(self._files)
+
+    def read(self, process):
+        """Return a dict mapping stat names to values for the process.
+
+        Values are None for stats that are not available.  Stats from files
+        that can't be read because of missing permissions (e.g. ``io`` for
+        processes of other users) are not included.
+
+        """
+        stats = {}
+        files_read = bytes_read = read_errors = 0
+        for filename, fields in self._files.items():
+            try:
+                content = self._read_file(process_file(process, filename))
+            except PermissionError:
+                read_errors += 1
+                continue
+            except OSError:
+                content = None
+                read_errors += 1
+            else:
+                files_read += 1
+                bytes_read += len(content)
+            stats.update(self._parse(filename, content, fields))
+        if self._counts is not None:
+            self._counts.add(
+                files_read=files_read, bytes_read=bytes_read,
+                read_errors=read_errors)
+        return stats
+
+    def _parse(self, filename, content, fields):
+        """Return tuples with (stat, value) for fields in a file content."""
+        if content is None:
+            return ((stat, None) for stat, _ in fields)
+        if filename == 'stat':
+            split = split_stat(content)
+            return (
+                (stat, parse_stat_field(split, index))
+                for stat, index in fields)
+        return (
+            (stat, parse_value(find_key_value(content, key)))
+            for stat, key in fields)
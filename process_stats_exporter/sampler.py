@@ -0,0 +1,91 @@
+"""Update metrics in background at a fixed interval."""
+
+import asyncio
+import time
+
+from prometheus_aioexporter.metric import MetricConfig
+
+
+class MetricsSampler:
+    """Periodically update metrics in background.
+
+    Metrics are updated by calling the update handler at a fixed interval, so
+    that serving requests doesn't require collecting stats.
+
+    :param logger: the logger to report errors to.
+    :param callable update_handler: a callable to update metrics, accepting a
+        dict mapping metric names to metrics.
+    :param float interval: the sampling interval in seconds.
+    :param callable on_sample: an optional callable to call with no
+        arguments after each successful sample.
+
+    """
+
+    _time = time.time  # For testing
+
+    _TIMESTAMP_METRIC = 'proc_exporter_last_sample_timestamp'
+
+    def __init__(self, logger, update_handler, interval, on_sample=None):
+        self.logger = logger
+        self._update_handler = update_handler
+        self._interval = interval
+        self._on_sample = on_sample
+        self._metrics = {}
+        self._task = None
+
+    def metrics(self):
+        """Return a list of MetricConfigs."""
+        return [
+            MetricConfig(
+                self._TIMESTAMP_METRIC,
+                'Timestamp of the last metrics sample', 'gauge', {})]
+
+    def start(self, metrics):
+        """Start sampling in background.
+
+        :param dict metrics: a dict mapping names to metrics, to pass to the
+            update handler.
+
+        """
+        self._metrics = metrics
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop sampling."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def sample(self):
+        """Update metrics."""
+        try:
+            self._update_handler(self._metrics)
+        except Exception:
+            self.logger.exception('failed updating metrics')
+            return
+
+        timestamp_metric = self._metrics.get(self._TIMESTAMP_METRIC)
+        if timestamp_metric is not None:
+            timestamp_metric.set(self._time())
+        if self._on_sample is not None:
+            self._on_sample()
+
+    async def _run(self):
+        """Sample metrics at a fixed rate."""
+        loop = asyncio.get_event_loop()
+        next_time = loop.time()
+        while True:
+            # run in a separate thread to keep the loop responsive
+            await loop.run_in_executor(None, self.sample)
+            next_time += self._interval
+            now = loop.time()
+            if next_time < now:
+                # skip samples if updating took longer than the interval
+                skipped = (now - next_time) // self._interval + 1
+                next_time += skipped * self._interval
+            await asyncio.sleep(next_time - now)
@@ -1,11 +1,28 @@
 """Collect metrics for processes and tasks"""
 
 from collections import (
+    OrderedDict,
     namedtuple,
     defaultdict)
+from itertools import chain
+import os
+import random
+import threading
+import time
 
 from prometheus_aioexporter.metric import MetricConfig
 
+from .procfs import (
+    STATE_READ_SIZE,
+    ProcStatsReader,
+    find_key_value,
+    parse_state,
+    parse_value,
+    process_file,
+    read_file)
+from .counters import CounterRates
+from .taskstats import TaskstatsConnection
+
 
 ProcessStat = namedtuple(
     'ProcessStat', ['metric', 'type', 'description', 'stat'])
@@ -13,9 +30,178 @@ ProcessStat = namedtuple(
 ProcessTasksStat = namedtuple(
     'ProcessTaskStat', ['metric', 'type', 'description'])
 
+ProcessMemoryStat = namedtuple(
+    'ProcessMemoryStat', ['metric', 'type', 'description'])
+
+ProcessRate = namedtuple(
+    'ProcessRate', ['metric', 'description', 'stats', 'scale'])
+
+# Cost tiers for collectors
+CHEAP = 'cheap'
+EXPENSIVE = 'expensive'
+
+# Clock ticks per second, for CPU times in the stat file
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class ProcBackend:
+    """Read process stats from files under ``/proc``.
+
+    Stats are named as ``<file>.<field>`` (e.g. ``stat.utime``).
+
+    """
+
+    name = 'proc'
+
+    def make_reader(self, stats, file_cache=None, counts=None):
+        """Return a reader for stats, with a ``read(process)`` method."""
+        return ProcStatsReader(stats, file_cache=file_cache, counts=counts)
+
+    def new_cycle(self):
+        """Start a new collection cycle."""
+
+    def prefetch(self, processes):
+        """Prepare for reading stats for processes in the current cycle."""
+
+    def check(self):
+        """Raise an :class:`OSError` if stats can't be read."""
+
+    def reopen(self):
+        """Reopen resources in a forked process."""
+
+    def close(self):
+        """Release resources used by the backend."""
+
+
+class TaskstatsBackend(ProcBackend):
+    """Read process stats from the taskstats netlink interface.
+
+    Stats for the main thread of processes are requested at most once per
+    collection cycle, in batches for all processes when they're prefetched.
+    CPU times, faults, context switches and I/O are read from the reply,
+    which avoids reading and parsing the ``status``, ``sched`` and ``io``
+    files, and only the ``stat`` file is still read for the current RSS and
+    the start time, which taskstats don't report.
+
+    Since replies are for the main thread, CPU times, faults and I/O don't
+    include other threads, unlike the ones from ``/proc``.  I/O character
+    and syscall counts are rounded down to multiples of 1024.
+
+    """
+
+    name = 'taskstats'
+
+    # map stat names to taskstats fields
+    _FIELDS = {
+        'stat.utime': 'ac_utime',
+        'stat.stime': 'ac_stime',
+        'stat.minflt': 'ac_minflt',
+        'stat.majflt': 'ac_majflt',
+        'status.VmHWM': 'hiwater_rss',
+        'sched.nr_voluntary_switches': 'nvcsw',
+        'sched.nr_involuntary_switches': 'nivcsw',
+        'io.rchar': 'read_char',
+        'io.wchar': 'write_char',
+        'io.syscr': 'read_syscalls',
+        'io.syscw': 'write_syscalls',
+        'io.read_bytes': 'read_bytes',
+        'io.write_bytes': 'write_bytes'}
+
+    # map taskstats fields to functions converting them to /proc units
+    _CONVERSIONS = {
+        'ac_utime': lambda usec: usec * CLOCK_TICKS // 1000000,
+        'ac_stime': lambda usec: usec * CLOCK_TICKS // 1000000,
+        'hiwater_rss': lambda kb: kb * 1024}
+
+    def __init__(self, connection=None):
+        if connection is None:
+            connection = TaskstatsConnection()
+        self._connection = connection
+        # map PIDs to stats for the current cycle
+        self._stats = {}
+
+    def make_reader(self, stats, file_cache=None, counts=None):
+        stats = list(stats)
+        proc_reader = super().make_reader(
+            [stat for stat in stats if stat not in self._FIELDS],
+            file_cache=file_cache, counts=counts)
+        return _TaskstatsReader(
+            self, [stat for stat in stats if stat in self._FIELDS],
+            proc_reader)
+
+    def new_cycle(self):
+        self._stats = {}
+
+    def prefetch(self, processes):
+        self._fetch([process.pid for process in processes])
+
+    def check(self):
+        # requests fail without the CAP_NET_ADMIN capability
+        self._connection.get([os.getpid()])
+
+    def reopen(self):
+        # the netlink socket is bound to the address of the parent process
+        self._connection.close()
+        self._connection = TaskstatsConnection()
+        self._stats = {}
+
+    def close(self):
+        self._connection.close()
+
+    def read(self, process):
+        """Return a dict mapping stat names to values for a process."""
+        if process.pid not in self._stats:
+            self._fetch([process.pid])
+        return self._stats[process.pid]
+
+    def _fetch(self, pids):
+        """Request stats for PIDs, for the current cycle."""
+        all_taskstats = self._connection.get(pids)
+        for pid in pids:
+            taskstats = all_taskstats.get(pid)
+            stats = {}
+            for stat, field in self._FIELDS.items():
+                value = None if taskstats is None else taskstats[field]
+                convert = self._CONVERSIONS.get(field)
+                if value is not None and convert is not None:
+                    value = convert(value)
+                stats[stat] = value
+            self._stats[pid] = stats
+
+
+class _TaskstatsReader:
+    """Read stats from taskstats, and other ones from ``/proc``."""
+
+    def __init__(self, backend, stats, proc_reader):
+        self._backend = backend
+        self._stats = stats
+        self._proc_reader = proc_reader
+
+    def read(self, process):
+        values = self._proc_reader.read(process)
+        if self._stats:
+            taskstats = self._backend.read(process)
+            values.update((stat, taskstats[stat]) for stat in self._stats)
+        return values
+
 
 class StatsCollector:
-    """Describe and collect metrics."""
+    """Describe and collect metrics.
+
+    Collectors declare a cost tier, so that values from expensive ones can
+    be refreshed less frequently.  They can also declare a maximum duty
+    cycle, so that values for processes where collecting is slow are
+    refreshed less often, keeping the time spent collecting below that
+    fraction, up to a maximum delay.
+
+    """
+
+    name = None
+    cost = CHEAP
+    # fraction of time that can be spent collecting values for a process
+    max_duty = None
+    # maximum delay in seconds between refreshes, when backing off
+    max_backoff = None
 
     def __init__(self, labels=()):
         self.labels = list(labels)
@@ -28,9 +214,32 @@ class StatsCollector:
         """Return a dict mapping metric names to values for the process."""
         raise NotImplementedError('Subclasses must implement collect()')
 
+    def prune(self, pids):
+        """Discard state kept for processes not in the specified PIDs."""
+
 
 class ProcessStatsCollector(StatsCollector):
-    """Collect metrics for a process."""
+    """Collect metrics for a process.
+
+    Only files needed for stats in :attr:`_STATS` are read.  If a
+    :class:`FileCache` is passed, files are kept open across collections.
+
+    Stats are read through a backend, by default from files under ``/proc``.
+
+    If a :class:`Tally` is passed, counts of files and bytes read and of read
+    errors are added to it.
+
+    If rates are enabled, per-second rates in :attr:`_RATES` are also
+    reported, computed from stats read in consecutive collections for each
+    process with a monotonic clock.  Rates are summed over their stats, and
+    scaled (e.g. to convert clock ticks to seconds).  They're not reported
+    for the first collection of a process.
+
+    """
+
+    name = 'stats'
+
+    _clock = time.monotonic  # For testing
 
     _STATS = (
         ProcessStat(
@@ -51,7 +260,108 @@ class ProcessStatsCollector(StatsCollector):
         ProcessStat(
             'proc_min_fault', 'counter',
             'Number of minor faults that did not require a page load',
-            'stat.minflt'),
+            'stat.minflt'))
+
+    # Stats collected for internal use and not exported, with the start time
+    # telling processes with the same PID apart
+    _INTERNAL_STATS = (
+        ProcessStat(
+            'proc_start_time', 'gauge',
+            'Time the process started after system boot', 'stat.starttime'),)
+
+    _RATES = (
+        ProcessRate(
+            'proc_cpu_utilisation_ratio',
+            'CPU time used per second, in cores',
+            ('stat.utime', 'stat.stime'), 1 / CLOCK_TICKS),
+        ProcessRate(
+            'proc_cpu_utilisation_normalised_ratio',
+            'CPU time used per second, as a fraction of all CPUs',
+            ('stat.utime', 'stat.stime'),
+            1 / (CLOCK_TICKS * (os.cpu_count() or 1))),
+        ProcessRate(
+            'proc_maj_fault_rate', 'Major faults per second',
+            ('stat.majflt',), 1),
+        ProcessRate(
+            'proc_min_fault_rate', 'Minor faults per second',
+            ('stat.minflt',), 1))
+
+    def __init__(self, labels=(), file_cache=None, counts=None,
+                 backend=None, rates=False):
+        super().__init__(labels=labels)
+        if backend is None:
+            backend = ProcBackend()
+        stats = [stat.stat for stat in self._STATS + self._INTERNAL_STATS]
+        self._rates = None
+        if rates and self._RATES:
+            rate_stats = sorted(
+                set(chain(*(rate.stats for rate in self._RATES))))
+            self._rates = CounterRates(rate_stats)
+            self._rates_lock = threading.Lock()
+            # the start time identifies processes with the same PID
+            stats.extend(
+                stat for stat in rate_stats + ['stat.starttime']
+                if stat not in stats)
+        self._reader = backend.make_reader(
+            stats, file_cache=file_cache, counts=counts)
+
+    def metrics(self):
+        metrics = [
+            MetricConfig(
+                stat.metric, stat.description, stat.type,
+                {'labels': self.labels})
+            for stat in self._STATS]
+        if self._rates is not None:
+            metrics.extend(
+                MetricConfig(
+                    rate.metric, rate.description, 'gauge',
+                    {'labels': self.labels})
+                for rate in self._RATES)
+        return metrics
+
+    def collect(self, process):
+        stats = self._reader.read(process)
+        values = {
+            stat.metric: stats[stat.stat]
+            for stat in self._STATS + self._INTERNAL_STATS
+            if stat.stat in stats}
+        if self._rates is not None:
+            values.update(self._collect_rates(process, stats))
+        return values
+
+    def prune(self, pids):
+        if self._rates is not None:
+            with self._rates_lock:
+                self._rates.prune(pids)
+
+    def _collect_rates(self, process, stats):
+        """Return a dict with rates for a process."""
+        with self._rates_lock:
+            stat_rates = self._rates.rates(
+                process.pid, stats.get('stat.starttime'), self._clock(),
+                stats)
+        values = {}
+        for rate in self._RATES:
+            rates = [stat_rates.get(stat) for stat in rate.stats]
+            if None not in rates:
+                values[rate.metric] = sum(rates) * rate.scale
+        return values
+
+
+class ProcessSchedStatsCollector(ProcessStatsCollector):
+    """Collect scheduler metrics for a process.
+
+    The ``sched`` file only reports stats for the main thread of the
+    process, so context switches of other threads are not included.  It's
+    formatted with many scheduler fields on each read, which makes it
+    expensive compared to other files.
+
+    """
+
+    name = 'sched'
+    cost = EXPENSIVE
+
+    _STATS = (
         ProcessStat(
             'proc_ctx_involuntary', 'counter',
             'Number of involuntary context switches',
@@ -61,20 +371,74 @@ class ProcessStatsCollector(StatsCollector):
             'Number of voluntary context switches',
             'sched.nr_voluntary_switches'))
 
-    def metrics(self):
-        return [
-            MetricConfig(
-                stat.metric, stat.description, stat.type,
-                {'labels': self.labels})
-            for stat in self._STATS]
+    _INTERNAL_STATS = ()
 
-    def collect(self, process):
-        process.collect_stats()
-        return {stat.metric: process.get(stat.stat) for stat in self._STATS}
+    _RATES = (
+        ProcessRate(
+            'proc_ctx_involuntary_rate',
+            'Involuntary context switches per second',
+            ('sched.nr_involuntary_switches',), 1),
+        ProcessRate(
+            'proc_ctx_voluntary_rate',
+            'Voluntary context switches per second',
+            ('sched.nr_voluntary_switches',), 1))
+
+
+class ProcessIOStatsCollector(ProcessStatsCollector):
+    """Collect I/O metrics for a process.
+
+    Stats are read from the ``io`` file, which is only readable for
+    processes of the same user, unless running as root.  Metrics for
+    processes whose file can't be read are not reported.
+
+    """
+
+    name = 'io'
+
+    _STATS = (
+        ProcessStat(
+            'proc_io_read_chars', 'counter',
+            'Number of bytes read by the process with read syscalls',
+            'io.rchar'),
+        ProcessStat(
+            'proc_io_write_chars', 'counter',
+            'Number of bytes written by the process with write syscalls',
+            'io.wchar'),
+        ProcessStat(
+            'proc_io_read_syscalls', 'counter',
+            'Number of read syscalls', 'io.syscr'),
+        ProcessStat(
+            'proc_io_write_syscalls', 'counter',
+            'Number of write syscalls', 'io.syscw'),
+        ProcessStat(
+            'proc_io_read_bytes', 'counter',
+            'Number of bytes fetched from the storage layer',
+            'io.read_bytes'),
+        ProcessStat(
+            'proc_io_write_bytes', 'counter',
+            'Number of bytes sent to the storage layer', 'io.write_bytes'))
+
+    _INTERNAL_STATS = ()
+
+    _RATES = ()
 
 
 class ProcessTasksStatsCollector(StatsCollector):
-    """Collect metrics for a process' tasks."""
+    """Collect metrics for a process' tasks.
+
+    Only the state is read for each task.  If a sample size is specified and
+    a process has more tasks, states are only read for a random sample of
+    tasks, and counts are extrapolated.
+
+    If a :class:`Tally` is passed, counts of files and bytes read and of read
+    errors are added to it.
+
+    """
+
+    name = 'tasks'
+    cost = EXPENSIVE
+
+    _sample = random.sample  # For testing
 
     _STATS = (
         ProcessTasksStat(
@@ -90,6 +454,11 @@ class ProcessTasksStatsCollector(StatsCollector):
             'Number of process tasks in uninterruptible sleep state'),
     )
 
+    def __init__(self, labels=(), sample_size=None, counts=None):
+        super().__init__(labels=labels)
+        self._sample_size = sample_size
+        self._counts = counts
+
     def metrics(self):
         return [
             MetricConfig(
@@ -98,13 +467,192 @@ class ProcessTasksStatsCollector(StatsCollector):
             for stat in self._STATS]
 
     def collect(self, process):
-        tasks = process.tasks()
+        tasks_dir = process_file(process, 'task')
+        try:
+            tids = os.listdir(str(tasks_dir))
+        except OSError:
+            if self._counts is not None:
+                self._counts.add(read_errors=1)
+            return {stat.metric: None for stat in self._STATS}
+
+        tasks_count = len(tids)
+        if self._sample_size and tasks_count > self._sample_size:
+            tids = self._sample(tids, self._sample_size)
+
         state_counts = defaultdict(int)
-        for task in tasks:
-            task.collect_stats()
-            state_counts[task.get('stat.state')] += 1
+        bytes_read = read_errors = 0
+        for tid in tids:
+            try:
+                content = read_file(
+                    os.path.join(str(tasks_dir), tid, 'stat'),
+                    size=STATE_READ_SIZE)
+            except OSError:
+                # the task is gone
+                read_errors += 1
+                continue
+            bytes_read += len(content)
+            state_counts[parse_state(content)] += 1
+        if self._counts is not None:
+            self._counts.add(
+                files_read=len(tids) - read_errors, bytes_read=bytes_read,
+                read_errors=read_errors)
+
+        if len(tids) < tasks_count:
+            scale = tasks_count / len(tids)
+            for state, count in state_counts.items():
+                state_counts[state] = round(count * scale)
+
         return {
-            'proc_tasks_count': len(tasks),
-            'proc_tasks_state_running': state_counts['R'],
-            'proc_tasks_state_sleeping': state_counts['S'],
-            'proc_tasks_state_uninterruptible_sleep': state_counts['D']}
+            'proc_tasks_count': tasks_count,
+            'proc_tasks_state_running': state_counts[b'R'],
+            'proc_tasks_state_sleeping': state_counts[b'S'],
+            'proc_tasks_state_uninterruptible_sleep': state_counts[b'D']}
+
+
+class ProcessMemoryStatsCollector(StatsCollector):
+    """Collect proportional memory metrics for a process.
+
+    Stats are read from the ``smaps_rollup`` file, or by streaming the full
+    ``smaps`` file line by line on kernels without it.
+
+    Reading these files requires walking the process page tables, which is
+    expensive for processes with large mappings, so the collector declares a
+    maximum duty cycle: stats for processes where reading is slow are
+    refreshed less often.
+
+    Kernels that don't report ``SwapPss`` are detected at startup from the
+    exporter process files, and the related metric is not exported.
+
+    """
+
+    name = 'smaps'
+    cost = EXPENSIVE
+    max_duty = 0.01
+    max_backoff = 300
+
+    _self_dir = '/proc/self'  # For testing
+
+    _STATS = (
+        ProcessMemoryStat(
+            'proc_mem_pss', 'gauge', 'Memory proportional set size (PSS)'),
+        ProcessMemoryStat(
+            'proc_mem_uss', 'gauge', 'Memory unique set size (USS)'),
+        ProcessMemoryStat(
+            'proc_mem_swap_pss', 'gauge',
+            'Swapped memory proportional set size'))
+
+    _FIELDS = (b'Pss', b'Private_Clean', b'Private_Dirty', b'SwapPss')
+
+    def __init__(self, labels=(), file_cache=None, counts=None):
+        super().__init__(labels=labels)
+        self._read_file = read_file if file_cache is None else file_cache.read
+        self._counts = counts
+        self._has_rollup = True
+        self._stats = self._STATS
+        self._fields = self._FIELDS
+        if not self._reports_swap_pss():
+            self._stats = tuple(
+                stat for stat in self._STATS
+                if stat.metric != 'proc_mem_swap_pss')
+            self._fields = tuple(
+                field for field in self._FIELDS if field != b'SwapPss')
+
+    def metrics(self):
+        return [
+            MetricConfig(
+                stat.metric, stat.description, stat.type,
+                {'labels': self.labels})
+            for stat in self._stats]
+
+    def collect(self, process):
+        try:
+            fields = self._read_fields(process)
+        except PermissionError:
+            self._count(read_errors=1)
+            return {}
+        except OSError:
+            self._count(read_errors=1)
+            return {stat.metric: None for stat in self._stats}
+
+        private = (fields[b'Private_Clean'], fields[b'Private_Dirty'])
+        values = {
+            'proc_mem_pss': fields[b'Pss'],
+            'proc_mem_uss': None if None in private else sum(private)}
+        if b'SwapPss' in fields:
+            values['proc_mem_swap_pss'] = fields[b'SwapPss']
+        return values
+
+    def _reports_swap_pss(self):
+        """Whether the kernel reports SwapPss, checking the exporter process.
+
+        If files can't be read, the field is assumed to be reported.
+
+        """
+        for name in ('smaps_rollup', 'smaps'):
+            try:
+                with open(os.path.join(self._self_dir, name), 'rb') as fd:
+                    return any(line.startswith(b'SwapPss:') for line in fd)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                break
+        return True
+
+    def _read_fields(self, process):
+        """Return a dict with values for fields, in bytes."""
+        if self._has_rollup:
+            try:
+                content = self._read_file(
+                    process_file(process, 'smaps_rollup'))
+            except FileNotFoundError:
+                pass
+            else:
+                self._count(files_read=1, bytes_read=len(content))
+                return {
+                    field: parse_value(find_key_value(content, field))
+                    for field in self._fields}
+
+        fields = self._read_smaps(process_file(process, 'smaps'))
+        # the process exists, so the kernel doesn't provide smaps_rollup
+        self._has_rollup = False
+        return fields
+
+    def _read_smaps(self, path):
+        """Sum values for fields across mappings in a smaps file.
+
+        The file is read line by line, without loading it in memory.
+
+        """
+        fields = dict.fromkeys(self._fields)
+        size = 0
+        with open(str(path), 'rb') as fd:
+            for line in fd:
+                size += len(line)
+                key, separator, value = line.partition(b':')
+                if not separator or key not in fields:
+                    continue
+                value = parse_value(value.strip())
+                if value is not None:
+                    fields[key] = (fields[key] or 0) + value
+        self._count(files_read=1, bytes_read=size)
+        return fields
+
+    def _count(self, **counts):
+        """Add counts to the tally, if set."""
+        if self._counts is not None:
+            self._counts.add(**counts)
+
+
+# Map names to available collectors
+COLLECTORS = OrderedDict(
+    (collector.name, collector)
+    for collector in (
+        ProcessStatsCollector, ProcessSchedStatsCollector,
+        ProcessTasksStatsCollector, ProcessIOStatsCollector,
+        ProcessMemoryStatsCollector))
+
+DEFAULT_COLLECTORS = ('stats', 'sched', 'tasks')
+
+# Map names to available stats backends
+BACKENDS = {
+    backend.name: backend for backend in (ProcBackend, TaskstatsBackend)}
@@ -0,0 +1,230 @@
+"""Client for the Linux taskstats generic netlink interface.
+
+Taskstats return accounting stats for tasks as a binary struct, without
+parsing text files under ``/proc``.  Requests require the ``CAP_NET_ADMIN``
+capability.
+
+See https://www.kernel.org/doc/Documentation/accounting/taskstats.txt for
+details.
+
+"""
+
+import errno
+import os
+import socket
+import struct
+import threading
+
+
+NETLINK_GENERIC = 16
+
+NLM_F_REQUEST = 0x01
+NLMSG_ERROR = 0x02
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+TASKSTATS_GENL_NAME = b'TASKSTATS'
+TASKSTATS_GENL_VERSION = 1
+TASKSTATS_CMD_GET = 1
+TASKSTATS_CMD_ATTR_PID = 1
+TASKSTATS_TYPE_PID = 1
+TASKSTATS_TYPE_STATS = 3
+TASKSTATS_TYPE_AGGR_PID = 4
+
+NLA_TYPE_MASK = 0x3fff
+
+_NLMSG_HEADER = struct.Struct('=IHHII')  # len, type, flags, seq, pid
+_GENL_HEADER = struct.Struct('=BBH')  # cmd, version, reserved
+_ATTR_HEADER = struct.Struct('=HH')  # len, type
+
+# Offsets of fields in struct taskstats
+TASKSTATS_FIELDS = {
+    'ac_utime': 152,  # usec
+    'ac_stime': 160,  # usec
+    'ac_minflt': 168,
+    'ac_majflt': 176,
+    'hiwater_rss': 200,  # kB
+    'read_char': 216,  # rounded to multiples of 1024
+    'write_char': 224,  # rounded to multiples of 1024
+    'read_syscalls': 232,  # rounded to multiples of 1024
+    'write_syscalls': 240,  # rounded to multiples of 1024
+    'read_bytes': 248,
+    'write_bytes': 256,
+    'nvcsw': 272,
+    'nivcsw': 280}
+
+# Maximum number of requests sent at once
+MAX_BATCH = 256
+
+# Timeout for replies, in seconds
+REPLY_TIMEOUT = 5
+
+
+def _align(length):
+    """Return a length aligned to 4 bytes."""
+    return (length + 3) & ~3
+
+
+def pack_attr(attr_type, payload):
+    """Return a netlink attribute."""
+    length = _ATTR_HEADER.size + len(payload)
+    padding = b'\x00' * (_align(length) - length)
+    return _ATTR_HEADER.pack(length, attr_type) + payload + padding
+
+
+def parse_attrs(data):
+    """Return a dict mapping netlink attribute types to payloads."""
+    attrs = {}
+    offset = 0
+    while offset + _ATTR_HEADER.size <= len(data):
+        length, attr_type = _ATTR_HEADER.unpack_from(data, offset)
+        if length < _ATTR_HEADER.size:
+            break
+        attrs[attr_type & NLA_TYPE_MASK] = data[
+            offset + _ATTR_HEADER.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def pack_message(msg_type, seq, cmd, attrs, version=TASKSTATS_GENL_VERSION):
+    """Return a generic netlink request message."""
+    payload = _GENL_HEADER.pack(cmd, version, 0) + attrs
+    length = _NLMSG_HEADER.size + len(payload)
+    header = _NLMSG_HEADER.pack(length, msg_type, NLM_F_REQUEST, seq, 0)
+    return header + payload
+
+
+def parse_messages(data):
+    """Yield tuples with (type, seq, payload) for netlink messages."""
+    offset = 0
+    while offset + _NLMSG_HEADER.size <= len(data):
+        length, msg_type, _, seq, _ = _NLMSG_HEADER.unpack_from(data, offset)
+        if length < _NLMSG_HEADER.size:
+            break
+        yield msg_type, seq, data[offset + _NLMSG_HEADER.size:offset + length]
+        offset += _align(length)
+
+
+def parse_taskstats(data):
+    """Return a dict with fields from a struct taskstats.
+
+    Values for fields not in the struct (from older kernels) are None.
+
+    """
+    return {
+        name: (
+            struct.unpack_from('=Q', data, offset)[0]
+            if offset + 8 <= len(data) else None)
+        for name, offset in TASKSTATS_FIELDS.items()}
+
+
+class TaskstatsConnection:
+    """A connection to the taskstats netlink interface.
+
+    Requests for multiple tasks are sent together, and replies are matched
+    to requests by sequence number.  Requests are serialized across threads.
+
+    :param sock: a connected socket to use instead of a netlink one (for
+        testing).
+    :param float timeout: the maximum time to wait for a reply, in seconds.
+
+    """
+
+    def __init__(self, sock=None, timeout=REPLY_TIMEOUT):
+        if sock is None:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+            sock.bind((0, 0))
+        sock.settimeout(timeout)
+        self._sock = sock
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.family_id = self._get_family_id()
+
+    def get(self, pids):
+        """Return a dict mapping task PIDs to dicts with taskstats fields.
+
+        Tasks that don't exist are not included.  An :class:`OSError` is
+        raised for other errors.
+
+        """
+        pids = list(pids)
+        stats = {}
+        with self._lock:
+            for start in range(0, len(pids), MAX_BATCH):
+                stats.update(self._get_batch(pids[start:start + MAX_BATCH]))
+        return stats
+
+    def close(self):
+        """Close the connection."""
+        self._sock.close()
+
+    def _get_batch(self, pids):
+        """Return taskstats for a batch of PIDs."""
+        requests = {}
+        messages = []
+        for pid in pids:
+            seq = self._next_seq()
+            requests[seq] = pid
+            messages.append(
+                pack_message(
+                    self.family_id, seq, TASKSTATS_CMD_GET,
+                    pack_attr(TASKSTATS_CMD_ATTR_PID, struct.pack('=I', pid))))
+        self._sock.send(b''.join(messages))
+
+        stats = {}
+        for seq, payload in self._receive(requests):
+            attrs = parse_attrs(payload[_GENL_HEADER.size:])
+            aggr = parse_attrs(attrs.get(TASKSTATS_TYPE_AGGR_PID, b''))
+            if TASKSTATS_TYPE_STATS in aggr:
+                stats[requests[seq]] = parse_taskstats(
+                    aggr[TASKSTATS_TYPE_STATS])
+        return stats
+
+    def _get_family_id(self):
+        """Return the generic netlink family ID for taskstats."""
+        seq = self._next_seq()
+        self._sock.send(
+            pack_message(
+                GENL_ID_CTRL, seq, CTRL_CMD_GETFAMILY,
+                pack_attr(
+                    CTRL_ATTR_FAMILY_NAME, TASKSTATS_GENL_NAME + b'\x00')))
+        [(_, payload)] = self._receive({seq: None})
+        attrs = parse_attrs(payload[_GENL_HEADER.size:])
+        return struct.unpack('=H', attrs[CTRL_ATTR_FAMILY_ID])[0]
+
+    def _receive(self, requests):
+        """Yield (seq, payload) tuples for replies to requests.
+
+        Replies with ``ESRCH`` errors (for tasks that don't exist) are
+        skipped.  An :class:`OSError` is raised if replies don't arrive
+        within the timeout.  Late replies to previous requests are ignored.
+
+        """
+        pending = set(requests)
+        while pending:
+            try:
+                data = self._sock.recv(65536)
+            except socket.timeout:
+                raise OSError(
+                    errno.ETIMEDOUT, 'no reply from taskstats for {} '
+                    'requests'.format(len(pending)))
+            if not data:
+                raise OSError(errno.ECONNRESET, 'taskstats connection closed')
+            for msg_type, seq, payload in parse_messages(data):
+                if seq not in pending:
+                    continue
+                pending.discard(seq)
+                if msg_type == NLMSG_ERROR:
+                    error = -struct.unpack_from('=i', payload)[0]
+                    if error == errno.ESRCH:
+                        continue
+                    raise OSError(error, os.strerror(error))
+                yield seq, payload
+
+    def _next_seq(self):
+        self._seq = (self._seq + 1) & 0xffffffff
+        return self._seq
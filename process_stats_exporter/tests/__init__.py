@@ -0,0 +1,19 @@
+"""Helpers shared by tests."""
+
+from .. import procfs
+
+
+def make_stat(pid, start_time, comm='exec', ppid=0):
+    """Return content for a process stat file."""
+    fields = [str(pid), '({})'.format(comm), 'S', str(ppid)]
+    fields.extend(['0'] * 17)
+    fields.append(str(start_time))
+    fields.extend(['0'] * 30)
+    return ' '.join(fields)
+
+
+def deny_io(path, size=procfs.READ_SIZE, read_file=procfs.read_file):
+    """Read a process file, failing for the io file as for other users."""
+    if str(path).endswith('/io'):
+        raise PermissionError(13, 'Permission denied')
+    return read_file(path, size=size)
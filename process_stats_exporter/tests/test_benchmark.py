@@ -0,0 +1,183 @@
+import json
+import re
+from io import StringIO
+from unittest import mock
+
+from lxstats.process import Process
+from lxstats.testing import TestCase
+
+from ..benchmark import (
+    FakeProc,
+    benchmark_parse,
+    benchmark_scrapes,
+    compare_results,
+    main,
+    percentile)
+from ..process import (
+    get_pids,
+    read_cmd,
+    read_start_time)
+from ..stats import (
+    ProcessStatsCollector,
+    ProcessTasksStatsCollector)
+
+
+class BenchmarkParseTests(TestCase):
+
+    def test_benchmark(self):
+        """Timings are returned for each collection method."""
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        process = Process(10, self.tempdir.path / '10')
+        timings = benchmark_parse([process], 2)
+        self.assertEqual(sorted(timings), ['lxstats', 'reader'])
+        for timing in timings.values():
+            self.assertGreater(timing, 0)
+
+
+class FakeProcTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fake_proc = FakeProc(
+            self.tempdir.path, threads=3, cmdline_length=32, seed=1)
+
+    def test_add_process(self):
+        """Processes have files that can be parsed."""
+        pid = self.fake_proc.add_process()
+        self.assertEqual(get_pids(self.tempdir.path), [pid])
+        proc_dir = self.tempdir.path / str(pid)
+        cmd = read_cmd(proc_dir)
+        self.assertRegex(cmd, r'^app\d --option')
+        self.assertEqual(len(cmd), 32)
+        self.assertEqual(read_start_time(proc_dir), 1)
+        process = Process(pid, proc_dir)
+        stats = ProcessStatsCollector().collect(process)
+        self.assertNotIn(None, stats.values())
+        tasks = ProcessTasksStatsCollector().collect(process)
+        self.assertEqual(tasks['proc_tasks_count'], 3)
+
+    def test_add_processes_unique_ids(self):
+        """Processes and threads have different IDs."""
+        pid1 = self.fake_proc.add_process()
+        pid2 = self.fake_proc.add_process()
+        self.assertEqual(pid2, pid1 + 3)
+        self.assertEqual(
+            read_start_time(self.tempdir.path / str(pid2)), 2)
+
+    def test_remove_process(self):
+        """Processes can be removed."""
+        self.fake_proc.add_processes(2)
+        pid = self.fake_proc.pids[0]
+        self.fake_proc.remove_process(pid)
+        self.assertNotIn(pid, get_pids(self.tempdir.path))
+        self.assertNotIn(pid, self.fake_proc.pids)
+
+    def test_churn(self):
+        """A fraction of processes is replaced."""
+        self.fake_proc.add_processes(10)
+        pids = set(self.fake_proc.pids)
+        self.assertEqual(self.fake_proc.churn(0.2), 2)
+        self.assertEqual(len(pids & set(self.fake_proc.pids)), 8)
+        self.assertEqual(
+            get_pids(self.tempdir.path), sorted(self.fake_proc.pids))
+
+
+class PercentileTests(TestCase):
+
+    def test_percentile(self):
+        """The nearest-rank percentile is returned."""
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 0), 1)
+
+
+class BenchmarkScrapesTests(TestCase):
+
+    def test_benchmark(self):
+        """Throughput, latency and memory usage are returned."""
+        fake_proc = FakeProc(self.tempdir.path, seed=1)
+        fake_proc.add_processes(5)
+        results = benchmark_scrapes(
+            fake_proc, 3, [re.compile('app')], churn=0.2)
+        self.assertEqual(
+            sorted(results),
+            ['latency_p50', 'latency_p99', 'peak_rss', 'scrapes_per_sec'])
+        self.assertGreaterEqual(results.pop('peak_rss'), 0)
+        for value in results.values():
+            self.assertGreater(value, 0)
+
+
+class CompareResultsTests(TestCase):
+
+    baseline = {
+        'scrapes_per_sec': 100.0, 'latency_p50': 0.01, 'latency_p99': 0.02,
+        'peak_rss': 1000}
+
+    def test_no_regressions(self):
+        """Results within the threshold are not regressions."""
+        results = {
+            'scrapes_per_sec': 95.0, 'latency_p50': 0.0105,
+            'latency_p99': 0.01, 'peak_rss': 1050}
+        self.assertEqual(compare_results(results, self.baseline, 0.1), [])
+
+    def test_regressions(self):
+        """Results worse than the baseline over the threshold are returned."""
+        results = {
+            'scrapes_per_sec': 50.0, 'latency_p50': 0.01,
+            'latency_p99': 0.03, 'peak_rss': 1000}
+        self.assertEqual(
+            compare_results(results, self.baseline, 0.1),
+            [('scrapes_per_sec', 100.0, 50.0, -0.5),
+             ('latency_p99', 0.02, 0.03, (0.03 - 0.02) / 0.02)])
+
+    def test_missing_baseline(self):
+        """Results not in the baseline are not compared."""
+        results = dict(self.baseline, peak_rss=5000)
+        baseline = dict(self.baseline, peak_rss=0)
+        self.assertEqual(compare_results(results, baseline, 0.1), [])
+
+
+class MainTests(TestCase):
+
+    def test_scrapes_output(self):
+        """Results for the scrapes benchmark are saved as JSON."""
+        output = self.tempdir.path / 'results.json'
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(
+                ['scrapes', '--processes', '5', '-n', '2', '--seed', '1',
+                 '-o', str(output)])
+        self.assertIn('scrapes/sec', stdout.getvalue())
+        content = json.loads(output.read_text())
+        self.assertEqual(content['params']['processes'], 5)
+        self.assertIn('latency_p99', content['results'])
+
+    def write_baseline(self, **results):
+        """Write a baseline file with the specified results."""
+        baseline = self.tempdir.path / 'baseline.json'
+        baseline.write_text(json.dumps({'params': {}, 'results': results}))
+        return baseline
+
+    def run_baseline(self, baseline):
+        """Run the scrapes benchmark with a baseline, returning the status."""
+        with mock.patch('sys.stdout', new_callable=StringIO), \
+                mock.patch('sys.stderr', new_callable=StringIO) as stderr:
+            status = main(
+                ['scrapes', '--processes', '5', '-n', '2', '--seed', '1',
+                 '--baseline', str(baseline), '--threshold', '0.5'])
+        return status, stderr.getvalue()
+
+    def test_scrapes_baseline(self):
+        """With results as good as the baseline, the status is 0."""
+        baseline = self.write_baseline(scrapes_per_sec=0.001)
+        status, stderr = self.run_baseline(baseline)
+        self.assertEqual(status, 0)
+        self.assertNotIn('regression', stderr)
+
+    def test_scrapes_baseline_regression(self):
+        """With results worse than the baseline, the status is 1."""
+        baseline = self.write_baseline(scrapes_per_sec=1e12)
+        status, stderr = self.run_baseline(baseline)
+        self.assertEqual(status, 1)
+        self.assertIn('regression: scrapes_per_sec 1e+12', stderr)
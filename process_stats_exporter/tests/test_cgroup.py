@@ -0,0 +1,146 @@
+from unittest import TestCase
+
+from lxstats.testing import TestCase as LxStatsTestCase
+from prometheus_client import (
+    CollectorRegistry,
+    generate_latest)
+
+from ..cgroup import (
+    CgroupStatsCollector,
+    get_cgroup_name,
+    get_cgroup_path,
+    get_cgroup_pids,
+    parse_flat_keyed,
+    read_cgroup_file)
+
+
+class GetCgroupPathTests(TestCase):
+
+    def test_absolute(self):
+        """Absolute paths are returned normalized."""
+        self.assertEqual(
+            get_cgroup_path('/sys/fs/cgroup/foo/'), '/sys/fs/cgroup/foo')
+
+    def test_relative(self):
+        """Relative paths are relative to the root."""
+        self.assertEqual(
+            get_cgroup_path('foo/bar', root='/cgroup'), '/cgroup/foo/bar')
+
+
+class GetCgroupNameTests(TestCase):
+
+    def test_under_root(self):
+        """The name is the path relative to the root."""
+        self.assertEqual(
+            get_cgroup_name('/sys/fs/cgroup/system.slice/foo.service'),
+            '/system.slice/foo.service')
+
+    def test_relative(self):
+        """The name for relative paths starts with a slash."""
+        self.assertEqual(
+            get_cgroup_name('system.slice/', root='/cgroup'), '/system.slice')
+
+    def test_root(self):
+        """The name of the root cgroup is a slash."""
+        self.assertEqual(get_cgroup_name('/cgroup', root='/cgroup'), '/')
+
+    def test_outside_root(self):
+        """The name of a cgroup not under the root is the full path."""
+        self.assertEqual(
+            get_cgroup_name('/other/foo', root='/cgroup'), '/other/foo')
+
+
+class GetCgroupPidsTests(LxStatsTestCase):
+
+    def test_pids(self):
+        """PIDs for processes in the cgroup are returned sorted."""
+        self.tempdir.mkfile(path='foo/cgroup.procs', content='30\n10\n20\n')
+        self.assertEqual(
+            get_cgroup_pids(self.tempdir.join('foo')), [10, 20, 30])
+
+    def test_descendants(self):
+        """PIDs for processes in descendant cgroups are included."""
+        self.tempdir.mkfile(path='foo/cgroup.procs', content='10\n')
+        self.tempdir.mkfile(path='foo/bar/cgroup.procs', content='20\n')
+        self.tempdir.mkfile(path='foo/bar/baz/cgroup.procs', content='')
+        self.tempdir.mkfile(path='other/cgroup.procs', content='30\n')
+        self.assertEqual(get_cgroup_pids(self.tempdir.join('foo')), [10, 20])
+
+    def test_not_found(self):
+        """If the cgroup doesn't exist, no PID is returned."""
+        self.assertEqual(get_cgroup_pids(self.tempdir.join('foo')), [])
+
+
+class ParseFlatKeyedTests(TestCase):
+
+    def test_parse(self):
+        """Integer values are parsed from lines."""
+        self.assertEqual(
+            parse_flat_keyed(b'usage_usec 100\nuser_usec 60\n'),
+            {'usage_usec': 100, 'user_usec': 60})
+
+    def test_invalid(self):
+        """Invalid lines are skipped."""
+        self.assertEqual(
+            parse_flat_keyed(b'foo 1 2\nbar baz\nusage_usec 100'),
+            {'usage_usec': 100})
+
+
+class ReadCgroupFileTests(LxStatsTestCase):
+
+    def test_read_chunks(self):
+        """The full file is read, in chunks."""
+        self.tempdir.mkfile(path='cgroup.procs', content='12345\n' * 10)
+        self.assertEqual(
+            read_cgroup_file(self.tempdir.join('cgroup.procs'), size=4),
+            b'12345\n' * 10)
+
+
+class CgroupStatsCollectorTests(LxStatsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.registry = CollectorRegistry()
+
+    def generate(self, cgroups, labels=None):
+        self.registry.register(
+            CgroupStatsCollector(
+                cgroups, labels=labels, root=self.tempdir.path))
+        return generate_latest(self.registry).decode('utf-8')
+
+    def test_collect(self):
+        """CPU and memory stats for cgroups are exported."""
+        self.tempdir.mkfile(
+            path='foo/cpu.stat',
+            content=(
+                'usage_usec 3000000\nuser_usec 2000000\n'
+                'system_usec 1000000\nnr_periods 10\n'
+                'throttled_usec 500000\n'))
+        self.tempdir.mkfile(path='foo/memory.current', content='4096\n')
+        content = self.generate(['foo'], labels={'env': 'prod'})
+        self.assertIn('# TYPE proc_cgroup_cpu_usage_seconds counter', content)
+        self.assertIn(
+            'proc_cgroup_cpu_usage_seconds{cgroup="/foo",env="prod"} 3.0',
+            content)
+        self.assertIn(
+            'proc_cgroup_cpu_user_seconds{cgroup="/foo",env="prod"} 2.0',
+            content)
+        self.assertIn(
+            'proc_cgroup_cpu_system_seconds{cgroup="/foo",env="prod"} 1.0',
+            content)
+        self.assertIn(
+            'proc_cgroup_cpu_throttled_seconds{cgroup="/foo",env="prod"} 0.5',
+            content)
+        self.assertIn('# TYPE proc_cgroup_mem_current gauge', content)
+        self.assertIn(
+            'proc_cgroup_mem_current{cgroup="/foo",env="prod"} 4096.0',
+            content)
+
+    def test_collect_missing(self):
+        """Stats not available are not exported."""
+        self.tempdir.mkfile(path='foo/cpu.stat', content='usage_usec 100\n')
+        content = self.generate(['foo', 'bar'])
+        self.assertIn('proc_cgroup_cpu_usage_seconds{cgroup="/foo"}', content)
+        self.assertNotIn('proc_cgroup_cpu_user_seconds{', content)
+        self.assertNotIn('proc_cgroup_mem_current{', content)
+        self.assertNotIn('cgroup="/bar"', content)
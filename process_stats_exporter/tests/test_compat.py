@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+from unittest import TestCase
+
+from prometheus_aioexporter.metric import (
+    MetricConfig,
+    MetricsRegistry)
+
+from ..compat import (
+    AIOEXPORTER_VERSION,
+    WEB_FACTORY,
+    PrometheusExporterScript,
+    PrometheusExporterWeb,
+    UnsupportedVersion,
+    get_web_factory,
+    unregister_metric)
+from ..main import ProcessStatsExporter
+
+
+class FakeWeb:
+
+    async def _handle_metrics(self, request):
+        pass
+
+
+class UnsupportedVersionTests(TestCase):
+
+    def test_message(self):
+        """The message includes the version and what's not found."""
+        error = UnsupportedVersion('something', version='9.9')
+        self.assertEqual(
+            str(error),
+            'prometheus_aioexporter 9.9 is not supported: something not found')
+
+    def test_default_version(self):
+        """The installed version is reported by default."""
+        self.assertEqual(
+            UnsupportedVersion('something').version, AIOEXPORTER_VERSION)
+
+
+class GetWebFactoryTests(TestCase):
+
+    def test_application(self):
+        """Before 1.4, the script creates an application subclass."""
+
+        class Script:
+
+            def _create_application(self, args):
+                pass
+
+        web_module = SimpleNamespace(PrometheusExporterApplication=FakeWeb)
+        self.assertEqual(
+            get_web_factory(Script, web_module),
+            ('_create_application', FakeWeb))
+
+    def test_exporter(self):
+        """From 1.4, the script creates an exporter."""
+
+        class Script:
+
+            def _get_exporter(self, args):
+                pass
+
+        web_module = SimpleNamespace(PrometheusExporter=FakeWeb)
+        self.assertEqual(
+            get_web_factory(Script, web_module), ('_get_exporter', FakeWeb))
+
+    def test_no_metrics_handler(self):
+        """The web class must have a metrics handler."""
+
+        class Script:
+
+            def _get_exporter(self, args):
+                pass
+
+        web_module = SimpleNamespace(PrometheusExporter=object)
+        with self.assertRaises(UnsupportedVersion):
+            get_web_factory(Script, web_module)
+
+    def test_not_found(self):
+        """If no factory is found, UnsupportedVersion is raised."""
+        web_module = SimpleNamespace(PrometheusExporter=FakeWeb)
+        with self.assertRaises(UnsupportedVersion) as context:
+            get_web_factory(object, web_module)
+        self.assertIn(
+            '_get_exporter, _create_application', str(context.exception))
+
+    def test_installed_version(self):
+        """The factory for the installed version is found."""
+        self.assertTrue(hasattr(PrometheusExporterScript, WEB_FACTORY))
+        self.assertTrue(hasattr(PrometheusExporterWeb, '_handle_metrics'))
+
+    def test_overridden(self):
+        """The exporter script overrides the factory."""
+        self.assertIsNot(
+            getattr(ProcessStatsExporter, WEB_FACTORY),
+            getattr(PrometheusExporterScript, WEB_FACTORY))
+
+
+class UnregisterMetricTests(TestCase):
+
+    def test_unregister(self):
+        """The metric is removed from the collector registry."""
+        registry = MetricsRegistry()
+        metrics = registry.create_metrics(
+            [MetricConfig('sample', 'A sample', 'gauge', {})])
+        unregister_metric(registry, metrics['sample'])
+        self.assertNotIn(
+            b'sample', registry.generate_metrics())
+
+    def test_no_collector_registry(self):
+        """If the registry has no collector registry, an error is raised."""
+        with self.assertRaises(UnsupportedVersion):
+            unregister_metric(object(), None)
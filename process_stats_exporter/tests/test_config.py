@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+from unittest import mock
+
+from lxstats.testing import TestCase
+
+from .. import config
+from ..config import (
+    ConfigError,
+    ConfigWatcher,
+    load_config,
+    parse_config)
+
+
+class LoadConfigTests(TestCase):
+
+    def test_load_json(self):
+        """Options are loaded from a JSON file."""
+        path = self.tempdir.mkfile(
+            path='config.json',
+            content=json.dumps(
+                {'pids': [10, 20], 'cmdline_regexps': ['foo.*'],
+                 'labels': {'env': 'prod'}}))
+        loaded = load_config(path)
+        self.assertEqual(loaded['pids'], [10, 20])
+        [regexp] = loaded['cmdline_regexps']
+        self.assertEqual(regexp.pattern, 'foo.*')
+        self.assertEqual(loaded['labels'], {'env': 'prod'})
+
+    def test_load_not_found(self):
+        """An error is raised if the file can't be read."""
+        with self.assertRaises(ConfigError) as cm:
+            load_config(self.tempdir.join('config.json'))
+        self.assertIn('No such file or directory', str(cm.exception))
+
+    def test_load_invalid_json(self):
+        """An error is raised if the file is not valid JSON."""
+        path = self.tempdir.mkfile(path='config.json', content='{')
+        with self.assertRaises(ConfigError) as cm:
+            load_config(path)
+        self.assertIn('parsing', str(cm.exception))
+
+    def test_load_yaml_not_available(self):
+        """An error is raised for YAML files if PyYAML is not installed."""
+        path = self.tempdir.mkfile(path='config.yaml', content='pids: [10]')
+        with mock.patch.object(config, 'yaml', None):
+            with self.assertRaises(ConfigError) as cm:
+                load_config(path)
+        self.assertEqual(
+            str(cm.exception), 'PyYAML is required for YAML config files')
+
+
+class ParseConfigTests(TestCase):
+
+    def test_only_present_keys(self):
+        """Only options in the data are returned."""
+        self.assertEqual(parse_config({'pids': [10]}), {'pids': [10]})
+        self.assertEqual(parse_config(None), {})
+
+    def test_not_mapping(self):
+        """Config data must be a mapping."""
+        with self.assertRaises(ConfigError) as cm:
+            parse_config([10])
+        self.assertEqual(str(cm.exception), 'config must be a mapping')
+
+    def test_unknown_keys(self):
+        """Unknown keys are not allowed."""
+        with self.assertRaises(ConfigError) as cm:
+            parse_config({'pids': [10], 'foo': 1, 'bar': 2})
+        self.assertEqual(str(cm.exception), 'unknown config keys: bar, foo')
+
+    def test_invalid_pids(self):
+        """PIDs must be a list of integers."""
+        with self.assertRaises(ConfigError) as cm:
+            parse_config({'pids': ['10']})
+        self.assertEqual(str(cm.exception), 'pids must be integers')
+        with self.assertRaises(ConfigError) as cm:
+            parse_config({'pids': 10})
+        self.assertEqual(str(cm.exception), 'pids must be a list')
+
+    def test_invalid_regexp(self):
+        """Regexps must be valid."""
+        with self.assertRaises(ConfigError) as cm:
+            parse_config({'cmdline_regexps': ['foo(']})
+        self.assertIn("compiling regexp 'foo('", str(cm.exception))
+
+    def test_invalid_regexp_group(self):
+        """Regexp groups must be valid as labels."""
+        with self.assertRaises(ConfigError) as cm:
+            parse_config({'cmdline_regexps': ['(?P<Foo>.*)']})
+        self.assertEqual(
+            str(cm.exception), 'regexp group not valid as label: Foo')
+
+    def test_invalid_label(self):
+        """Label names must be valid."""
+        with self.assertRaises(ConfigError) as cm:
+            parse_config({'labels': {'Foo': 'bar'}})
+        self.assertEqual(str(cm.exception), 'invalid label: Foo')
+
+    def test_label_values_strings(self):
+        """Label values are converted to strings."""
+        self.assertEqual(
+            parse_config({'labels': {'shard': 1}}),
+            {'labels': {'shard': '1'}})
+
+
+class ConfigWatcherTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = self.tempdir.mkfile(path='config.json', content='{}')
+        self.changes = []
+        self.watcher = ConfigWatcher(
+            self.path, lambda: self.changes.append(True), interval=0.01)
+
+    def test_check_unchanged(self):
+        """If the file is unchanged, the callable is not called."""
+        self.watcher.check()
+        self.assertEqual(self.changes, [])
+
+    def test_check_changed(self):
+        """If the file changes, the callable is called once."""
+        self.tempdir.mkfile(path='config.json', content='{"pids": [10]}')
+        self.watcher.check()
+        self.watcher.check()
+        self.assertEqual(self.changes, [True])
+
+    def test_check_removed(self):
+        """If the file is removed, the callable is called."""
+        os.unlink(self.path)
+        self.watcher.check()
+        self.assertEqual(self.changes, [True])
+
+    def test_start_stop(self):
+        """The file is checked periodically once started."""
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+        async def run():
+            self.watcher.start()
+            self.tempdir.mkfile(path='config.json', content='{"pids": [1]}')
+            await asyncio.sleep(0.05)
+            await self.watcher.stop()
+
+        loop.run_until_complete(run())
+        self.assertEqual(self.changes, [True])
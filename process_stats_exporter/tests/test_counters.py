@@ -0,0 +1,236 @@
+from unittest import TestCase
+
+from prometheus_aioexporter.metric import MetricConfig
+from prometheus_client import (
+    CollectorRegistry,
+    generate_latest)
+
+from ..counters import (
+    CounterDeltas,
+    CounterRates,
+    CumulativeCountersCollector)
+
+
+class CounterDeltasTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.deltas = CounterDeltas(['foo', 'bar'])
+        self.deltas.new_cycle()
+
+    def test_first_sample(self):
+        """The first increment for a process is the full value."""
+        self.assertEqual(
+            self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20}),
+            {'foo': 10, 'bar': 20})
+
+    def test_deltas(self):
+        """Increments are the difference with the previous sample."""
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.deltas.new_cycle()
+        self.assertEqual(
+            self.deltas.deltas('p1', 100, {'foo': 15, 'bar': 20}),
+            {'foo': 5, 'bar': 0})
+
+    def test_deltas_per_process(self):
+        """Values are tracked separately for each process."""
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.deltas.deltas('p2', 100, {'foo': 1, 'bar': 2})
+        self.deltas.new_cycle()
+        self.assertEqual(
+            self.deltas.deltas('p2', 100, {'foo': 3, 'bar': 4}),
+            {'foo': 2, 'bar': 2})
+
+    def test_start_time_changed(self):
+        """If the start time changes, counters are reset."""
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.deltas.new_cycle()
+        self.assertEqual(
+            self.deltas.deltas('p1', 200, {'foo': 15, 'bar': 30}),
+            {'foo': 15, 'bar': 30})
+
+    def test_value_decreased(self):
+        """If a value decreases, the counter is reset."""
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.deltas.new_cycle()
+        self.assertEqual(
+            self.deltas.deltas('p1', 100, {'foo': 5, 'bar': 25}),
+            {'foo': 5, 'bar': 5})
+
+    def test_none_values(self):
+        """None values are preserved, and don't reset the last value."""
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.assertEqual(
+            self.deltas.deltas('p1', 100, {'foo': None, 'bar': 25}),
+            {'foo': None, 'bar': 5})
+        self.assertEqual(
+            self.deltas.deltas('p1', 100, {'foo': 12, 'bar': 25}),
+            {'foo': 2, 'bar': 0})
+
+    def test_missing_values(self):
+        """Counters without values are not included."""
+        self.assertEqual(
+            self.deltas.deltas('p1', 100, {'foo': 10}), {'foo': 10})
+
+    def test_new_cycle_releases_slots(self):
+        """Slots for processes not seen in a cycle are released and reused."""
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.deltas.deltas('p2', 100, {'foo': 10, 'bar': 20})
+        self.deltas.new_cycle()
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.deltas.new_cycle()
+        self.assertEqual(len(self.deltas), 1)
+        self.assertEqual(
+            self.deltas.deltas('p3', 100, {'foo': 1, 'bar': 2}),
+            {'foo': 1, 'bar': 2})
+        self.assertEqual(len(self.deltas._start_times), 2)
+
+    def test_prune(self):
+        """Slots for processes not in the specified keys are released."""
+        self.deltas.deltas('p1', 100, {'foo': 10, 'bar': 20})
+        self.deltas.deltas('p2', 100, {'foo': 10, 'bar': 20})
+        self.deltas.prune(['p2'])
+        self.assertEqual(len(self.deltas), 1)
+        self.assertEqual(
+            self.deltas.deltas('p1', 100, {'foo': 15, 'bar': 20}),
+            {'foo': 15, 'bar': 20})
+
+
+class CounterRatesTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.rates = CounterRates(['foo', 'bar'])
+
+    def test_first_sample(self):
+        """There are no rates for the first sample for a process."""
+        self.assertEqual(
+            self.rates.rates('p1', 100, 10.0, {'foo': 10, 'bar': 20}), {})
+
+    def test_rates(self):
+        """Rates are increments divided by the elapsed time."""
+        self.rates.rates('p1', 100, 10.0, {'foo': 10, 'bar': 20})
+        self.assertEqual(
+            self.rates.rates('p1', 100, 14.0, {'foo': 30, 'bar': 20}),
+            {'foo': 5.0, 'bar': 0.0})
+
+    def test_rates_per_process(self):
+        """Rates are computed separately for each process."""
+        self.rates.rates('p1', 100, 10.0, {'foo': 10})
+        self.rates.rates('p2', 100, 12.0, {'foo': 100})
+        self.assertEqual(
+            self.rates.rates('p1', 100, 12.0, {'foo': 20}), {'foo': 5.0})
+        self.assertEqual(
+            self.rates.rates('p2', 100, 22.0, {'foo': 200}), {'foo': 10.0})
+
+    def test_start_time_changed(self):
+        """There are no rates if the process start time changes."""
+        self.rates.rates('p1', 100, 10.0, {'foo': 10})
+        self.assertEqual(self.rates.rates('p1', 200, 12.0, {'foo': 20}), {})
+        self.assertEqual(
+            self.rates.rates('p1', 200, 14.0, {'foo': 30}), {'foo': 5.0})
+
+    def test_value_decreased(self):
+        """There's no rate for a value that decreases."""
+        self.rates.rates('p1', 100, 10.0, {'foo': 10, 'bar': 10})
+        self.assertEqual(
+            self.rates.rates('p1', 100, 12.0, {'foo': 5, 'bar': 20}),
+            {'bar': 5.0})
+
+    def test_no_elapsed_time(self):
+        """There are no rates if no time elapsed."""
+        self.rates.rates('p1', 100, 10.0, {'foo': 10})
+        self.assertEqual(self.rates.rates('p1', 100, 10.0, {'foo': 20}), {})
+
+    def test_none_values(self):
+        """Values that are not available have no rate."""
+        self.rates.rates('p1', 100, 10.0, {'foo': 10, 'bar': 10})
+        self.assertEqual(
+            self.rates.rates('p1', 100, 12.0, {'foo': None, 'bar': 20}),
+            {'bar': 5.0})
+
+    def test_slots_reused(self):
+        """Slots for pruned processes are reused."""
+        self.rates.rates('p1', 100, 10.0, {'foo': 10})
+        self.rates.prune([])
+        self.assertEqual(self.rates.rates('p2', 100, 12.0, {'foo': 20}), {})
+        self.assertEqual(len(self.rates._timestamps), 1)
+
+
+class CumulativeCountersCollectorTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.collector = CumulativeCountersCollector(
+            [MetricConfig('foo', 'The foo', 'counter', {})], ['l2', 'l1'])
+        self.registry = CollectorRegistry()
+        self.registry.register(self.collector)
+
+    def get_value(self, labels):
+        """Return the value for the foo counter with the labels."""
+        return self.registry.get_sample_value('foo', labels)
+
+    def test_collect(self):
+        """Cumulative values are exported as counters."""
+        self.collector.update(
+            [({'l1': 'a', 'l2': 'b'}, 1, {'foo': 10}),
+             ({'l1': 'c', 'l2': 'd'}, 2, {'foo': 20})])
+        content = generate_latest(self.registry).decode('utf-8')
+        self.assertIn('# TYPE foo counter', content)
+        self.assertIn('foo{l1="a",l2="b"} 10.0', content)
+        self.assertIn('foo{l1="c",l2="d"} 20.0', content)
+
+    def test_collect_sum_same_labels(self):
+        """Values for processes with the same labels are summed."""
+        self.collector.update(
+            [({'l1': 'a', 'l2': 'b'}, 1, {'foo': 10}),
+             ({'l1': 'a', 'l2': 'b'}, 2, {'foo': 20}),
+             ({'l1': 'a', 'l2': 'b'}, 3, {'foo': None})])
+        content = generate_latest(self.registry).decode('utf-8')
+        self.assertIn('foo{l1="a",l2="b"} 30.0', content)
+
+    def test_update_replaces_values(self):
+        """Values from previous updates are replaced."""
+        self.collector.update([({'l1': 'a', 'l2': 'b'}, 1, {'foo': 10})])
+        self.collector.update([({'l1': 'c', 'l2': 'd'}, 2, {'foo': 20})])
+        content = generate_latest(self.registry).decode('utf-8')
+        self.assertNotIn('l1="a"', content)
+
+    def test_update_process_gone(self):
+        """Values for processes that are gone are kept for their labels."""
+        labels = {'l1': 'a', 'l2': 'b'}
+        self.collector.update(
+            [(labels, 1, {'foo': 10}), (labels, 2, {'foo': 20})])
+        self.collector.update([(labels, 2, {'foo': 25})])
+        self.assertEqual(self.get_value(labels), 35)
+        self.collector.update(
+            [(labels, 2, {'foo': 30}), (labels, 3, {'foo': 1})])
+        self.assertEqual(self.get_value(labels), 41)
+
+    def test_update_process_restarted(self):
+        """Values for a restarted process are added to previous ones."""
+        labels = {'l1': 'a', 'l2': 'b'}
+        self.collector.update([(labels, (10, 100), {'foo': 50})])
+        self.collector.update([(labels, (10, 200), {'foo': 5})])
+        self.assertEqual(self.get_value(labels), 55)
+
+    def test_update_missing_value(self):
+        """If a value is missing, the last one for the process is used."""
+        labels = {'l1': 'a', 'l2': 'b'}
+        self.collector.update(
+            [(labels, 1, {'foo': 10}), (labels, 2, {'foo': 20})])
+        self.collector.update(
+            [(labels, 1, {'foo': None}), (labels, 2, {'foo': 25})])
+        self.assertEqual(self.get_value(labels), 35)
+
+    def test_update_labels_gone(self):
+        """Offsets are discarded when no process has the labels."""
+        labels = {'l1': 'a', 'l2': 'b'}
+        self.collector.update(
+            [(labels, 1, {'foo': 10}), (labels, 2, {'foo': 20})])
+        self.collector.update([(labels, 2, {'foo': 20})])
+        self.collector.update([])
+        self.assertIsNone(self.get_value(labels))
+        self.assertEqual(self.collector._offsets, {})
+        self.collector.update([(labels, 3, {'foo': 5})])
+        self.assertEqual(self.get_value(labels), 5)
@@ -0,0 +1,173 @@
+import gzip
+from unittest import (
+    TestCase,
+    mock)
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.exposition import generate_latest
+
+from ..exposition import (
+    ExpositionCache,
+    _split_output)
+
+
+class SampleCollector:
+
+    documentation = 'A sample'
+
+    def collect(self):
+        metric = GaugeMetricFamily(
+            'sample', self.documentation, labels=['x'])
+        metric.add_metric(['y'], 3)
+        yield metric
+
+
+class ExpositionCacheTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.registry = CollectorRegistry()
+        self.counter = Counter(
+            'counter', 'A counter', ['pid', 'cmd'], registry=self.registry)
+        self.gauge = Gauge(
+            'gauge', 'A gauge', ['name'], registry=self.registry)
+        self.histogram = Histogram(
+            'histogram', 'A histogram', ['phase'], buckets=(1, 10),
+            registry=self.registry)
+        self.exposition = ExpositionCache(self.registry)
+
+    def test_same_as_generate_latest(self):
+        """The exposition is the same as generated by prometheus_client."""
+        self.registry.register(SampleCollector())
+        self.counter.labels(pid='10', cmd='foo').inc(3)
+        self.counter.labels(pid='20', cmd='b"a\\r\n').inc(4.5)
+        self.gauge.labels(name='x').set(1e20)
+        self.histogram.labels(phase='a').observe(5)
+        Gauge('plain', 'A gauge without labels', registry=self.registry).set(2)
+        self.exposition.update()
+        self.assertEqual(
+            self.exposition.get(), generate_latest(self.registry))
+
+    def test_update_values(self):
+        """Updated values are included in the exposition."""
+        child = self.counter.labels(pid='10', cmd='foo')
+        child.inc(3)
+        self.exposition.update()
+        child.inc(2)
+        self.gauge.labels(name='x').set(5)
+        self.exposition.update()
+        self.assertIn(b'gauge{name="x"} 5.0\n', self.exposition.get())
+        self.assertEqual(
+            self.exposition.get(), generate_latest(self.registry))
+
+    def test_update_render_changed(self):
+        """Only lines for series whose value changed are rendered again."""
+        self.counter.labels(pid='10', cmd='foo').inc(1)
+        self.gauge.labels(name='x').set(1)
+        child = self.gauge.labels(name='y')
+        child.set(2)
+        self.exposition.update()
+        counter = self.exposition._rendered['counter']
+        gauge_lines = self.exposition._rendered['gauge'].lines
+        child.set(3)
+        with mock.patch(
+                'process_stats_exporter.exposition.generate_latest',
+                side_effect=generate_latest) as mock_generate:
+            self.exposition.update()
+        self.assertIs(self.exposition._rendered['counter'], counter)
+        # only the changed series is rendered
+        [call] = mock_generate.call_args_list
+        [family] = call[0][0].collect()
+        self.assertEqual(
+            [sample[:3] for sample in family.samples],
+            [('gauge', {'name': 'y'}, 3.0)])
+        lines = self.exposition._rendered['gauge'].lines
+        key = ('gauge', (('name', 'x'),))
+        self.assertIs(lines[key], gauge_lines[key])
+        self.assertIn(b'gauge{name="y"} 3.0\n', self.exposition.get())
+        self.assertEqual(
+            self.exposition.get(), generate_latest(self.registry))
+
+    def test_update_new_series(self):
+        """New series are added to the exposition."""
+        self.gauge.labels(name='x').set(1)
+        self.exposition.update()
+        self.gauge.labels(name='y').set(1)
+        self.exposition.update()
+        self.assertEqual(
+            self.exposition.get(), generate_latest(self.registry))
+
+    def test_update_documentation_changed(self):
+        """Metrics are rendered again if their description changes."""
+        collector = SampleCollector()
+        self.registry.register(collector)
+        self.exposition.update()
+        collector.documentation = 'Another sample'
+        self.exposition.update()
+        self.assertIn(b'# HELP sample Another sample\n', self.exposition.get())
+
+    def test_update_removed_series(self):
+        """Removed series are dropped from the exposition."""
+        self.gauge.labels(name='x').set(1)
+        self.gauge.labels(name='y').set(2)
+        self.exposition.update()
+        self.gauge.remove('x')
+        self.exposition.update()
+        body = self.exposition.get()
+        self.assertNotIn(b'name="x"', body)
+        self.assertIn(b'name="y"', body)
+
+    def test_update_unregistered_collector(self):
+        """Unregistered collectors are dropped from the exposition."""
+        self.gauge.labels(name='x').set(1)
+        self.exposition.update()
+        self.registry.unregister(self.gauge)
+        self.exposition.update()
+        self.assertNotIn(b'gauge', self.exposition.get())
+        self.assertNotIn('gauge', self.exposition._rendered)
+
+    def test_get_compressed(self):
+        """The compressed exposition is gzip-compressed."""
+        self.gauge.labels(name='x').set(1)
+        self.exposition.update()
+        self.assertEqual(
+            gzip.decompress(self.exposition.get(compressed=True)),
+            self.exposition.get())
+
+    def test_update_compressed_unchanged(self):
+        """The exposition is not compressed again if unchanged."""
+        self.gauge.labels(name='x').set(1)
+        self.exposition.update()
+        compressed = self.exposition.get(compressed=True)
+        self.exposition.update()
+        self.assertIs(self.exposition.get(compressed=True), compressed)
+
+    def test_get_not_updated(self):
+        """If the exposition is not rendered yet, None is returned."""
+        self.assertIsNone(self.exposition.get())
+        self.assertIsNone(self.exposition.get(compressed=True))
+
+
+class SplitOutputTests(TestCase):
+
+    def test_split(self):
+        """The output is split in the header and sample lines."""
+        self.assertEqual(
+            _split_output(b'# HELP x X\n# TYPE x gauge\nx 1.0\nx 2.0\n', 2),
+            (b'# HELP x X\n# TYPE x gauge\n', [b'x 1.0\n', b'x 2.0\n']))
+
+    def test_split_count_mismatch(self):
+        """If the number of sample lines doesn't match, None is returned."""
+        self.assertIsNone(_split_output(b'# TYPE x gauge\nx 1.0\n', 2))
+
+    def test_split_header_after_samples(self):
+        """If headers follow sample lines, None is returned."""
+        self.assertIsNone(
+            _split_output(
+                b'# TYPE x counter\nx_total 1.0\n'
+                b'# TYPE x_created gauge\nx_created 1.0\n', 3))
@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from ..guard import (
+    SeriesGuard,
+    top_keys)
+
+
+class TopKeysTests(TestCase):
+
+    def test_top_keys(self):
+        """Keys with the highest scores are returned."""
+        scores = [('a', 10), ('b', 30), ('c', 20), ('d', 5), ('e', 40)]
+        self.assertEqual(top_keys(scores, 3), ['b', 'c', 'e'])
+
+    def test_top_keys_fewer(self):
+        """All keys are returned if fewer than requested."""
+        self.assertEqual(top_keys([('a', 1), ('b', 2)], 3), ['a', 'b'])
+
+    def test_top_keys_ties(self):
+        """With equal scores, keys that come first are preferred."""
+        scores = [('a', 1), ('b', 1), ('c', 1), ('d', 2)]
+        self.assertEqual(top_keys(scores, 2), ['a', 'd'])
+
+    def test_top_keys_order(self):
+        """Keys are returned in the order they're passed."""
+        scores = [('a', 10), ('b', 40), ('c', 20), ('d', 30)]
+        self.assertEqual(top_keys(scores, 3), ['b', 'c', 'd'])
+
+    def test_top_keys_not_compared(self):
+        """Keys are not compared."""
+        scores = [(object(), 1), (object(), 1), (object(), 1)]
+        self.assertEqual(len(top_keys(scores, 2)), 2)
+
+
+class SeriesGuardTests(TestCase):
+
+    def test_score_rss(self):
+        """The score for RSS ranking is the current RSS."""
+        guard = SeriesGuard(top_k=1, rank_by='rss')
+        self.assertEqual(
+            guard.score({'proc_mem_rss': 100}, {'proc_time_user': 10}), 100)
+
+    def test_score_cpu(self):
+        """The score for CPU ranking is the CPU time increment."""
+        guard = SeriesGuard(top_k=1, rank_by='cpu')
+        self.assertEqual(
+            guard.score(
+                {'proc_time_user': 100, 'proc_time_system': 200},
+                {'proc_time_user': 10, 'proc_time_system': 20}),
+            30)
+
+    def test_score_missing(self):
+        """Missing values count as zero."""
+        guard = SeriesGuard(top_k=1, rank_by='cpu')
+        self.assertEqual(guard.score({}, {'proc_time_user': None}), 0)
+
+    def test_select_top_k(self):
+        """Keys with the highest scores are selected."""
+        guard = SeriesGuard(top_k=2)
+        scores = [('a', 10), ('b', 30), ('c', 20)]
+        self.assertEqual(guard.select(iter(scores), set()), {'b', 'c'})
+
+    def test_select_max_series(self):
+        """New keys are selected while below the maximum."""
+        guard = SeriesGuard(max_series=3)
+        scores = [('a', 0), ('b', 0), ('c', 0), ('d', 0)]
+        self.assertEqual(guard.select(scores, {'c'}), {'a', 'b', 'c'})
+
+    def test_select_max_series_not_found(self):
+        """Tracked keys not found don't count towards the maximum."""
+        guard = SeriesGuard(max_series=2)
+        scores = [('a', 0), ('b', 0), ('c', 0)]
+        self.assertEqual(guard.select(scores, {'x', 'y'}), {'a', 'b'})
+
+    def test_select_max_series_tracked(self):
+        """Keys that already have series are always selected."""
+        guard = SeriesGuard(max_series=2)
+        scores = [('a', 0), ('b', 0), ('c', 0)]
+        self.assertEqual(guard.select(scores, {'b', 'c'}), {'b', 'c'})
+
+    def test_select_top_k_and_max_series(self):
+        """Top keys are selected within the maximum."""
+        guard = SeriesGuard(max_series=2, top_k=2)
+        scores = [('a', 10), ('b', 30), ('c', 20)]
+        self.assertEqual(guard.select(scores, {'a', 'c'}), {'b', 'c'})
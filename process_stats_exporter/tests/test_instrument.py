@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+from prometheus_aioexporter.metric import MetricsRegistry
+
+from ..instrument import (
+    Instrumentation,
+    Tally)
+
+
+class TallyTests(TestCase):
+
+    def test_add(self):
+        """Values are summed by name."""
+        tally = Tally()
+        tally.add(foo=1, bar=2)
+        tally.add(foo=3)
+        self.assertEqual(tally.take(), {'foo': 4, 'bar': 2})
+
+    def test_take_resets(self):
+        """Values are reset when taken."""
+        tally = Tally()
+        tally.add(foo=1)
+        tally.take()
+        self.assertEqual(tally.take(), {})
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.instrumentation = Instrumentation()
+        self.metrics = MetricsRegistry().create_metrics(
+            self.instrumentation.metrics())
+
+    def test_update_metrics_durations(self):
+        """Phase durations are observed in the histogram."""
+        self.instrumentation.durations.add(discovery=0.002, update=0.02)
+        self.instrumentation.update_metrics(self.metrics)
+        histogram = self.metrics['proc_exporter_phase_duration_seconds']
+        self.assertEqual(
+            histogram.labels(phase='discovery')._sum.get(), 0.002)
+        self.assertEqual(histogram.labels(phase='update')._sum.get(), 0.02)
+
+    def test_update_metrics_counts(self):
+        """Counts are added to counters."""
+        self.instrumentation.counts.add(files_read=3, bytes_read=100)
+        self.instrumentation.update_metrics(self.metrics)
+        self.instrumentation.counts.add(files_read=2, read_errors=1)
+        self.instrumentation.update_metrics(self.metrics)
+        self.assertEqual(
+            self.metrics['proc_exporter_files_read']._value.get(), 5)
+        self.assertEqual(
+            self.metrics['proc_exporter_bytes_read']._value.get(), 100)
+        self.assertEqual(
+            self.metrics['proc_exporter_read_errors']._value.get(), 1)
+        self.assertEqual(
+            self.metrics['proc_exporter_processes_scanned']._value.get(), 0)
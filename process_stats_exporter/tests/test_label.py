@@ -5,8 +5,10 @@ from lxstats.process import Process
 from lxstats.testing import TestCase as LxStatsTestCase
 
 from ..label import (
-    PidLabeler,
-    CmdlineLabeler)
+    CachedLabeler,
+    CgroupLabeler,
+    CmdlineLabeler,
+    PidLabeler)
 
 
 class PidLabelerTests(TestCase):
@@ -21,6 +23,18 @@ class PidLabelerTests(TestCase):
         self.assertEqual(PidLabeler()(process), {'pid': '10'})
 
 
+class CgroupLabelerTests(TestCase):
+
+    def test_labels(self):
+        """CgroupLabeler returns the "cgroup" label."""
+        self.assertEqual(CgroupLabeler('/foo').labels(), {'cgroup'})
+
+    def test_call(self):
+        """The labeler returns a label with the cgroup name."""
+        process = Process(10, '/proc/10')
+        self.assertEqual(CgroupLabeler('/foo')(process), {'cgroup': '/foo'})
+
+
 class CmdlineLabelerTests(LxStatsTestCase):
 
     def test_labels(self):
@@ -39,6 +53,12 @@ class CmdlineLabelerTests(LxStatsTestCase):
             re.compile('(?P<foo>[0-9]+)exec(?P<bar>[a-z]+)'))
         self.assertEqual(labeler.labels(), {'foo', 'bar'})
 
+    def test_match(self):
+        """The labeler tells whether a command line matches the regexp."""
+        labeler = CmdlineLabeler(re.compile('exec'))
+        self.assertTrue(labeler.match('/path/to/exec --foo'))
+        self.assertFalse(labeler.match('/path/to/other'))
+
     def test_call(self):
         """The labeler returns a label with the process "cmd"."""
         self.make_process_file(10, 'comm', content='exec')
@@ -62,3 +82,38 @@ class CmdlineLabelerTests(LxStatsTestCase):
         process.collect_stats()
         labeler = CmdlineLabeler(re.compile('(?P<prefix>.*)/exec'))
         self.assertEqual(labeler(process), {'prefix': '/path/to'})
+
+    def test_call_not_matching(self):
+        """If the process command line doesn't match, None is returned."""
+        self.make_process_file(10, 'cmdline', content='/path/to/other')
+        process = Process(10, self.tempdir.path / '10')
+        process.collect_stats()
+        labeler = CmdlineLabeler(re.compile('(?P<prefix>.*)/exec'))
+        self.assertIsNone(labeler(process))
+
+    def test_match_labels(self):
+        """Labels are returned from a regexp match."""
+        labeler = CmdlineLabeler(re.compile('(?P<prefix>.*)/exec'))
+        match = labeler.match('/path/to/exec')
+        self.assertEqual(
+            labeler.match_labels(match, 'exec'), {'prefix': '/path/to'})
+
+    def test_match_labels_comm(self):
+        """Without groups, the process command name is returned as label."""
+        labeler = CmdlineLabeler(re.compile('exec'))
+        match = labeler.match('/path/to/exec')
+        self.assertEqual(labeler.match_labels(match, 'exec'), {'cmd': 'exec'})
+
+
+class CachedLabelerTests(TestCase):
+
+    def test_labels(self):
+        """Label names from the wrapped labeler are returned."""
+        labeler = CachedLabeler(PidLabeler(), {'pid': '10'})
+        self.assertEqual(labeler.labels(), {'pid'})
+
+    def test_call(self):
+        """The labeler returns the cached labels."""
+        labeler = CachedLabeler(PidLabeler(), {'pid': '10'})
+        process = Process(20, '/proc/20')
+        self.assertEqual(labeler(process), {'pid': '10'})
@@ -1,17 +1,29 @@
 import logging
 from operator import itemgetter
 import re
+from unittest import mock
 
 from fixtures import LoggerFixture
 from lxstats.process import Process
 from lxstats.testing import TestCase
 from prometheus_aioexporter.metric import MetricsRegistry
 
-from ..metrics import ProcessMetricsHandler
+from .. import procfs
 from ..label import (
+    CachedLabeler,
     CmdlineLabeler,
     PidLabeler,
 )
+from ..metrics import ProcessMetricsHandler
+from ..process import ProcessCacheEntry
+from ..stats import (
+    EXPENSIVE,
+    ProcBackend,
+)
+from . import (
+    deny_io,
+    make_stat,
+)
 
 
 class ProcessMetricsHandlerTests(TestCase):
@@ -34,7 +46,11 @@ class ProcessMetricsHandlerTests(TestCase):
              'proc_min_fault', 'proc_tasks_count',
              'proc_tasks_state_running', 'proc_tasks_state_sleeping',
              'proc_tasks_state_uninterruptible_sleep',
-             'proc_time_system', 'proc_time_user'])
+             'proc_time_system', 'proc_time_user',
+             'proc_exporter_phase_duration_seconds',
+             'proc_exporter_processes_scanned',
+             'proc_exporter_processes_matched', 'proc_exporter_files_read',
+             'proc_exporter_bytes_read', 'proc_exporter_read_errors'])
 
     def test_get_metric_configs_with_pids(self):
         """If PIDs are specified, metrics include a "pid" label."""
@@ -42,7 +58,49 @@ class ProcessMetricsHandlerTests(TestCase):
             logging.getLogger('test'), pids=['10', '20'],
             get_process_iterator=lambda **kwargs: self.labelers_processes)
         for metric in handler.get_metric_configs():
-            self.assertEqual(metric.config['labels'], ['pid'])
+            if not metric.name.startswith('proc_exporter_'):
+                self.assertEqual(metric.config['labels'], ['pid'])
+
+    def test_get_metric_configs_with_cgroups(self):
+        """If cgroups are specified, metrics include a "cgroup" label."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), cgroups=['foo'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        for metric in handler.get_metric_configs():
+            if not metric.name.startswith('proc_exporter_'):
+                self.assertEqual(metric.config['labels'], ['cgroup'])
+        self.assertIsNone(handler.cgroup_stats)
+
+    def test_cgroup_missing_logged_on_change(self):
+        """Missing cgroups are logged once, and when found again."""
+        path = self.tempdir.join('cgroup/foo')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), cgroups=[path],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        handler.collect()
+        handler.collect()
+        self.assertEqual(
+            self.logger.output.count('cgroup not found: {}'.format(path)), 1)
+        self.tempdir.mkfile(path='cgroup/foo/cgroup.procs')
+        handler.collect()
+        handler.collect()
+        self.assertEqual(
+            self.logger.output.count('cgroup found: {}'.format(path)), 1)
+
+    def test_cgroup_stats(self):
+        """With cgroup stats, a collector for cgroups is created."""
+        self.tempdir.mkfile(
+            path='cgroup/foo/memory.current', content='4096\n')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'),
+            cgroups=[self.tempdir.join('cgroup/foo')], cgroup_stats=True,
+            labels={'env': 'prod'},
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        registry = MetricsRegistry()
+        registry.register_additional_collector(handler.cgroup_stats)
+        content = registry.generate_metrics().decode('utf-8')
+        self.assertIn('env="prod"', content)
+        self.assertIn(' 4096.0', content)
 
     def test_update_metrics(self):
         """Metrics are updated with values from procesess."""
@@ -59,6 +117,9 @@ class ProcessMetricsHandlerTests(TestCase):
         self.make_process_file(
             20, 'stat', content=' '.join(str(i) for i in range(45, 90)))
         self.make_process_dir(20, 'task')
+        # processes from the iterator have stats collected
+        for _, process in self.labelers_processes:
+            process.collect_stats()
         handler = ProcessMetricsHandler(
             logging.getLogger('test'), cmdline_regexps=[re.compile('exec.*')],
             get_process_iterator=lambda **kwargs: self.labelers_processes)
@@ -74,6 +135,32 @@ class ProcessMetricsHandlerTests(TestCase):
         self.assertEqual(labels2, {'cmd': 'exec2'})
         self.assertEqual(value2, 54.0)
 
+    def test_update_metrics_labeler_not_matching(self):
+        """Processes not matching their labeler anymore are skipped."""
+        self.labelers_processes.extend(
+            [(CmdlineLabeler(re.compile('exec')),
+              Process(10, self.tempdir.path / '10')),
+             (CmdlineLabeler(re.compile('exec')),
+              Process(20, self.tempdir.path / '20'))])
+        self.make_process_file(10, 'cmdline', content='exec\x00')
+        self.make_process_file(10, 'comm', content='exec')
+        self.make_process_file(10, 'stat', content=make_stat(10, 100))
+        self.make_process_dir(10, 'task')
+        self.make_process_file(20, 'cmdline', content='other\x00')
+        self.make_process_file(20, 'comm', content='other')
+        self.make_process_file(20, 'stat', content=make_stat(20, 100))
+        self.make_process_dir(20, 'task')
+        for _, process in self.labelers_processes:
+            process.collect_stats()
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), cmdline_regexps=[re.compile('exec')],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        [(_, labels, _)] = metrics['proc_mem_rss']._samples()
+        self.assertEqual(labels, {'cmd': 'exec'})
+
     def test_update_metrics_with_pids(self):
         """Metrics include the "pid" label if PIDs are specified."""
         self.labelers_processes.extend(
@@ -113,3 +200,909 @@ class ProcessMetricsHandlerTests(TestCase):
         self.assertIn(
             'empty value for metric "proc_time_system" on PID 10',
             self.logger.output)
+
+    def test_collect(self):
+        """Stats are collected once for each process."""
+        process1 = Process(10, self.tempdir.path / '10')
+        process2 = Process(20, self.tempdir.path / '20')
+        labeler1 = CmdlineLabeler(re.compile('exec'))
+        labeler2 = CmdlineLabeler(re.compile('exec1'))
+        self.labelers_processes.extend(
+            [(labeler1, process1), (labeler1, process2),
+             (labeler2, process1)])
+        self.make_process_dir(10, 'task')
+        self.make_process_dir(20, 'task')
+        [(labelers1, result1, values1),
+         (labelers2, result2, values2)] = self.handler.collect()
+        self.assertEqual(labelers1, [labeler1, labeler2])
+        self.assertIs(result1, process1)
+        self.assertEqual(labelers2, [labeler1])
+        self.assertIs(result2, process2)
+        self.assertEqual(values1['proc_tasks_count'], 0)
+
+    def test_collect_with_workers(self):
+        """Stats can be collected in parallel, preserving processes order."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20'], collect_workers=4,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        self.addCleanup(handler.close)
+        for pid in range(10, 30):
+            self.labelers_processes.append(
+                (PidLabeler(), Process(pid, self.tempdir.path / str(pid))))
+            self.make_process_dir(pid, 'task/{}'.format(pid))
+            self.make_process_file(
+                pid, 'stat', content=' '.join(str(i) for i in range(45)))
+        result = handler.collect()
+        self.assertEqual(
+            [process.pid for _, process, _ in result], list(range(10, 30)))
+        self.assertEqual(
+            [values['proc_tasks_count'] for _, _, values in result],
+            [1] * 20)
+
+    def test_close(self):
+        """Closing the handler shuts down the workers pool."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], collect_workers=2)
+        executor = handler._executor
+        handler.close()
+        self.assertIsNone(handler._executor)
+        self.assertRaises(RuntimeError, executor.submit, print)
+
+    def test_backend(self):
+        """Stats are read through the backend, which is closed."""
+        backend = mock.Mock(wraps=ProcBackend())
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], backend=backend,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        process = Process(10, self.tempdir.path / '10')
+        self.labelers_processes.append((PidLabeler(), process))
+        self.make_process_dir(10, 'task/10')
+        handler.collect()
+        backend.new_cycle.assert_called_once_with()
+        backend.prefetch.assert_called_once_with([process])
+        handler.close()
+        backend.close.assert_called_once_with()
+
+    def test_update_metrics_series_cached(self):
+        """Series for each set of labels are resolved once."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], labels={'foo': 'bar'},
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        metric = metrics['proc_mem_rss']
+        metric.labels = lambda **labels: self.fail('labels resolved again')
+        handler.update_metrics(metrics)
+        [series] = metric._metrics.values()
+        self.assertEqual(series._value.get(), 23)
+
+    def test_get_metric_configs_with_series_ttl(self):
+        """If a series TTL is set, a metric for evicted series is included."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], series_ttl=2)
+        self.assertIn(
+            'proc_exporter_evicted_series',
+            [config.name for config in handler.get_metric_configs()])
+
+    def test_update_metrics_evict_stale_series(self):
+        """Series not updated within the TTL are removed."""
+        for pid in (10, 20):
+            self.make_process_file(
+                pid, 'stat', content=' '.join(str(i) for i in range(45)))
+            self.make_process_dir(pid, 'task')
+        process1 = Process(10, self.tempdir.path / '10')
+        process2 = Process(20, self.tempdir.path / '20')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20'], series_ttl=2,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        metric = metrics['proc_mem_rss']
+        self.labelers_processes.extend(
+            [(PidLabeler(), process1), (PidLabeler(), process2)])
+        handler.update_metrics(metrics)
+        self.assertCountEqual(metric._metrics, [('10',), ('20',)])
+        # process 20 exits
+        self.labelers_processes.pop()
+        handler.update_metrics(metrics)
+        self.assertCountEqual(metric._metrics, [('10',), ('20',)])
+        handler.update_metrics(metrics)
+        self.assertCountEqual(metric._metrics, [('10',)])
+        self.assertEqual(
+            metrics['proc_exporter_evicted_series']._value.get(), 12)
+
+    def test_update_metrics_series_ttl_evicted_count(self):
+        """Only series that were created are counted as evicted."""
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], series_ttl=1,
+            window_size=10,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        # no window samples are taken, so window series aren't created
+        handler.update_metrics(metrics)
+        self.labelers_processes.pop()
+        handler.update_metrics(metrics)
+        self.assertEqual(metrics['proc_mem_rss']._metrics, {})
+        self.assertEqual(
+            metrics['proc_exporter_evicted_series']._value.get(), 12)
+
+    def test_reconfigure_label_values(self):
+        """If static label values change, existing series are removed."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], labels={'env': 'prod'},
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        metric = metrics['proc_mem_rss']
+        self.assertEqual(
+            handler.reconfigure(metrics, pids=['10'], labels={'env': 'dev'}),
+            [])
+        self.assertEqual(metric._metrics, {})
+        handler.update_metrics(metrics)
+        self.assertEqual(len(metric._metrics), 1)
+        self.assertEqual(
+            metric.labels(env='dev', pid='10')._value.get(), 23)
+
+    def test_reconfigure_label_names(self):
+        """If label names change, names of metrics to recreate are returned.
+
+        MetricConfigs are updated with the new labels.
+
+        """
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        metrics = MetricsRegistry().create_metrics(
+            self.handler.get_metric_configs())
+        self.handler.update_metrics(metrics)
+        names = self.handler.reconfigure(
+            metrics, pids=['10'], labels={'env': 'prod'})
+        self.assertIn('proc_mem_rss', names)
+        self.assertNotIn('proc_exporter_files_read', names)
+        metric_configs = [
+            config for config in self.handler.get_metric_configs()
+            if config.name in names]
+        self.assertCountEqual(
+            [config.name for config in metric_configs], names)
+        for config in metric_configs:
+            self.assertCountEqual(config.config['labels'], ['env', 'pid'])
+        metrics.update(MetricsRegistry().create_metrics(metric_configs))
+        self.handler.update_metrics(metrics)
+        metric = metrics['proc_mem_rss'].labels(env='prod', pid='10')
+        self.assertEqual(metric._value.get(), 23)
+
+    def test_reconfigure_evict_untracked_series(self):
+        """Series for processes no longer tracked are removed on update."""
+        for pid in (10, 20):
+            self.make_process_file(
+                pid, 'stat', content=' '.join(str(i) for i in range(45)))
+            self.make_process_dir(pid, 'task')
+        self.labelers_processes.extend(
+            [(PidLabeler(), Process(10, self.tempdir.path / '10')),
+             (PidLabeler(), Process(20, self.tempdir.path / '20'))])
+        metrics = MetricsRegistry().create_metrics(
+            self.handler.get_metric_configs())
+        self.handler.update_metrics(metrics)
+        self.handler.reconfigure(metrics, pids=['10'])
+        self.labelers_processes.pop()
+        self.handler.update_metrics(metrics)
+        metric = metrics['proc_mem_rss']
+        self.assertCountEqual(metric._metrics, [('10',)])
+        # series are then only removed with a TTL
+        self.labelers_processes.pop()
+        self.handler.update_metrics(metrics)
+        self.assertCountEqual(metric._metrics, [('10',)])
+
+    def test_reconfigure_regexps_keep_cache(self):
+        """Cached matches for unchanged regexps are kept."""
+        foo = re.compile('foo')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), cmdline_regexps=[foo, re.compile('x')])
+        cache = handler._process_cache
+        entry = ProcessCacheEntry(
+            100, 'foo', None, [CachedLabeler(CmdlineLabeler(foo), {})])
+        cache.add(10, entry)
+        cache.add(20, ProcessCacheEntry(100, 'bar', None, []))
+        names = handler.reconfigure(
+            {}, cmdline_regexps=[re.compile('foo'), re.compile('bar')])
+        self.assertEqual(names, [])
+        self.assertIs(cache.get(10, 100), entry)
+        self.assertIsNone(cache.get(20, 100))
+
+    def test_update_metrics_counter_deltas(self):
+        """Counters are incremented by the difference from the last update."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        metrics = MetricsRegistry().create_metrics(
+            self.handler.get_metric_configs())
+        self.handler.update_metrics(metrics)
+        self.make_process_file(
+            10, 'stat',
+            content=' '.join(str(i * 2) for i in range(21)) + ' 21')
+        self.handler.update_metrics(metrics)
+        metric = metrics['proc_min_fault'].labels(pid='10')
+        self.assertEqual(metric._value.get(), 18)
+
+    def test_update_metrics_counter_process_restarted(self):
+        """Counters are reset if the process start time changes."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        metrics = MetricsRegistry().create_metrics(
+            self.handler.get_metric_configs())
+        self.handler.update_metrics(metrics)
+        self.make_process_file(
+            10, 'stat',
+            content=' '.join(str(i) for i in range(21)) + ' 1000')
+        self.handler.update_metrics(metrics)
+        metric = metrics['proc_min_fault'].labels(pid='10')
+        self.assertEqual(metric._value.get(), 18)
+
+    def test_raw_counters(self):
+        """With raw counters, cumulative values are exported directly."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], raw_counters=True,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        self.assertNotIn(
+            'proc_min_fault',
+            [config.name for config in handler.get_metric_configs()])
+        registry = MetricsRegistry()
+        metrics = registry.create_metrics(handler.get_metric_configs())
+        registry.register_additional_collector(handler.cumulative_counters)
+        handler.update_metrics(metrics)
+        handler.update_metrics(metrics)
+        content = registry.generate_metrics().decode('utf-8')
+        self.assertIn('proc_min_fault{pid="10"} 9.0', content)
+        self.assertIn('proc_mem_rss{pid="10"} 23.0', content)
+
+    def test_get_metric_configs_aggregate(self):
+        """With aggregation, non-additive metrics are not included."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], aggregate=True,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        names = [config.name for config in handler.get_metric_configs()]
+        self.assertNotIn('proc_start_time', names)
+        self.assertIn('proc_group_process_count', names)
+
+    def test_update_metrics_aggregate(self):
+        """With aggregation, values for processes in a group are summed."""
+        regexp = re.compile('(?P<app>[a-z]+)')
+        labeler = CmdlineLabeler(regexp)
+        self.labelers_processes.extend(
+            [(labeler, Process(10, self.tempdir.path / '10')),
+             (labeler, Process(20, self.tempdir.path / '20'))])
+        self.make_process_file(10, 'comm', content='exec1')
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        self.make_process_file(20, 'comm', content='exec2')
+        self.make_process_file(
+            20, 'stat', content=' '.join(str(i) for i in range(45, 90)))
+        self.make_process_dir(20, 'task')
+        for _, process in self.labelers_processes:
+            process.collect_stats()
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), cmdline_regexps=[regexp],
+            aggregate=True,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        [series] = metrics['proc_min_fault']._metrics.values()
+        self.assertEqual(series._value.get(), 9 + 54)
+        [series] = metrics['proc_mem_rss']._metrics.values()
+        self.assertEqual(series._value.get(), 23 + 68)
+        [series] = metrics['proc_group_process_count']._metrics.values()
+        self.assertEqual(series._value.get(), 2)
+        # gauges are set to the sum on each update
+        handler.update_metrics(metrics)
+        [series] = metrics['proc_mem_rss']._metrics.values()
+        self.assertEqual(series._value.get(), 23 + 68)
+        [series] = metrics['proc_min_fault']._metrics.values()
+        self.assertEqual(series._value.get(), 9 + 54)
+
+    def test_update_metrics_aggregate_missing_values(self):
+        """Metrics not reported by any process in a group are left out."""
+        regexp = re.compile('(?P<app>[a-z]+)')
+        labeler = CachedLabeler(CmdlineLabeler(regexp), {'app': 'exec'})
+        self.labelers_processes.append(
+            (labeler, Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_file(10, 'io', content='rchar: 100\n')
+        with mock.patch.object(procfs, 'read_file', deny_io):
+            handler = ProcessMetricsHandler(
+                logging.getLogger('test'), cmdline_regexps=[regexp],
+                aggregate=True, collectors=['stats', 'io'],
+                get_process_iterator=lambda **kwargs: self.labelers_processes)
+            metrics = MetricsRegistry().create_metrics(
+                handler.get_metric_configs())
+            handler.update_metrics(metrics)
+        self.assertEqual(metrics['proc_io_read_chars']._metrics, {})
+        [series] = metrics['proc_min_fault']._metrics.values()
+        self.assertEqual(series._value.get(), 9)
+
+    def make_stat(self, pid, rss=0, utime=0):
+        """Write the stat file for a process with the specified stats."""
+        fields = [str(i) for i in range(45)]
+        fields[13] = str(utime)
+        fields[23] = str(rss)
+        self.make_process_file(pid, 'stat', content=' '.join(fields))
+
+    def make_ranked_process(self, pid, rss=0, utime=0):
+        """Add a process labeled by PID, with the specified stats."""
+        self.make_stat(pid, rss=rss, utime=utime)
+        self.make_process_dir(pid, 'task')
+        self.labelers_processes.append(
+            (PidLabeler(), Process(pid, self.tempdir.path / str(pid))))
+
+    def test_top_k(self):
+        """With top K, other processes are folded in "other" series."""
+        self.make_ranked_process(10, rss=100)
+        self.make_ranked_process(20, rss=300)
+        self.make_ranked_process(30, rss=200)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20', '30'], top_k=2,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        values = {
+            labels: series._value.get()
+            for labels, series in metrics['proc_mem_rss']._metrics.items()}
+        self.assertEqual(
+            values, {('20',): 300, ('30',): 200, ('other',): 100})
+        self.assertEqual(
+            metrics['proc_exporter_folded_series']._value.get(), 1)
+        self.assertIn(
+            'series limit reached, folding 1 label sets into "other" series',
+            self.logger.output)
+
+    def test_top_k_other_summed(self):
+        """Values for folded processes are summed."""
+        self.make_ranked_process(10, rss=100, utime=10)
+        self.make_ranked_process(20, rss=300, utime=20)
+        self.make_ranked_process(30, rss=200, utime=30)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20', '30'], top_k=1,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        self.assertEqual(
+            metrics['proc_mem_rss'].labels(pid='other')._value.get(), 300)
+        self.assertEqual(
+            metrics['proc_time_user'].labels(pid='other')._value.get(), 40)
+
+    def test_top_k_by_cpu(self):
+        """Label sets can be ranked by CPU time since the last update."""
+        self.make_ranked_process(10, utime=1000)
+        self.make_ranked_process(20, utime=100)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20'], top_k=1,
+            top_by='cpu',
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        self.make_stat(10, utime=1010)
+        self.make_stat(20, utime=200)
+        handler.update_metrics(metrics)
+        # series count increments while they're selected
+        self.assertCountEqual(
+            metrics['proc_time_user']._metrics, [('20',), ('other',)])
+        self.assertEqual(
+            metrics['proc_time_user'].labels(pid='20')._value.get(), 100)
+        self.assertEqual(
+            metrics['proc_time_user'].labels(pid='other')._value.get(),
+            100 + 10)
+
+    def test_top_k_ranking_changed(self):
+        """Series for label sets no longer in the top K are removed."""
+        self.make_ranked_process(10, rss=300)
+        self.make_ranked_process(20, rss=100)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20'], top_k=1,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        self.make_stat(10, rss=50)
+        self.make_stat(20, rss=200)
+        handler.update_metrics(metrics)
+        values = {
+            labels: series._value.get()
+            for labels, series in metrics['proc_mem_rss']._metrics.items()}
+        self.assertEqual(values, {('20',): 200, ('other',): 50})
+
+    def test_max_series(self):
+        """Series are exported for label sets up to the maximum."""
+        self.make_ranked_process(10, rss=100)
+        self.make_ranked_process(20, rss=200)
+        self.make_ranked_process(30, rss=300)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20', '30'], max_series=2,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        self.assertCountEqual(
+            metrics['proc_mem_rss']._metrics, [('10',), ('20',), ('other',)])
+        self.assertEqual(
+            metrics['proc_mem_rss'].labels(pid='other')._value.get(), 300)
+
+    def test_max_series_processes_exited(self):
+        """Label sets of exited processes don't count towards the maximum."""
+        self.make_ranked_process(10, rss=100)
+        self.make_ranked_process(20, rss=200)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20', '30'], max_series=2,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        # process 10 exits
+        del self.labelers_processes[0]
+        self.make_ranked_process(30, rss=300)
+        handler.update_metrics(metrics)
+        self.assertCountEqual(
+            metrics['proc_mem_rss']._metrics, [('20',), ('30',)])
+        self.assertEqual(
+            metrics['proc_exporter_folded_series']._value.get(), 0)
+
+    def test_max_series_other_labels(self):
+        """Label sets with the same labels as "other" series are folded."""
+        self.make_process_file(10, 'cmdline', content='other\x00')
+        self.make_process_file(10, 'stat', content=make_stat(10, 100))
+        self.make_process_dir(10, 'task')
+        labeler = CachedLabeler(
+            CmdlineLabeler(re.compile('(?P<name>.*)')), {'name': 'other'})
+        self.labelers_processes.append(
+            (labeler, Process(10, self.tempdir.path / '10')))
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'),
+            cmdline_regexps=[re.compile('(?P<name>.*)')], max_series=2,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        self.assertEqual(
+            metrics['proc_exporter_folded_series']._value.get(), 1)
+        self.assertIn(
+            'process labels are the same as for "other" series',
+            self.logger.output)
+
+    def test_get_metric_configs_with_guard(self):
+        """With a series guard, the counter for folded series is included."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], max_series=10)
+        self.assertIn(
+            'proc_exporter_folded_series',
+            [config.name for config in handler.get_metric_configs()])
+
+    def test_update_metrics_collect_processes(self):
+        """Stats can be collected by worker processes."""
+        self.make_ranked_process(10, rss=100, utime=5)
+        self.make_ranked_process(11, rss=200, utime=7)
+        self.make_ranked_process(12, rss=300, utime=9)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '11', '12'],
+            collect_processes=2,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        self.addCleanup(handler.close)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        self.assertEqual(
+            {labels['pid']: value
+             for _, labels, value in metrics['proc_mem_rss']._samples()},
+            {'10': 100, '11': 200, '12': 300})
+        self.assertEqual(
+            {labels['pid']: value
+             for _, labels, value in metrics['proc_time_user']._samples()},
+            {'10': 5, '11': 7, '12': 9})
+        # counts from workers are reported
+        self.assertEqual(
+            metrics['proc_exporter_files_read']._value.get(), 3)
+
+    def test_update_metrics_collect_processes_state(self):
+        """Worker processes keep state across collections."""
+        self.make_ranked_process(10, utime=5)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], collect_processes=2,
+            rates=True, collectors=['stats'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        self.addCleanup(handler.close)
+        [(_, _, values)] = handler.collect()
+        self.assertNotIn('proc_cpu_utilisation_ratio', values)
+        self.make_stat(10, utime=50)
+        [(_, _, values)] = handler.collect()
+        self.assertGreater(values['proc_cpu_utilisation_ratio'], 0)
+
+    def test_get_metric_configs_rates(self):
+        """With rates, metrics for rates are included."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], rates=True,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        names = [config.name for config in handler.get_metric_configs()]
+        self.assertIn('proc_cpu_utilisation_ratio', names)
+        self.assertIn('proc_ctx_voluntary_rate', names)
+
+    def test_get_metric_configs_window_size(self):
+        """With a window size, metrics for gauge windows are included."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], window_size=10,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        names = [config.name for config in handler.get_metric_configs()]
+        self.assertIn('proc_mem_rss_window_max', names)
+        self.assertNotIn('proc_tasks_state_running_window_avg', names)
+        self.assertIsNone(self.handler.gauge_windows)
+
+    def test_get_metric_configs_window_size_aggregate(self):
+        """With aggregation, only averages for gauge windows are included."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], window_size=10,
+            aggregate=True,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        names = [config.name for config in handler.get_metric_configs()]
+        self.assertNotIn('proc_mem_rss_window_max', names)
+        self.assertNotIn('proc_mem_rss_window_min', names)
+        self.assertIn('proc_mem_rss_window_avg', names)
+
+    def test_update_metrics_gauge_windows(self):
+        """Gauges sampled between collections are reported."""
+        self.make_ranked_process(10, rss=100)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], window_size=10,
+            collectors=['stats'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        # no samples yet
+        self.assertEqual(metrics['proc_mem_rss_window_max']._metrics, {})
+        for rss in (300, 200):
+            self.make_stat(10, rss=rss)
+            handler.gauge_windows.sample()
+        handler.update_metrics(metrics)
+        [series] = metrics['proc_mem_rss_window_max']._metrics.values()
+        self.assertEqual(series._value.get(), 300)
+        [series] = metrics['proc_mem_rss_window_min']._metrics.values()
+        self.assertEqual(series._value.get(), 200)
+        [series] = metrics['proc_mem_rss_window_avg']._metrics.values()
+        self.assertEqual(series._value.get(), 250)
+
+    def test_update_metrics_gauge_windows_no_samples(self):
+        """Window series are removed for label sets without samples."""
+        self.make_ranked_process(10, rss=100)
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], window_size=10,
+            collectors=['stats'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.gauge_windows.track([self.labelers_processes[0][1]])
+        handler.gauge_windows.sample()
+        handler.update_metrics(metrics)
+        self.assertEqual(len(metrics['proc_mem_rss_window_avg']._metrics), 1)
+        # the process is gone
+        self.labelers_processes.clear()
+        handler.update_metrics(metrics)
+        self.assertEqual(metrics['proc_mem_rss_window_avg']._metrics, {})
+        self.assertEqual(metrics['proc_mem_rss_window_max']._metrics, {})
+
+    def test_update_metrics_gauge_windows_aggregate(self):
+        """Aggregated averages are for totals of samples in each tick."""
+        self.make_ranked_process(10, rss=100)
+        self.make_ranked_process(20, rss=0)
+        self.labelers_processes[:] = [
+            (CachedLabeler(PidLabeler(), {'pid': 'all'}), process)
+            for _, process in self.labelers_processes]
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10', '20'], window_size=10,
+            collectors=['stats'], aggregate=True,
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.gauge_windows.track(
+            [process for _, process in self.labelers_processes])
+        handler.gauge_windows.sample()
+        # process 20 is not sampled in the last tick
+        self.make_stat(20, rss=50)
+        handler.gauge_windows.sample()
+        stat_file = self.tempdir.path / '20' / 'stat'
+        stat_file.rename(self.tempdir.path / 'stat')
+        handler.gauge_windows.sample()
+        (self.tempdir.path / 'stat').rename(stat_file)
+        handler.update_metrics(metrics)
+        [series] = metrics['proc_mem_rss_window_avg']._metrics.values()
+        # totals for ticks are 100 (process 20 has rss 0), 150 and 100
+        self.assertAlmostEqual(series._value.get(), 350 / 3)
+
+    def test_update_metrics_instrumentation(self):
+        """Phase durations and counts are reported."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task')
+        metrics = MetricsRegistry().create_metrics(
+            self.handler.get_metric_configs())
+        self.handler.update_metrics(metrics)
+        histogram = metrics['proc_exporter_phase_duration_seconds']
+        self.assertCountEqual(
+            [labels for labels in histogram._metrics],
+            [('discovery',), ('collect_stats',), ('collect_sched',),
+             ('collect_tasks',), ('update',)])
+        self.assertEqual(
+            metrics['proc_exporter_processes_matched']._value.get(), 1)
+        # stat is read, status and sched are missing
+        self.assertEqual(
+            metrics['proc_exporter_files_read']._value.get(), 1)
+        self.assertEqual(
+            metrics['proc_exporter_read_errors']._value.get(), 2)
+
+    def test_get_metric_configs_collectors(self):
+        """Only metrics for the specified collectors are returned."""
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], collectors=['io'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        names = [
+            config.name for config in handler.get_metric_configs()
+            if not config.name.startswith('proc_exporter_')]
+        self.assertCountEqual(
+            names,
+            ['proc_io_read_chars', 'proc_io_write_chars',
+             'proc_io_read_syscalls', 'proc_io_write_syscalls',
+             'proc_io_read_bytes', 'proc_io_write_bytes'])
+
+    def check_pid_reused_without_stats(self, **kwargs):
+        """Check that counters are reset for a reused PID, without stats."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(10, 'stat', content=make_stat(10, 100))
+        self.make_process_file(10, 'io', content='rchar: 100\n')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], collectors=['io'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes,
+            **kwargs)
+        self.addCleanup(handler.close)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        # a new process with the same PID
+        self.make_process_file(10, 'stat', content=make_stat(10, 200))
+        self.make_process_file(10, 'io', content='rchar: 150\n')
+        handler.update_metrics(metrics)
+        metric = metrics['proc_io_read_chars'].labels(pid='10')
+        self.assertEqual(metric._value.get(), 250)
+        self.assertNotIn('proc_start_time', metrics)
+
+    def test_update_metrics_pid_reused_without_stats(self):
+        """Without the stats collector, the start time is still read."""
+        self.check_pid_reused_without_stats()
+
+    def test_update_metrics_pid_reused_without_stats_workers(self):
+        """The start time is returned by collect worker processes."""
+        self.check_pid_reused_without_stats(collect_processes=1)
+
+    def test_update_metrics_missing_values(self):
+        """Metrics not reported for a process are not updated."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_file(10, 'io', content='rchar: 100\n')
+        with mock.patch.object(procfs, 'read_file', deny_io):
+            handler = ProcessMetricsHandler(
+                logging.getLogger('test'), pids=['10'],
+                collectors=['stats', 'io'],
+                get_process_iterator=lambda **kwargs: self.labelers_processes)
+        metrics = MetricsRegistry().create_metrics(
+            handler.get_metric_configs())
+        handler.update_metrics(metrics)
+        metric = metrics['proc_io_read_chars'].labels(pid='10')
+        self.assertEqual(metric._value.get(), 0)
+        self.assertNotIn('proc_io_read_chars', self.logger.output)
+        metric = metrics['proc_min_fault'].labels(pid='10')
+        self.assertEqual(metric._value.get(), 9)
+
+    def test_collect_refresh_intervals(self):
+        """Values from expensive collectors are cached for the interval."""
+        process = Process(10, self.tempdir.path / '10')
+        self.labelers_processes.append((PidLabeler(), process))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_file(10, 'sched', content='nr_switches: 1\n')
+        self.make_process_dir(10, 'task/10')
+        now = [100.0]
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'],
+            refresh_intervals={EXPENSIVE: 10},
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        handler._clock = lambda: now[0]
+        [(_, _, values)] = handler.collect()
+        self.assertEqual(values['proc_tasks_count'], 1)
+        self.make_process_dir(10, 'task/11')
+        self.make_process_file(
+            10, 'stat',
+            content=' '.join(str(i * 2) for i in range(21)) + ' 21')
+        now[0] += 5
+        [(_, _, values)] = handler.collect()
+        # cheap collectors values are refreshed
+        self.assertEqual(values['proc_min_fault'], 18)
+        self.assertEqual(values['proc_tasks_count'], 1)
+        now[0] += 5
+        [(_, _, values)] = handler.collect()
+        self.assertEqual(values['proc_tasks_count'], 2)
+
+    def test_collect_refresh_intervals_process_changed(self):
+        """Cached values are not used for a different process."""
+        process = Process(10, self.tempdir.path / '10')
+        self.labelers_processes.append((PidLabeler(), process))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        self.make_process_dir(10, 'task/10')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'],
+            refresh_intervals={EXPENSIVE: 10},
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        handler._clock = lambda: 100.0
+        handler.collect()
+        self.make_process_dir(10, 'task/11')
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(21)) + ' 99')
+        [(_, _, values)] = handler.collect()
+        self.assertEqual(values['proc_tasks_count'], 2)
+
+    def test_collect_refresh_intervals_prune(self):
+        """Cached values for processes not found are removed."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'],
+            refresh_intervals={EXPENSIVE: 10},
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        handler.collect()
+        self.assertEqual(
+            sorted(handler._cached_values), [('sched', 10), ('tasks', 10)])
+        del self.labelers_processes[:]
+        handler.collect()
+        self.assertEqual(handler._cached_values, {})
+
+    def test_collect_prune_collectors(self):
+        """Collectors state for processes not found is removed."""
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(10, 'stat', content=make_stat(10, 100))
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], rates=True,
+            collectors=['stats'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        handler.collect()
+        [collector] = handler._collectors
+        self.assertEqual(list(collector._rates._slots), [10])
+        del self.labelers_processes[:]
+        handler.collect()
+        self.assertEqual(collector._rates._slots, {})
+
+    def make_memory_handler(self, elapsed):
+        """Return a handler for the memory collector, with a fake clock.
+
+        Collecting stats for a process takes the specified time.
+
+        """
+        self.labelers_processes.append(
+            (PidLabeler(), Process(10, self.tempdir.path / '10')))
+        self.make_process_file(10, 'stat', content=make_stat(10, 100))
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 100 kB\n')
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), pids=['10'], collectors=['smaps'],
+            get_process_iterator=lambda **kwargs: self.labelers_processes)
+        self.now = 100.0
+        handler._clock = lambda: self.now
+        timer = iter([0.0, elapsed] * 10)
+        handler._timer = lambda: next(timer)
+        return handler
+
+    def collect_pss(self, handler):
+        """Collect stats, returning the PSS for the process."""
+        [(_, _, values)] = handler.collect()
+        return values['proc_mem_pss']
+
+    def test_collect_backoff(self):
+        """Stats are refreshed less often when collecting them is slow."""
+        handler = self.make_memory_handler(0.05)
+        handler.collect()
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 200 kB\n')
+        # with a 1% duty cycle, stats are refreshed after 5 seconds
+        self.now += 4
+        self.assertEqual(self.collect_pss(handler), 100 * 1024)
+        self.now += 1
+        self.assertEqual(self.collect_pss(handler), 200 * 1024)
+
+    def test_collect_backoff_skip_read(self):
+        """Files are not read for processes that are backing off."""
+        handler = self.make_memory_handler(0.05)
+        handler.collect()
+        instrumentation = handler._instrumentation
+        instrumentation.durations.take()
+        self.now += 1
+        with mock.patch.object(
+                handler._get_collector('smaps'), 'collect') as collect:
+            handler.collect()
+        collect.assert_not_called()
+        self.assertNotIn(
+            'collect_smaps', instrumentation.durations.take())
+
+    def test_collect_backoff_fast(self):
+        """Stats are refreshed on each collection when collecting is fast."""
+        handler = self.make_memory_handler(0.0)
+        handler.collect()
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 200 kB\n')
+        self.assertEqual(self.collect_pss(handler), 200 * 1024)
+        self.assertEqual(handler._cached_values, {})
+
+    def test_collect_backoff_max(self):
+        """The refresh delay is capped."""
+        handler = self.make_memory_handler(10)
+        handler.collect()
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 200 kB\n')
+        self.now += 299
+        self.assertEqual(self.collect_pss(handler), 100 * 1024)
+        self.now += 1
+        self.assertEqual(self.collect_pss(handler), 200 * 1024)
+
+    def test_collect_backoff_pid_reused(self):
+        """Values for a previous process with the same PID are not used."""
+        handler = self.make_memory_handler(0.05)
+        handler.collect()
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 200 kB\n')
+        self.make_process_file(10, 'stat', content=make_stat(10, 200))
+        self.assertEqual(self.collect_pss(handler), 200 * 1024)
+
+    def test_collect_include_children(self):
+        """The process iterator is called to include children."""
+        calls = []
+
+        def get_process_iterator(**kwargs):
+            calls.append(kwargs['include_children'])
+            return []
+
+        handler = ProcessMetricsHandler(
+            logging.getLogger('test'), cmdline_regexps=[re.compile('foo')],
+            include_children=True, get_process_iterator=get_process_iterator)
+        handler.collect()
+        self.assertEqual(calls, [True])
@@ -2,10 +2,22 @@ import re
 
 from lxstats.testing import TestCase
 
-from ..process import get_process_iterator
+from ..instrument import Tally
+from ..procfs import FileCache
+from ..process import (
+    ProcessCache,
+    ProcessCacheEntry,
+    get_pids,
+    get_process_iterator,
+    read_cmd,
+    read_ppid_and_start_time,
+    read_start_time)
 from ..label import (
-    PidLabeler,
-    CmdlineLabeler)
+    CachedLabeler,
+    CgroupLabeler,
+    CmdlineLabeler,
+    PidLabeler)
+from . import make_stat
 
 
 class GetProcessIteratorTests(TestCase):
@@ -22,29 +34,487 @@ class GetProcessIteratorTests(TestCase):
             self.assertIsInstance(labeler, PidLabeler)
         self.assertCountEqual([process.pid for process in processes], [10, 30])
 
+    def test_process_iterator_pids_not_collected(self):
+        """Processes for PIDs are returned without collecting stats."""
+        self.make_process_file(10, 'comm', content='exec')
+        iterator = get_process_iterator(proc=self.tempdir.path, pids=[10, 20])
+        [(_, process)] = iterator
+        self.assertEqual(process.pid, 10)
+        self.assertIsNone(process.get('comm'))
+
+    def test_process_iterator_cgroups(self):
+        """An iterator yielding processes in cgroups is returned."""
+        self.tempdir.mkfile(path='cgroup/foo/cgroup.procs', content='10\n')
+        self.tempdir.mkfile(
+            path='cgroup/foo/bar/cgroup.procs', content='30\n20\n')
+        self.tempdir.mkfile(path='cgroup/baz/cgroup.procs', content='20\n')
+        counts = Tally()
+        iterator = get_process_iterator(
+            proc=self.tempdir.path, cgroups=['foo', 'baz'],
+            cgroup_root=self.tempdir.join('cgroup'), counts=counts,
+            cmdline_regexps=[re.compile('foo')])
+        result = [
+            (labeler(process), process.pid) for labeler, process in iterator]
+        self.assertEqual(
+            result,
+            [({'cgroup': '/foo'}, 10), ({'cgroup': '/foo'}, 20),
+             ({'cgroup': '/foo'}, 30), ({'cgroup': '/baz'}, 20)])
+        self.assertEqual(counts.take(), {'processes_scanned': 4})
+
+    def test_process_iterator_cgroups_labeler(self):
+        """Processes in cgroups are returned with a CgroupLabeler."""
+        self.tempdir.mkfile(path='foo/cgroup.procs', content='10\n')
+        iterator = get_process_iterator(
+            proc=self.tempdir.path, cgroups=[self.tempdir.join('foo')])
+        [(labeler, process)] = iterator
+        self.assertIsInstance(labeler, CgroupLabeler)
+        self.assertEqual(process.pid, 10)
+
+    def make_process(self, pid, cmdline, comm='exec'):
+        self.make_process_file(pid, 'cmdline', content=cmdline)
+        self.make_process_file(pid, 'comm', content=comm + '\n')
+
     def test_process_iterator_cmdline_regexps(self):
         """An iterator yielding processes with matching cmdline is returned."""
-        self.make_process_file(10, 'cmdline', content='foo\x00bar\x00')
-        self.make_process_file(20, 'cmdline', content='another\x00command\x00')
-        self.make_process_file(30, 'cmdline', content='baz\x00bza\x00')
-        self.make_process_file(40, 'cmdline', content='something\x00else\x00')
+        self.make_process(10, 'foo\x00bar\x00')
+        self.make_process(20, 'another\x00command\x00')
+        self.make_process(30, 'baz\x00bza\x00')
+        self.make_process(40, 'something\x00else\x00')
         iterator = get_process_iterator(
             proc=self.tempdir.path,
             cmdline_regexps=[re.compile('foo'), re.compile('baz')])
         labelers, processes = zip(*iterator)
         for labeler in labelers:
-            self.assertIsInstance(labeler, CmdlineLabeler)
+            self.assertIsInstance(labeler.labeler, CmdlineLabeler)
         self.assertCountEqual([process.pid for process in processes], [10, 30])
 
+    def test_process_iterator_cmdline_regexps_empty_args(self):
+        """Labels are taken from the command line used for matching."""
+        self.make_process_file(10, 'cmdline', content='foo\x00\x00bar\x00')
+        iterator = get_process_iterator(
+            proc=self.tempdir.path,
+            cmdline_regexps=[re.compile('^foo  (?P<arg>.*)$')])
+        [(labeler, process)] = iterator
+        self.assertEqual(labeler(process), {'arg': 'bar'})
+
     def test_process_iterator_cmdline_regexps_matches_args(self):
         """Cmdline regexps match the full cmdline"""
-        self.make_process_file(10, 'cmdline', content='foo\x00bar\x00')
-        self.make_process_file(20, 'cmdline', content='another\x00command\x00')
+        self.make_process(10, 'foo\x00bar\x00')
+        self.make_process(20, 'another\x00command\x00')
         iterator = get_process_iterator(
             proc=self.tempdir.path, cmdline_regexps=[re.compile('bar')])
         _, processes = zip(*iterator)
         self.assertCountEqual([process.pid for process in processes], [10])
 
+    def test_process_iterator_cmdline_regexps_multiple_matches(self):
+        """A process is returned once for each matching regexp."""
+        self.make_process(10, 'foo\x00bar\x00')
+        self.make_process(20, 'baz\x00bza\x00')
+        iterator = get_process_iterator(
+            proc=self.tempdir.path,
+            cmdline_regexps=[re.compile('foo'), re.compile('bar')])
+        labelers, processes = zip(*iterator)
+        self.assertEqual([process.pid for process in processes], [10, 10])
+        self.assertIs(processes[0], processes[1])
+        self.assertEqual(
+            [labeler.labeler.pattern for labeler in labelers], ['foo', 'bar'])
+
+    def test_process_iterator_cmdline_regexps_kernel_task(self):
+        """Kernel tasks are matched with the command name in brackets."""
+        self.make_process_file(10, 'cmdline')
+        self.make_process_file(10, 'comm', content='kthreadd\n')
+        iterator = get_process_iterator(
+            proc=self.tempdir.path,
+            cmdline_regexps=[re.compile(r'^\[kthread')])
+        _, processes = zip(*iterator)
+        self.assertEqual([process.pid for process in processes], [10])
+
+    def test_process_iterator_cmdline_regexps_comm_label(self):
+        """The command name label is read without collecting stats."""
+        self.make_process(10, 'foo\x00bar\x00', comm='foo')
+        iterator = get_process_iterator(
+            proc=self.tempdir.path, cmdline_regexps=[re.compile('foo')])
+        [(labeler, process)] = iterator
+        self.assertEqual(labeler(process), {'cmd': 'foo'})
+        self.assertIsNone(process.get('comm'))
+
+    def test_process_iterator_cmdline_regexps_process_gone(self):
+        """Processes whose command name can't be read are skipped."""
+        self.make_process_file(10, 'cmdline', content='foo\x00')
+        iterator = get_process_iterator(
+            proc=self.tempdir.path, cmdline_regexps=[re.compile('foo')])
+        self.assertEqual(list(iterator), [])
+
+    def test_process_iterator_scanned_counts(self):
+        """Scanned processes and files read for them are counted."""
+        self.make_process(10, 'foo\x00', comm='foo')
+        self.make_process(20, 'bar\x00', comm='bar')
+        counts = Tally()
+        list(
+            get_process_iterator(
+                proc=self.tempdir.path, cmdline_regexps=[re.compile('foo')],
+                counts=counts))
+        self.assertEqual(
+            counts.take(),
+            {'processes_scanned': 2, 'files_read': 3, 'bytes_read': 12})
+
+    def test_process_iterator_comm_not_read_with_groups(self):
+        """The command name isn't read for regexps with groups."""
+        self.make_process_file(10, 'cmdline', content='foo\x00')
+        counts = Tally()
+        [(labeler, process)] = get_process_iterator(
+            proc=self.tempdir.path, cmdline_regexps=[re.compile('(f.o)')],
+            counts=counts)
+        self.assertEqual(labeler(process), {'match_1': 'foo'})
+        self.assertEqual(
+            counts.take(),
+            {'processes_scanned': 1, 'files_read': 1, 'bytes_read': 4})
+
     def test_process_iterator_empty(self):
         """If no args are specified, an empty iterator is returned."""
         self.assertEqual([], list(get_process_iterator()))
+
+
+class CachedProcessIteratorTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = ProcessCache()
+
+    def make_process(self, pid, cmdline, start_time=100):
+        self.make_process_file(pid, 'cmdline', content=cmdline)
+        self.make_process_file(pid, 'comm', content='exec\n')
+        self.make_process_file(
+            pid, 'stat', content=make_stat(pid, start_time))
+
+    def get_processes(self, *regexps, file_cache=None):
+        iterator = get_process_iterator(
+            proc=self.tempdir.path,
+            cmdline_regexps=[re.compile(regexp) for regexp in regexps],
+            cache=self.cache, file_cache=file_cache)
+        return list(iterator)
+
+    def test_cached_labelers(self):
+        """Labelers with precomputed labels are returned."""
+        self.make_process(10, 'foo\x00bar\x00')
+        [(labeler, process)] = self.get_processes('(f.o)')
+        self.assertIsInstance(labeler, CachedLabeler)
+        self.assertIsInstance(labeler.labeler, CmdlineLabeler)
+        self.assertEqual(labeler(process), {'match_1': 'foo'})
+        self.assertEqual(process.pid, 10)
+
+    def test_cached_labelers_empty_args(self):
+        """Cached labels are taken from the cached command line."""
+        self.make_process(10, 'foo\x00\x00bar\x00')
+        [(labeler, process)] = self.get_processes('^foo  (?P<arg>.*)$')
+        self.assertEqual(labeler(process), {'arg': 'bar'})
+        self.assertEqual(self.cache.get(10, 100).cmd, 'foo  bar')
+
+    def test_cache_entries(self):
+        """All processes are cached, including not matching ones."""
+        self.make_process(10, 'foo\x00')
+        self.make_process(20, 'bar\x00')
+        self.get_processes('foo')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get(20, 100).labelers, [])
+
+    def test_cmdline_not_read_again(self):
+        """The command line for cached processes is not read again."""
+        self.make_process(10, 'foo\x00')
+        [(_, process1)] = self.get_processes('foo')
+        self.make_process_file(10, 'cmdline', content='bar\x00')
+        [(_, process2)] = self.get_processes('foo')
+        self.assertIs(process1, process2)
+
+    def test_start_time_changed(self):
+        """If the process start time changes, the entry is replaced."""
+        self.make_process(10, 'foo\x00')
+        self.get_processes('foo')
+        self.make_process(10, 'bar\x00', start_time=200)
+        self.assertEqual(self.get_processes('foo'), [])
+        self.assertEqual(self.cache.get(10, 200).cmd, 'bar')
+
+    def test_process_gone(self):
+        """Entries for processes that don't exist anymore are removed."""
+        self.make_process(10, 'foo\x00')
+        self.make_process(20, 'foo\x00')
+        self.get_processes('foo')
+        for name in ('cmdline', 'comm', 'stat'):
+            (self.tempdir.path / '20' / name).unlink()
+        (self.tempdir.path / '20').rmdir()
+        self.get_processes('foo')
+        self.assertEqual(len(self.cache), 1)
+        self.assertIsNone(self.cache.get(20, 100))
+
+    def test_file_cache(self):
+        """Stat files are kept open in the file cache, if passed."""
+        file_cache = FileCache(10)
+        self.addCleanup(file_cache.close)
+        self.make_process(10, 'foo\x00')
+        self.make_process(20, 'bar\x00')
+        self.get_processes('foo', file_cache=file_cache)
+        self.assertEqual(len(file_cache), 2)
+        self.make_process(10, 'bar\x00', start_time=200)
+        self.assertEqual(self.get_processes('foo', file_cache=file_cache), [])
+        self.assertEqual(self.cache.get(10, 200).cmd, 'bar')
+
+
+class ProcessTreeIteratorTests(TestCase):
+
+    def make_process(self, pid, cmdline, ppid=1, start_time=100):
+        self.make_process_file(pid, 'cmdline', content=cmdline)
+        self.make_process_file(
+            pid, 'stat', content=make_stat(pid, start_time, ppid=ppid))
+
+    def get_processes(self, *regexps, cache=None, file_cache=None):
+        iterator = get_process_iterator(
+            proc=self.tempdir.path,
+            cmdline_regexps=[re.compile(regexp) for regexp in regexps],
+            cache=cache, include_children=True, file_cache=file_cache)
+        return [
+            (labeler(process), process.pid) for labeler, process in iterator]
+
+    def test_descendants(self):
+        """Descendants of matching processes have the same labels."""
+        self.make_process(10, 'super\x00', ppid=1)
+        self.make_process(20, 'worker\x00', ppid=10)
+        self.make_process(30, 'worker\x00', ppid=10)
+        self.make_process(40, 'subworker\x00', ppid=30)
+        self.make_process(50, 'other\x00', ppid=1)
+        self.assertEqual(
+            self.get_processes('(?P<app>super)'),
+            [({'app': 'super'}, 10), ({'app': 'super'}, 20),
+             ({'app': 'super'}, 30), ({'app': 'super'}, 40)])
+
+    def test_descendants_matching(self):
+        """Descendants matching a regexp have their own labels."""
+        self.make_process(10, 'super foo\x00', ppid=1)
+        self.make_process(20, 'super bar\x00', ppid=10)
+        self.make_process(30, 'worker\x00', ppid=20)
+        self.assertEqual(
+            self.get_processes('super (?P<name>[a-z]+)'),
+            [({'name': 'foo'}, 10), ({'name': 'bar'}, 20),
+             ({'name': 'bar'}, 30)])
+
+    def test_descendants_multiple_labelers(self):
+        """Descendants are returned for each matching labeler."""
+        self.make_process(10, 'super\x00', ppid=1)
+        self.make_process(20, 'worker\x00', ppid=10)
+        processes = get_process_iterator(
+            proc=self.tempdir.path,
+            cmdline_regexps=[re.compile('(?P<a>super)'),
+                             re.compile('(?P<b>sup)')],
+            include_children=True)
+        result = [
+            (labeler(process), process) for labeler, process in processes]
+        self.assertEqual(
+            [(labels, process.pid) for labels, process in result],
+            [({'a': 'super'}, 10), ({'a': 'super'}, 20),
+             ({'b': 'sup'}, 10), ({'b': 'sup'}, 20)])
+        # the same Process is returned for both labelers
+        self.assertIs(result[1][1], result[3][1])
+
+    def test_cache(self):
+        """Matches are cached."""
+        cache = ProcessCache()
+        self.make_process(10, 'super\x00', ppid=1)
+        self.make_process(20, 'worker\x00', ppid=10)
+        self.get_processes('(?P<app>super)', cache=cache)
+        self.assertEqual(len(cache), 2)
+        self.make_process_file(10, 'cmdline', content='changed\x00')
+        self.assertEqual(
+            self.get_processes('(?P<app>super)', cache=cache),
+            [({'app': 'super'}, 10), ({'app': 'super'}, 20)])
+
+    def test_file_cache(self):
+        """Stat files are kept open in the file cache, if passed."""
+        file_cache = FileCache(10)
+        self.addCleanup(file_cache.close)
+        self.make_process(10, 'super\x00', ppid=1)
+        self.make_process(20, 'worker\x00', ppid=10)
+        self.assertEqual(
+            self.get_processes('(?P<app>super)', file_cache=file_cache),
+            [({'app': 'super'}, 10), ({'app': 'super'}, 20)])
+        self.assertEqual(len(file_cache), 2)
+
+    def test_descendants_matching_other_regexp(self):
+        """Descendants matching another regexp only have their own labels."""
+        self.make_process(10, 'super\x00', ppid=1)
+        self.make_process(20, 'worker\x00', ppid=10)
+        self.make_process(30, 'subworker\x00', ppid=20)
+        self.assertEqual(
+            self.get_processes('(?P<app>super)', '^(?P<app>worker)'),
+            [({'app': 'super'}, 10), ({'app': 'worker'}, 20),
+             ({'app': 'worker'}, 30)])
+
+    def test_cache_new_matching_descendant(self):
+        """Matching descendants found after caching have their own labels."""
+        cache = ProcessCache()
+        self.make_process(10, 'super foo\x00', ppid=1)
+        self.make_process(20, 'worker\x00', ppid=1)
+        self.get_processes(
+            'super (?P<name>[a-z]+)', '^(?P<name>worker)', cache=cache)
+        self.make_process(30, 'super bar\x00', ppid=10)
+        self.make_process(40, 'worker\x00', ppid=10)
+        self.assertEqual(
+            self.get_processes(
+                'super (?P<name>[a-z]+)', '^(?P<name>worker)', cache=cache),
+            [({'name': 'foo'}, 10), ({'name': 'worker'}, 20),
+             ({'name': 'bar'}, 30), ({'name': 'worker'}, 40)])
+
+    def test_process_gone(self):
+        """Processes without a stat file are skipped."""
+        self.make_process(10, 'super\x00', ppid=1)
+        self.make_process_file(20, 'cmdline', content='worker\x00')
+        self.assertEqual(
+            self.get_processes('(?P<app>super)'), [({'app': 'super'}, 10)])
+
+
+class ProcessCacheTests(TestCase):
+
+    def test_get(self):
+        """An entry is returned if the start time matches."""
+        cache = ProcessCache()
+        entry = ProcessCacheEntry(100, 'foo', None, [])
+        cache.add(10, entry)
+        self.assertIs(cache.get(10, 100), entry)
+
+    def test_get_not_found(self):
+        """If an entry is not found, None is returned."""
+        self.assertIsNone(ProcessCache().get(10, 100))
+
+    def test_get_different_start_time(self):
+        """If the start time is different, the entry is evicted."""
+        cache = ProcessCache()
+        cache.add(10, ProcessCacheEntry(100, 'foo', None, []))
+        self.assertIsNone(cache.get(10, 200))
+        self.assertEqual(len(cache), 0)
+
+    def test_prune(self):
+        """Entries for PIDs not in the specified ones are removed."""
+        cache = ProcessCache()
+        cache.add(10, ProcessCacheEntry(100, 'foo', None, []))
+        cache.add(20, ProcessCacheEntry(100, 'bar', None, []))
+        cache.prune([20, 30])
+        self.assertIsNone(cache.get(10, 100))
+        self.assertIsNotNone(cache.get(20, 100))
+
+    def test_update_regexps_removed(self):
+        """Labelers for removed regexps are dropped from entries."""
+        foo = CachedLabeler(CmdlineLabeler(re.compile('foo')), {})
+        other = CachedLabeler(CmdlineLabeler(re.compile('o+')), {})
+        cache = ProcessCache()
+        entry = ProcessCacheEntry(100, 'foo', None, [foo, other])
+        cache.add(10, entry)
+        cache.update_regexps(['foo'], [])
+        self.assertEqual(cache.get(10, 100).labelers, [other])
+
+    def test_update_regexps_added(self):
+        """Entries matching added regexps are evicted."""
+        cache = ProcessCache()
+        cache.add(10, ProcessCacheEntry(100, 'foo', None, []))
+        unchanged = ProcessCacheEntry(100, 'bar', None, [])
+        cache.add(20, unchanged)
+        cache.update_regexps([], [re.compile('fo+')])
+        self.assertIsNone(cache.get(10, 100))
+        self.assertIs(cache.get(20, 100), unchanged)
+
+
+class GetPidsTests(TestCase):
+
+    def test_pids(self):
+        """Sorted PIDs are returned for process directories."""
+        self.make_process_file(100, 'cmdline')
+        self.make_process_file(20, 'cmdline')
+        self.tempdir.mkdir(path='self')
+        self.assertEqual(get_pids(self.tempdir.path), [20, 100])
+
+
+class ReadCmdTests(TestCase):
+
+    def test_read_cmd(self):
+        """The command line is returned with arguments joined by spaces."""
+        self.make_process_file(10, 'cmdline', content='foo\x00bar\x00')
+        self.assertEqual(read_cmd(self.tempdir.path / '10'), 'foo bar')
+
+    def test_read_cmd_empty_args(self):
+        """Empty arguments are kept, as in the process "cmd"."""
+        self.make_process_file(10, 'cmdline', content='foo\x00\x00bar\x00')
+        self.assertEqual(read_cmd(self.tempdir.path / '10'), 'foo  bar')
+
+    def test_read_cmd_kernel_task(self):
+        """For kernel tasks, the command name in brackets is returned."""
+        self.make_process_file(10, 'cmdline')
+        self.make_process_file(10, 'comm', content='kthreadd\n')
+        self.assertEqual(read_cmd(self.tempdir.path / '10'), '[kthreadd]')
+
+    def test_read_cmd_not_found(self):
+        """If the process doesn't exist, None is returned."""
+        self.assertIsNone(read_cmd(self.tempdir.path / '10'))
+
+    def test_read_cmd_counts(self):
+        """Files and bytes read are counted."""
+        self.make_process_file(10, 'cmdline')
+        self.make_process_file(10, 'comm', content='kthreadd\n')
+        counts = Tally()
+        read_cmd(self.tempdir.path / '10', counts=counts)
+        self.assertEqual(counts.take(), {'files_read': 2, 'bytes_read': 9})
+
+
+class ReadPpidAndStartTimeTests(TestCase):
+
+    def test_read(self):
+        """The parent PID and start time are returned."""
+        self.make_process_file(
+            10, 'stat', content=make_stat(10, 1234, ppid=5))
+        self.assertEqual(
+            read_ppid_and_start_time(self.tempdir.path / '10'), (5, 1234))
+
+    def test_read_not_found(self):
+        """If the process doesn't exist, None is returned."""
+        self.assertIsNone(read_ppid_and_start_time(self.tempdir.path / '10'))
+
+    def test_read_file_cache(self):
+        """The stat file is read through the file cache, if passed."""
+        file_cache = FileCache(10)
+        self.addCleanup(file_cache.close)
+        self.make_process_file(
+            10, 'stat', content=make_stat(10, 1234, ppid=5))
+        self.assertEqual(
+            read_ppid_and_start_time(
+                self.tempdir.path / '10', file_cache=file_cache), (5, 1234))
+        self.assertEqual(len(file_cache), 1)
+
+
+class ReadStartTimeTests(TestCase):
+
+    def test_read_start_time(self):
+        """The process start time is returned."""
+        self.make_process_file(10, 'stat', content=make_stat(10, 12345))
+        self.assertEqual(read_start_time(self.tempdir.path / '10'), 12345)
+
+    def test_read_start_time_comm_with_spaces(self):
+        """The command name can contain spaces and parenthesis."""
+        self.make_process_file(
+            10, 'stat', content=make_stat(10, 12345, comm='foo) (bar'))
+        self.assertEqual(read_start_time(self.tempdir.path / '10'), 12345)
+
+    def test_read_start_time_not_found(self):
+        """If the process doesn't exist, None is returned."""
+        self.assertIsNone(read_start_time(self.tempdir.path / '10'))
+
+    def test_read_start_time_file_cache(self):
+        """The stat file is read through the file cache, if passed."""
+        file_cache = FileCache(10)
+        self.addCleanup(file_cache.close)
+        self.make_process_file(10, 'stat', content=make_stat(10, 12345))
+        self.assertEqual(
+            read_start_time(self.tempdir.path / '10', file_cache=file_cache),
+            12345)
+        self.assertEqual(len(file_cache), 1)
+
+    def test_read_start_time_counts(self):
+        """Read errors are counted."""
+        counts = Tally()
+        read_start_time(self.tempdir.path / '10', counts=counts)
+        self.assertEqual(counts.take(), {'read_errors': 1})
@@ -0,0 +1,317 @@
+from textwrap import dedent
+from unittest import mock
+
+from lxstats.process import Process
+from lxstats.testing import TestCase
+
+from .. import procfs
+from ..instrument import Tally
+from ..procfs import (
+    FileCache,
+    ProcStatsReader,
+    find_key_value,
+    parse_state,
+    parse_value,
+    read_file,
+    split_stat)
+from . import deny_io
+
+
+class ReadFileTests(TestCase):
+
+    def test_read_file(self):
+        """The file content is returned as bytes."""
+        path = self.tempdir.mkfile(content='some content')
+        self.assertEqual(read_file(path), b'some content')
+
+    def test_read_file_size(self):
+        """At most the specified size is read."""
+        path = self.tempdir.mkfile(content='some content')
+        self.assertEqual(read_file(path, size=4), b'some')
+
+
+class FileCacheTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = FileCache(2)
+        self.addCleanup(self.cache.close)
+        self.cache.new_cycle()
+
+    def test_read(self):
+        """The file content is returned, and the file is kept open."""
+        path = self.tempdir.mkfile(content='some content')
+        self.assertEqual(self.cache.read(path), b'some content')
+        self.assertEqual(len(self.cache), 1)
+
+    def test_read_again(self):
+        """Files are read again from the start, without reopening them."""
+        path = self.tempdir.mkfile(content='some content')
+        self.cache.read(path)
+        path.unlink()
+        self.assertEqual(self.cache.read(path), b'some content')
+
+    def test_read_not_found(self):
+        """An error is raised if the file is not found."""
+        self.assertRaises(
+            FileNotFoundError, self.cache.read,
+            self.tempdir.path / 'not-here')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_read_error(self):
+        """If reading fails, the file is closed."""
+        path = self.tempdir.mkdir()
+        self.assertRaises(IsADirectoryError, self.cache.read, path)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_read_stale_reopen(self):
+        """If reading a file kept open fails, the file is reopened."""
+        path = self.tempdir.mkfile(content='some content')
+        self.cache.read(path)
+        pread = procfs.os.pread
+        calls = []
+
+        def stale_pread(fd, size, offset):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise ProcessLookupError()
+            return pread(fd, size, offset)
+
+        with mock.patch.object(procfs.os, 'pread', stale_pread):
+            self.assertEqual(self.cache.read(path), b'some content')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_read_stale_reopen_fails(self):
+        """If reopening a stale file fails, the error is raised."""
+        path = self.tempdir.mkfile(content='some content')
+        self.cache.read(path)
+        path.unlink()
+        with mock.patch.object(
+                procfs.os, 'pread', side_effect=ProcessLookupError()):
+            self.assertRaises(FileNotFoundError, self.cache.read, path)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_files_evict(self):
+        """Files not read in the current cycle are evicted when full."""
+        path1 = self.tempdir.mkfile(content='one')
+        path2 = self.tempdir.mkfile(content='two')
+        path3 = self.tempdir.mkfile(content='three')
+        self.cache.read(path1)
+        self.cache.read(path2)
+        self.cache.new_cycle()
+        self.cache.read(path2)
+        self.assertEqual(self.cache.read(path3), b'three')
+        path1.unlink()
+        # path1 has been closed
+        self.assertRaises(FileNotFoundError, self.cache.read, path1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_max_files_read_uncached(self):
+        """Files are read without caching if all were read in the cycle."""
+        path1 = self.tempdir.mkfile(content='one')
+        path2 = self.tempdir.mkfile(content='two')
+        path3 = self.tempdir.mkfile(content='three')
+        self.cache.read(path1)
+        self.cache.read(path2)
+        self.assertEqual(self.cache.read(path3), b'three')
+        path3.unlink()
+        self.assertRaises(FileNotFoundError, self.cache.read, path3)
+
+    def test_new_cycle_close_unused(self):
+        """Files not read in a whole cycle are closed."""
+        path1 = self.tempdir.mkfile(content='one')
+        path2 = self.tempdir.mkfile(content='two')
+        self.cache.read(path1)
+        self.cache.read(path2)
+        self.cache.new_cycle()
+        self.cache.read(path2)
+        self.cache.new_cycle()
+        self.assertEqual(len(self.cache), 1)
+
+    def test_close(self):
+        """All files are closed."""
+        self.cache.read(self.tempdir.mkfile(content='one'))
+        self.cache.close()
+        self.assertEqual(len(self.cache), 0)
+
+
+class SplitStatTests(TestCase):
+
+    def test_split(self):
+        """Stat content is split in fields."""
+        self.assertEqual(
+            split_stat(b'10 (exec) S 1 2\n'),
+            [b'10', b'exec', b'S', b'1', b'2'])
+
+    def test_split_comm_with_spaces(self):
+        """The command name can contain spaces and parenthesis."""
+        self.assertEqual(
+            split_stat(b'10 (foo) (bar) S 1 2\n'),
+            [b'10', b'foo) (bar', b'S', b'1', b'2'])
+
+    def test_split_no_parenthesis(self):
+        """If the command name has no parenthesis, content is split."""
+        self.assertEqual(
+            split_stat(b'10 exec S 1 2'), [b'10', b'exec', b'S', b'1', b'2'])
+
+
+class ParseStateTests(TestCase):
+
+    def test_parse_state(self):
+        """The state is returned from a stat file content."""
+        self.assertEqual(parse_state(b'10 (exec) R 1 2'), b'R')
+
+    def test_parse_state_comm_with_spaces(self):
+        """The command name can contain spaces and parenthesis."""
+        self.assertEqual(parse_state(b'10 (foo) (bar) D 1 2 3'), b'D')
+
+    def test_parse_state_no_parenthesis(self):
+        """If the command name has no parenthesis, the third field is used."""
+        self.assertEqual(parse_state(b'10 exec S 1 2 3'), b'S')
+
+    def test_parse_state_empty(self):
+        """If the content is truncated, None is returned."""
+        self.assertIsNone(parse_state(b'10 (exec)'))
+
+
+class FindKeyValueTests(TestCase):
+
+    def test_find(self):
+        """The value for a key is returned."""
+        content = b'Name:\tbash\nVmHWM:\t  100 kB\nVmRSS:\t  50 kB\n'
+        self.assertEqual(find_key_value(content, b'VmHWM'), b'100 kB')
+
+    def test_find_first_line(self):
+        """The key can be on the first line."""
+        self.assertEqual(find_key_value(b'VmHWM: 100 kB', b'VmHWM'), b'100 kB')
+
+    def test_find_spaces_before_separator(self):
+        """Spaces are allowed between the key and the separator."""
+        content = b'se.exec_start    :    12.3\nnr_switches    :    10\n'
+        self.assertEqual(find_key_value(content, b'nr_switches'), b'10')
+
+    def test_find_not_found(self):
+        """If the key is not found, None is returned."""
+        self.assertIsNone(find_key_value(b'Name:\tbash\n', b'VmHWM'))
+
+    def test_find_key_prefix(self):
+        """Keys that have the searched key as prefix are not matched."""
+        content = b'nr_switches_total: 10\nnr_switches: 20\n'
+        self.assertEqual(find_key_value(content, b'nr_switches'), b'20')
+
+    def test_find_key_not_at_line_start(self):
+        """Keys are only matched at the start of a line."""
+        content = b'se.nr_switches: 10\nnr_switches: 20\n'
+        self.assertEqual(find_key_value(content, b'nr_switches'), b'20')
+
+
+class ParseValueTests(TestCase):
+
+    def test_int(self):
+        """Integer values are converted."""
+        self.assertEqual(parse_value(b'10'), 10)
+
+    def test_float(self):
+        """Float values are converted."""
+        self.assertEqual(parse_value(b'1.5'), 1.5)
+
+    def test_kb(self):
+        """Values in kB are converted to bytes."""
+        self.assertEqual(parse_value(b'100 kB'), 102400)
+
+    def test_not_numeric(self):
+        """None is returned for non-numeric values."""
+        self.assertIsNone(parse_value(b'bash'))
+
+    def test_none(self):
+        """None is returned for missing values."""
+        self.assertIsNone(parse_value(None))
+
+
+class ProcStatsReaderTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.process = Process(10, self.tempdir.path / '10')
+
+    def test_files(self):
+        """Only files for the requested stats are read."""
+        reader = ProcStatsReader(['stat.utime', 'sched.nr_switches'])
+        self.assertEqual(reader.files(), ['sched', 'stat'])
+
+    def test_unsupported_stat(self):
+        """An error is raised for unsupported files."""
+        self.assertRaises(ValueError, ProcStatsReader, ['statm.size'])
+
+    def test_invalid_stat_field(self):
+        """An error is raised for unknown stat fields."""
+        self.assertRaises(ValueError, ProcStatsReader, ['stat.unknown'])
+
+    def test_read(self):
+        """Stats are read from files."""
+        self.make_process_file(
+            10, 'stat', content='10 (some exec) S ' + ' '.join(
+                str(i) for i in range(3, 45)))
+        self.make_process_file(10, 'status', content='VmHWM:\t  100 kB\n')
+        self.make_process_file(
+            10, 'sched',
+            content=dedent(
+                '''\
+                exec (10, #threads: 1)
+                -----------------------
+                se.exec_start          :       1234.5
+                nr_voluntary_switches  :         2000
+                '''))
+        reader = ProcStatsReader(
+            ['stat.comm', 'stat.state', 'stat.utime', 'status.VmHWM',
+             'sched.se.exec_start', 'sched.nr_voluntary_switches'])
+        self.assertEqual(
+            reader.read(self.process),
+            {'stat.comm': 'some exec',
+             'stat.state': 'S',
+             'stat.utime': 13,
+             'status.VmHWM': 102400,
+             'sched.se.exec_start': 1234.5,
+             'sched.nr_voluntary_switches': 2000})
+
+    def test_read_file_cache(self):
+        """Files can be read through a FileCache."""
+        cache = FileCache(10)
+        self.addCleanup(cache.close)
+        self.make_process_file(10, 'status', content='VmHWM:\t  100 kB\n')
+        reader = ProcStatsReader(['status.VmHWM'], file_cache=cache)
+        self.assertEqual(reader.read(self.process), {'status.VmHWM': 102400})
+        self.assertEqual(len(cache), 1)
+
+    def test_read_missing(self):
+        """Stats for missing files or fields are None."""
+        self.make_process_file(10, 'stat', content='10 (exec) S')
+        reader = ProcStatsReader(['stat.utime', 'status.VmHWM'])
+        self.assertEqual(
+            reader.read(self.process),
+            {'stat.utime': None, 'status.VmHWM': None})
+
+    def test_read_counts(self):
+        """Files and bytes read and read errors are counted."""
+        content = '10 (exec) S ' + ' '.join(str(i) for i in range(3, 45))
+        self.make_process_file(10, 'stat', content=content)
+        counts = Tally()
+        reader = ProcStatsReader(
+            ['stat.utime', 'status.VmHWM'], counts=counts)
+        reader.read(self.process)
+        self.assertEqual(
+            counts.take(),
+            {'files_read': 1, 'bytes_read': len(content), 'read_errors': 1})
+
+    def test_read_permission_denied(self):
+        """Stats from files that can't be read are not included."""
+        content = '10 (exec) S ' + ' '.join(str(i) for i in range(3, 45))
+        self.make_process_file(10, 'stat', content=content)
+        self.make_process_file(10, 'io', content='rchar: 100\n')
+        counts = Tally()
+        with mock.patch.object(procfs, 'read_file', deny_io):
+            reader = ProcStatsReader(
+                ['stat.utime', 'io.rchar'], counts=counts)
+        self.assertEqual(reader.read(self.process), {'stat.utime': 13})
+        self.assertEqual(counts.take()['read_errors'], 1)
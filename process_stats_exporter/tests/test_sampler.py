@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+from fixtures import LoggerFixture
+from lxstats.testing import TestCase
+from prometheus_aioexporter.metric import MetricsRegistry
+
+from ..sampler import MetricsSampler
+
+
+class MetricsSamplerTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture(level=logging.DEBUG))
+        self.updates = []
+        self.sampler = MetricsSampler(
+            logging.getLogger('test'), self.updates.append, 0.01)
+        self.sampler._time = lambda: 1234.5
+        self.metrics = MetricsRegistry().create_metrics(
+            self.sampler.metrics())
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_metrics(self):
+        """The sampler has a metric for the last sample timestamp."""
+        self.assertEqual(
+            [metric.name for metric in self.sampler.metrics()],
+            ['proc_exporter_last_sample_timestamp'])
+
+    def test_sample(self):
+        """The update handler is called and the timestamp is updated."""
+        self.sampler._metrics = self.metrics
+        self.sampler.sample()
+        self.assertEqual(self.updates, [self.metrics])
+        metric = self.metrics['proc_exporter_last_sample_timestamp']
+        self.assertEqual(metric._value.get(), 1234.5)
+
+    def test_sample_error(self):
+        """Errors updating metrics are logged."""
+        def update_handler(metrics):
+            raise Exception('boom')
+
+        sampler = MetricsSampler(
+            logging.getLogger('test'), update_handler, 0.01)
+        sampler._metrics = self.metrics
+        sampler.sample()
+        self.assertIn('failed updating metrics', self.logger.output)
+        metric = self.metrics['proc_exporter_last_sample_timestamp']
+        self.assertEqual(metric._value.get(), 0)
+
+    def test_sample_on_sample(self):
+        """The on_sample callable is called after each sample."""
+        calls = []
+        sampler = MetricsSampler(
+            logging.getLogger('test'), self.updates.append, 0.01,
+            on_sample=lambda: calls.append(self.updates[:]))
+        sampler._metrics = self.metrics
+        sampler.sample()
+        self.assertEqual(calls, [[self.metrics]])
+
+    def test_sample_error_no_on_sample(self):
+        """The on_sample callable is not called if updating metrics fails."""
+        def update_handler(metrics):
+            raise Exception('boom')
+
+        calls = []
+        sampler = MetricsSampler(
+            logging.getLogger('test'), update_handler, 0.01,
+            on_sample=lambda: calls.append(True))
+        sampler.sample()
+        self.assertEqual(calls, [])
+
+    def test_start_stop(self):
+        """Metrics are updated periodically until sampling is stopped."""
+        async def run():
+            self.sampler.start(self.metrics)
+            await asyncio.sleep(0.035)
+            await self.sampler.stop()
+
+        self.loop.run_until_complete(run())
+        self.assertGreaterEqual(len(self.updates), 3)
+        count = len(self.updates)
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertEqual(len(self.updates), count)
+
+    def test_stop_not_started(self):
+        """Stopping a sampler that's not started is a no-op."""
+        self.loop.run_until_complete(self.sampler.stop())
+        self.assertEqual(self.updates, [])
@@ -1,18 +1,148 @@
+import os
 from textwrap import dedent
-from unittest import TestCase
+from unittest import (
+    TestCase,
+    mock)
 
 from lxstats.testing import TestCase as LxStatsTestCase
 from lxstats.process import Process
 
+from .. import procfs
+from ..instrument import Tally
 from ..stats import (
+    CHEAP,
+    CLOCK_TICKS,
+    EXPENSIVE,
+    ProcessIOStatsCollector,
+    ProcessMemoryStatsCollector,
+    ProcessSchedStatsCollector,
     ProcessStatsCollector,
     ProcessTasksStatsCollector,
     StatsCollector,
+    TaskstatsBackend,
 )
+from . import deny_io
+
+
+class FakeTaskstatsConnection:
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.requests = []
+        self.closed = False
+
+    def get(self, pids):
+        self.requests.append(list(pids))
+        return {pid: self.tasks[pid] for pid in pids if pid in self.tasks}
+
+    def close(self):
+        self.closed = True
+
+
+class TaskstatsBackendTests(LxStatsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.connection = FakeTaskstatsConnection(
+            {10: {
+                'ac_utime': 2500000, 'ac_stime': 1000000, 'ac_minflt': 40,
+                'ac_majflt': 50, 'hiwater_rss': 100, 'nvcsw': 20,
+                'nivcsw': 30, 'read_char': 1024, 'write_char': 2048,
+                'read_syscalls': 3072, 'write_syscalls': 4096,
+                'read_bytes': 500, 'write_bytes': 600}})
+        self.backend = TaskstatsBackend(connection=self.connection)
+        self.process = Process(10, self.tempdir.path / '10')
+
+    def test_collect(self):
+        """Stats are read from taskstats, and other ones from /proc."""
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        collector = ProcessStatsCollector(backend=self.backend)
+        values = collector.collect(self.process)
+        self.assertEqual(
+            values['proc_time_user'], 2.5 * CLOCK_TICKS)
+        self.assertEqual(values['proc_time_system'], CLOCK_TICKS)
+        self.assertEqual(values['proc_mem_rss_max'], 102400)
+        self.assertEqual(values['proc_min_fault'], 40)
+        self.assertEqual(values['proc_maj_fault'], 50)
+        self.assertEqual(values['proc_mem_rss'], 23)
+        self.assertEqual(values['proc_start_time'], 21)
+
+    def test_collect_io(self):
+        """I/O stats are read from taskstats, without the io file."""
+        # the process has no io file
+        collector = ProcessIOStatsCollector(backend=self.backend)
+        self.assertEqual(
+            collector.collect(self.process),
+            {'proc_io_read_chars': 1024,
+             'proc_io_write_chars': 2048,
+             'proc_io_read_syscalls': 3072,
+             'proc_io_write_syscalls': 4096,
+             'proc_io_read_bytes': 500,
+             'proc_io_write_bytes': 600})
+
+    def test_collect_single_request(self):
+        """Stats from all collectors for a process need a single request."""
+        self.make_process_file(
+            10, 'stat', content=' '.join(str(i) for i in range(45)))
+        collectors = [
+            ProcessStatsCollector(backend=self.backend),
+            ProcessSchedStatsCollector(backend=self.backend),
+            ProcessIOStatsCollector(backend=self.backend)]
+        for collector in collectors:
+            collector.collect(self.process)
+        self.assertEqual(self.connection.requests, [[10]])
+
+    def test_collect_sched(self):
+        """Scheduler stats are read from taskstats."""
+        collector = ProcessSchedStatsCollector(backend=self.backend)
+        self.assertEqual(
+            collector.collect(self.process),
+            {'proc_ctx_involuntary': 30, 'proc_ctx_voluntary': 20})
+
+    def test_collect_missing(self):
+        """Stats for processes not found are None."""
+        collector = ProcessSchedStatsCollector(backend=self.backend)
+        self.assertEqual(
+            collector.collect(Process(20, self.tempdir.path / '20')),
+            {'proc_ctx_involuntary': None, 'proc_ctx_voluntary': None})
+
+    def test_read_once_per_cycle(self):
+        """Stats for a process are requested once per cycle."""
+        collector = ProcessSchedStatsCollector(backend=self.backend)
+        collector.collect(self.process)
+        collector.collect(self.process)
+        self.assertEqual(self.connection.requests, [[10]])
+        self.backend.new_cycle()
+        collector.collect(self.process)
+        self.assertEqual(self.connection.requests, [[10], [10]])
+
+    def test_prefetch(self):
+        """Stats for processes can be requested together."""
+        collector = ProcessSchedStatsCollector(backend=self.backend)
+        process = Process(20, self.tempdir.path / '20')
+        self.backend.prefetch([self.process, process])
+        collector.collect(self.process)
+        collector.collect(process)
+        self.assertEqual(self.connection.requests, [[10, 20]])
+
+    def test_check(self):
+        """Checking the backend sends a request for the current process."""
+        self.backend.check()
+        self.assertEqual(self.connection.requests, [[os.getpid()]])
+
+    def test_close(self):
+        """Closing the backend closes the connection."""
+        self.backend.close()
+        self.assertTrue(self.connection.closed)
 
 
 class StatsCollectorTests(TestCase):
 
+    def test_cost(self):
+        """Collectors are cheap by default."""
+        self.assertEqual(StatsCollector().cost, CHEAP)
+
     def test_labels_empty(self):
         """By default, no label is applied."""
         collector = StatsCollector()
@@ -48,9 +178,7 @@ class ProcessStatsCollectorTests(LxStatsTestCase):
              'proc_mem_rss',
              'proc_mem_rss_max',
              'proc_maj_fault',
-             'proc_min_fault',
-             'proc_ctx_involuntary',
-             'proc_ctx_voluntary'])
+             'proc_min_fault'])
 
     def test_collect(self):
         """Stats for a process can be collected."""
@@ -59,13 +187,6 @@ class ProcessStatsCollectorTests(LxStatsTestCase):
         self.make_process_file(
             pid, 'stat', content=' '.join(str(i) for i in range(45)))
         self.make_process_file(pid, 'status', content='VmHWM: 100 kB')
-        self.make_process_file(
-            pid, 'sched',
-            content=dedent(
-                '''\
-                nr_involuntary_switches : 1000
-                nr_voluntary_switches : 2000
-                '''))
         self.assertEqual(
             self.collector.collect(process),
             {'proc_time_user': 13,
@@ -74,9 +195,191 @@ class ProcessStatsCollectorTests(LxStatsTestCase):
              'proc_mem_rss_max': 102400,
              'proc_maj_fault': 11,
              'proc_min_fault': 9,
-             'proc_ctx_involuntary': 1000,
+             'proc_start_time': 21})
+
+    def make_stat(self, pid, utime, stime, minflt, start_time=100):
+        """Write the stat file for a process with the specified stats."""
+        fields = [str(i) for i in range(45)]
+        fields[9] = str(minflt)
+        fields[13] = str(utime)
+        fields[14] = str(stime)
+        fields[21] = str(start_time)
+        self.make_process_file(pid, 'stat', content=' '.join(fields))
+
+    def test_metrics_rates(self):
+        """With rates, metrics for rates are also returned."""
+        collector = ProcessStatsCollector(labels=['pid'], rates=True)
+        metrics = {metric.name: metric for metric in collector.metrics()}
+        for name in (
+                'proc_cpu_utilisation_ratio',
+                'proc_cpu_utilisation_normalised_ratio',
+                'proc_maj_fault_rate', 'proc_min_fault_rate'):
+            self.assertEqual(metrics[name].type, 'gauge')
+            self.assertEqual(metrics[name].config['labels'], ['pid'])
+
+    def test_collect_rates(self):
+        """Rates are computed between consecutive collections."""
+        timestamps = iter([10.0, 12.0])
+        collector = ProcessStatsCollector(rates=True)
+        collector._clock = lambda: next(timestamps)
+        process = Process(10, self.tempdir.path / '10')
+        self.make_stat(10, utime=100, stime=100, minflt=10)
+        values = collector.collect(process)
+        self.assertNotIn('proc_cpu_utilisation_ratio', values)
+        self.assertNotIn('proc_min_fault_rate', values)
+        self.make_stat(
+            10, utime=100 + 3 * CLOCK_TICKS, stime=100 + CLOCK_TICKS,
+            minflt=50)
+        values = collector.collect(process)
+        self.assertEqual(values['proc_cpu_utilisation_ratio'], 2.0)
+        self.assertEqual(values['proc_min_fault_rate'], 20.0)
+        self.assertEqual(values['proc_maj_fault_rate'], 0.0)
+
+    def test_collect_rates_normalised(self):
+        """The normalised CPU utilisation is divided by the CPU count."""
+        timestamps = iter([10.0, 11.0])
+        collector = ProcessStatsCollector(rates=True)
+        collector._clock = lambda: next(timestamps)
+        process = Process(10, self.tempdir.path / '10')
+        self.make_stat(10, utime=0, stime=0, minflt=0)
+        collector.collect(process)
+        self.make_stat(10, utime=CLOCK_TICKS, stime=0, minflt=0)
+        values = collector.collect(process)
+        self.assertAlmostEqual(
+            values['proc_cpu_utilisation_normalised_ratio'],
+            1 / (os.cpu_count() or 1))
+
+    def test_collect_rates_pid_reused(self):
+        """Rates are not reported for a different process with a PID."""
+        timestamps = iter([10.0, 12.0])
+        collector = ProcessStatsCollector(rates=True)
+        collector._clock = lambda: next(timestamps)
+        process = Process(10, self.tempdir.path / '10')
+        self.make_stat(10, utime=100, stime=100, minflt=10)
+        collector.collect(process)
+        self.make_stat(10, utime=10, stime=10, minflt=20, start_time=200)
+        values = collector.collect(process)
+        self.assertNotIn('proc_cpu_utilisation_ratio', values)
+        self.assertNotIn('proc_min_fault_rate', values)
+
+    def test_prune_rates(self):
+        """Values for rates are discarded for processes not found."""
+        collector = ProcessStatsCollector(rates=True)
+        self.make_stat(10, utime=100, stime=100, minflt=10)
+        collector.collect(Process(10, self.tempdir.path / '10'))
+        collector.prune([20])
+        self.assertEqual(len(collector._rates), 0)
+
+
+class ProcessSchedStatsCollectorTests(LxStatsTestCase):
+
+    def test_metrics(self):
+        """The list of scheduler metrics is returned."""
+        metrics = ProcessSchedStatsCollector().metrics()
+        self.assertEqual(
+            [metric.name for metric in metrics],
+            ['proc_ctx_involuntary', 'proc_ctx_voluntary'])
+
+    def test_collect(self):
+        """Scheduler stats for a process can be collected."""
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        self.make_process_file(
+            pid, 'sched',
+            content=dedent(
+                '''\
+                nr_involuntary_switches : 1000
+                nr_voluntary_switches : 2000
+                '''))
+        self.assertEqual(
+            ProcessSchedStatsCollector().collect(process),
+            {'proc_ctx_involuntary': 1000,
              'proc_ctx_voluntary': 2000})
 
+    def test_collect_rates(self):
+        """Context switch rates are computed between collections."""
+        timestamps = iter([10.0, 15.0])
+        collector = ProcessSchedStatsCollector(rates=True)
+        collector._clock = lambda: next(timestamps)
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        self.make_process_file(
+            pid, 'stat', content=' '.join(str(i) for i in range(45)))
+        for involuntary, voluntary in ((1000, 2000), (1100, 2500)):
+            self.make_process_file(
+                pid, 'sched',
+                content=dedent(
+                    '''\
+                    nr_involuntary_switches : {}
+                    nr_voluntary_switches : {}
+                    '''.format(involuntary, voluntary)))
+            values = collector.collect(process)
+        self.assertEqual(
+            values,
+            {'proc_ctx_involuntary': 1100,
+             'proc_ctx_voluntary': 2500,
+             'proc_ctx_involuntary_rate': 20.0,
+             'proc_ctx_voluntary_rate': 100.0})
+
+    def test_cost(self):
+        """The collector is expensive."""
+        self.assertEqual(ProcessSchedStatsCollector.cost, EXPENSIVE)
+
+
+class ProcessIOStatsCollectorTests(LxStatsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.collector = ProcessIOStatsCollector()
+
+    def test_metrics(self):
+        """The list of I/O metrics is returned."""
+        metrics = self.collector.metrics()
+        self.assertEqual(
+            [metric.name for metric in metrics],
+            ['proc_io_read_chars',
+             'proc_io_write_chars',
+             'proc_io_read_syscalls',
+             'proc_io_write_syscalls',
+             'proc_io_read_bytes',
+             'proc_io_write_bytes'])
+        for metric in metrics:
+            self.assertEqual(metric.type, 'counter')
+
+    def test_collect(self):
+        """I/O stats for a process can be collected."""
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        self.make_process_file(
+            pid, 'io',
+            content=dedent(
+                '''\
+                rchar: 1000
+                wchar: 2000
+                syscr: 30
+                syscw: 40
+                read_bytes: 4096
+                write_bytes: 8192
+                cancelled_write_bytes: 0
+                '''))
+        self.assertEqual(
+            self.collector.collect(process),
+            {'proc_io_read_chars': 1000,
+             'proc_io_write_chars': 2000,
+             'proc_io_read_syscalls': 30,
+             'proc_io_write_syscalls': 40,
+             'proc_io_read_bytes': 4096,
+             'proc_io_write_bytes': 8192})
+
+    def test_collect_permission_denied(self):
+        """If the file can't be read, no metrics are returned."""
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        self.make_process_file(pid, 'io', content='rchar: 1000\n')
+        with mock.patch.object(procfs, 'read_file', deny_io):
+            collector = ProcessIOStatsCollector()
+        self.assertEqual(collector.collect(process), {})
+
 
 class ProcessTasksStatsCollectorTests(LxStatsTestCase):
 
@@ -117,3 +420,205 @@ class ProcessTasksStatsCollectorTests(LxStatsTestCase):
              'proc_tasks_state_running': 2,
              'proc_tasks_state_sleeping': 0,
              'proc_tasks_state_uninterruptible_sleep': 1})
+
+    def test_collect_comm_with_parenthesis(self):
+        """The state is found after the command name."""
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        self.make_process_dir(pid, 'task/123')
+        self.tempdir.mkfile(
+            path='{}/task/123/stat'.format(pid),
+            content='123 (foo) R (bar) S 1 2 3')
+        self.assertEqual(
+            self.collector.collect(process),
+            {'proc_tasks_count': 1,
+             'proc_tasks_state_running': 0,
+             'proc_tasks_state_sleeping': 1,
+             'proc_tasks_state_uninterruptible_sleep': 0})
+
+    def test_collect_process_gone(self):
+        """If the process is gone, values are None."""
+        process = Process(10, self.tempdir.path / '10')
+        self.assertEqual(
+            self.collector.collect(process),
+            {'proc_tasks_count': None,
+             'proc_tasks_state_running': None,
+             'proc_tasks_state_sleeping': None,
+             'proc_tasks_state_uninterruptible_sleep': None})
+
+    def test_collect_sample(self):
+        """States are extrapolated from a sample of tasks."""
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        for tid in range(100, 110):
+            self.make_process_dir(pid, 'task/{}'.format(tid))
+            state = 'D' if tid < 102 else 'S'
+            self.tempdir.mkfile(
+                path='{}/task/{}/stat'.format(pid, tid),
+                content='{} (exec) {} 1 2'.format(tid, state))
+        collector = ProcessTasksStatsCollector(sample_size=5)
+        collector._sample = lambda tids, size: sorted(tids)[:size]
+        self.assertEqual(
+            collector.collect(process),
+            {'proc_tasks_count': 10,
+             'proc_tasks_state_running': 0,
+             'proc_tasks_state_sleeping': 6,
+             'proc_tasks_state_uninterruptible_sleep': 4})
+
+    def test_collect_sample_not_needed(self):
+        """If tasks are less than the sample size, all are read."""
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        self.make_process_dir(pid, 'task/123')
+        self.tempdir.mkfile(
+            path='{}/task/123/stat'.format(pid), content='123 (exec) R')
+        collector = ProcessTasksStatsCollector(sample_size=5)
+        collector._sample = lambda tids, size: self.fail('sampled')
+        self.assertEqual(collector.collect(process)['proc_tasks_count'], 1)
+
+    def test_collect_counts(self):
+        """Files and bytes read and read errors are counted."""
+        pid = 10
+        process = Process(pid, self.tempdir.path / str(pid))
+        self.make_process_dir(pid, 'task/123')
+        self.make_process_dir(pid, 'task/456')
+        self.tempdir.mkfile(
+            path='{}/task/123/stat'.format(pid), content='123 (exec) R')
+        counts = Tally()
+        collector = ProcessTasksStatsCollector(counts=counts)
+        collector.collect(process)
+        self.assertEqual(
+            counts.take(),
+            {'files_read': 1, 'bytes_read': 12, 'read_errors': 1})
+
+
+class ProcessMemoryStatsCollectorTests(LxStatsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.process = Process(10, self.tempdir.path / '10')
+        self.collector = self.make_collector()
+
+    def make_collector(self, **kwargs):
+        """Return a collector, checking fields in the test process files."""
+        with mock.patch.object(
+                ProcessMemoryStatsCollector, '_self_dir',
+                str(self.tempdir.path / '10')):
+            return ProcessMemoryStatsCollector(**kwargs)
+
+    def test_metrics(self):
+        """The list of memory metrics is returned."""
+        metrics = self.collector.metrics()
+        self.assertEqual(
+            [metric.name for metric in metrics],
+            ['proc_mem_pss', 'proc_mem_uss', 'proc_mem_swap_pss'])
+
+    def test_metrics_no_swap_pss(self):
+        """If the kernel doesn't report SwapPss, the metric is not exported."""
+        self.make_process_file(
+            10, 'smaps_rollup', content='Pss: 100 kB\nSwap: 0 kB\n')
+        collector = self.make_collector()
+        self.assertEqual(
+            [metric.name for metric in collector.metrics()],
+            ['proc_mem_pss', 'proc_mem_uss'])
+
+    def test_metrics_swap_pss_from_smaps(self):
+        """Without smaps_rollup, SwapPss is looked up in the smaps file."""
+        self.make_process_file(
+            10, 'smaps', content='Pss: 100 kB\nSwapPss: 0 kB\n')
+        collector = self.make_collector()
+        self.assertEqual(
+            [metric.name for metric in collector.metrics()],
+            ['proc_mem_pss', 'proc_mem_uss', 'proc_mem_swap_pss'])
+
+    def test_collect_rollup(self):
+        """Stats are read from the smaps_rollup file."""
+        self.make_process_file(
+            10, 'smaps_rollup',
+            content=dedent(
+                '''\
+                00400000-7ffc5e7fe000 ---p 00000000 00:00 0   [rollup]
+                Rss:                2000 kB
+                Pss:                1000 kB
+                Shared_Clean:        500 kB
+                Private_Clean:       100 kB
+                Private_Dirty:       200 kB
+                Swap:                 50 kB
+                SwapPss:              10 kB
+                '''))
+        self.assertEqual(
+            self.collector.collect(self.process),
+            {'proc_mem_pss': 1000 * 1024,
+             'proc_mem_uss': 300 * 1024,
+             'proc_mem_swap_pss': 10 * 1024})
+
+    def test_collect_smaps(self):
+        """If smaps_rollup is not available, stats are summed from smaps."""
+        self.make_process_file(
+            10, 'smaps',
+            content=dedent(
+                '''\
+                00400000-00401000 r-xp 00000000 08:01 1234   /bin/exec
+                Pss:                 100 kB
+                Private_Clean:        10 kB
+                Private_Dirty:        20 kB
+                SwapPss:               1 kB
+                VmFlags: rd ex mr mw me dw
+                00601000-00602000 rw-p 00001000 08:01 1234   /bin/exec
+                Pss:                 200 kB
+                Private_Clean:         0 kB
+                Private_Dirty:        40 kB
+                SwapPss:               2 kB
+                VmFlags: rd wr mr mw me dw ac
+                '''))
+        self.assertEqual(
+            self.collector.collect(self.process),
+            {'proc_mem_pss': 300 * 1024,
+             'proc_mem_uss': 70 * 1024,
+             'proc_mem_swap_pss': 3 * 1024})
+        self.assertFalse(self.collector._has_rollup)
+
+    def test_collect_missing_field(self):
+        """Values for fields not found are None."""
+        self.make_process_file(
+            10, 'smaps_rollup', content='Pss: 100 kB\nPrivate_Clean: 1 kB\n')
+        self.assertEqual(
+            self.collector.collect(self.process),
+            {'proc_mem_pss': 100 * 1024,
+             'proc_mem_uss': None,
+             'proc_mem_swap_pss': None})
+
+    def test_collect_no_swap_pss(self):
+        """If the kernel doesn't report SwapPss, no value is returned."""
+        self.make_process_file(
+            10, 'smaps_rollup',
+            content='Pss: 100 kB\nPrivate_Clean: 1 kB\nPrivate_Dirty: 2 kB\n')
+        collector = self.make_collector()
+        self.assertEqual(
+            collector.collect(self.process),
+            {'proc_mem_pss': 100 * 1024, 'proc_mem_uss': 3 * 1024})
+
+    def test_collect_process_gone(self):
+        """If the process is gone, values are None."""
+        self.assertEqual(
+            self.collector.collect(self.process),
+            {'proc_mem_pss': None,
+             'proc_mem_uss': None,
+             'proc_mem_swap_pss': None})
+        self.assertTrue(self.collector._has_rollup)
+
+    def test_collect_permission_denied(self):
+        """If files can't be read, no metrics are returned."""
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 100 kB\n')
+        with mock.patch.object(
+                self.collector, '_read_file',
+                side_effect=PermissionError(13, 'Permission denied')):
+            self.assertEqual(self.collector.collect(self.process), {})
+
+    def test_collect_not_cached(self):
+        """Stats are read on each collection."""
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 100 kB\n')
+        self.collector.collect(self.process)
+        self.make_process_file(10, 'smaps_rollup', content='Pss: 200 kB\n')
+        self.assertEqual(
+            self.collector.collect(self.process)['proc_mem_pss'], 200 * 1024)
@@ -0,0 +1,193 @@
+import errno
+import socket
+import struct
+import threading
+from unittest import TestCase
+
+from ..taskstats import (
+    CTRL_ATTR_FAMILY_ID,
+    CTRL_ATTR_FAMILY_NAME,
+    GENL_ID_CTRL,
+    NLMSG_ERROR,
+    TASKSTATS_CMD_ATTR_PID,
+    TASKSTATS_FIELDS,
+    TASKSTATS_TYPE_AGGR_PID,
+    TASKSTATS_TYPE_PID,
+    TASKSTATS_TYPE_STATS,
+    TaskstatsConnection,
+    pack_attr,
+    pack_message,
+    parse_attrs,
+    parse_messages,
+    parse_taskstats,
+)
+
+
+FAMILY_ID = 0x17
+
+
+def make_taskstats(**fields):
+    """Return a struct taskstats with the specified field values."""
+    data = bytearray(max(TASKSTATS_FIELDS.values()) + 8)
+    for name, value in fields.items():
+        struct.pack_into('=Q', data, TASKSTATS_FIELDS[name], value)
+    return bytes(data)
+
+
+class FakeKernel:
+    """Reply to taskstats requests on a socket, like the kernel does."""
+
+    def __init__(self, sock, tasks, error=None, reply_tasks=True):
+        self.sock = sock
+        self.tasks = tasks
+        self.error = error
+        self.reply_tasks = reply_tasks
+        self.sends = 0
+        self._stopped = threading.Event()
+        self.sock.settimeout(0.01)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.sock.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            self.sends += 1
+            replies = [
+                self._reply(msg_type, seq, payload)
+                for msg_type, seq, payload in parse_messages(data)
+                if msg_type == GENL_ID_CTRL or self.reply_tasks]
+            # replies are received in separate datagrams
+            for reply in replies:
+                self.sock.send(reply)
+
+    def _reply(self, msg_type, seq, payload):
+        attrs = parse_attrs(payload[4:])
+        if msg_type == GENL_ID_CTRL:
+            assert attrs[CTRL_ATTR_FAMILY_NAME] == b'TASKSTATS\x00'
+            return pack_message(
+                GENL_ID_CTRL, seq, 1,
+                pack_attr(CTRL_ATTR_FAMILY_ID, struct.pack('=H', FAMILY_ID)))
+        [pid] = struct.unpack('=I', attrs[TASKSTATS_CMD_ATTR_PID])
+        error = self.error
+        if error is None and pid not in self.tasks:
+            error = errno.ESRCH
+        if error is not None:
+            # struct nlmsgerr, with no generic netlink header
+            return struct.pack('=IHHIIi', 20, NLMSG_ERROR, 0, seq, 0, -error)
+        return pack_message(
+            FAMILY_ID, seq, 2,
+            pack_attr(
+                TASKSTATS_TYPE_AGGR_PID,
+                pack_attr(TASKSTATS_TYPE_PID, struct.pack('=I', pid)) +
+                pack_attr(TASKSTATS_TYPE_STATS, self.tasks[pid])))
+
+
+class AttrsTests(TestCase):
+
+    def test_pack_attr_aligned(self):
+        """Attributes are padded to 4 bytes."""
+        self.assertEqual(
+            pack_attr(2, b'abc\x00x'),
+            b'\x09\x00\x02\x00abc\x00x\x00\x00\x00')
+
+    def test_parse_attrs(self):
+        """Attributes are parsed to a dict."""
+        data = pack_attr(1, b'abcde') + pack_attr(2, b'fg')
+        self.assertEqual(parse_attrs(data), {1: b'abcde', 2: b'fg'})
+
+    def test_parse_attrs_nested_flag(self):
+        """Flags in attribute types are ignored."""
+        self.assertEqual(parse_attrs(pack_attr(0x8004, b'x')), {4: b'x'})
+
+
+class MessagesTests(TestCase):
+
+    def test_parse_messages(self):
+        """Multiple messages are parsed from data."""
+        data = (
+            pack_message(20, 1, 3, pack_attr(1, b'a')) +
+            pack_message(21, 2, 4, b''))
+        self.assertEqual(
+            list(parse_messages(data)),
+            [(20, 1, b'\x03\x01\x00\x00' + pack_attr(1, b'a')),
+             (21, 2, b'\x04\x01\x00\x00')])
+
+    def test_parse_taskstats(self):
+        """Fields are parsed from a taskstats struct."""
+        stats = parse_taskstats(make_taskstats(nvcsw=10, hiwater_rss=200))
+        self.assertEqual(stats['nvcsw'], 10)
+        self.assertEqual(stats['hiwater_rss'], 200)
+        self.assertEqual(stats['nivcsw'], 0)
+
+    def test_parse_taskstats_short(self):
+        """Fields missing from short structs are None."""
+        stats = parse_taskstats(make_taskstats()[:256])
+        self.assertEqual(stats['read_bytes'], 0)
+        self.assertIsNone(stats['write_bytes'])
+        self.assertIsNone(stats['nvcsw'])
+
+
+class TaskstatsConnectionTests(TestCase):
+
+    def make_connection(self, tasks, error=None, reply_tasks=True):
+        sock, kernel_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        kernel = FakeKernel(
+            kernel_sock, tasks, error=error, reply_tasks=reply_tasks)
+        self.addCleanup(kernel.stop)
+        connection = TaskstatsConnection(sock=sock, timeout=0.1)
+        self.addCleanup(connection.close)
+        return connection, kernel
+
+    def test_family_id(self):
+        """The taskstats family ID is resolved."""
+        connection, _ = self.make_connection({})
+        self.assertEqual(connection.family_id, FAMILY_ID)
+
+    def test_get(self):
+        """Stats for tasks are returned."""
+        connection, kernel = self.make_connection(
+            {10: make_taskstats(nvcsw=1), 20: make_taskstats(nvcsw=2)})
+        stats = connection.get([10, 20])
+        self.assertEqual(stats[10]['nvcsw'], 1)
+        self.assertEqual(stats[20]['nvcsw'], 2)
+        # one send for the family, one for all tasks
+        self.assertEqual(kernel.sends, 2)
+
+    def test_get_batches(self):
+        """Requests for many tasks are sent in batches."""
+        tasks = {pid: make_taskstats(nvcsw=pid) for pid in range(1, 301)}
+        connection, kernel = self.make_connection(tasks)
+        stats = connection.get(tasks)
+        self.assertEqual(
+            {pid: values['nvcsw'] for pid, values in stats.items()},
+            {pid: pid for pid in tasks})
+        self.assertEqual(kernel.sends, 3)
+
+    def test_get_missing(self):
+        """Tasks that don't exist are not included."""
+        connection, _ = self.make_connection({10: make_taskstats()})
+        self.assertEqual(list(connection.get([10, 20])), [10])
+
+    def test_get_error(self):
+        """An OSError is raised for errors."""
+        connection, _ = self.make_connection({}, error=errno.EPERM)
+        with self.assertRaises(OSError) as context:
+            connection.get([10])
+        self.assertEqual(context.exception.errno, errno.EPERM)
+
+    def test_get_timeout(self):
+        """An OSError is raised if replies don't arrive in time."""
+        connection, _ = self.make_connection(
+            {10: make_taskstats()}, reply_tasks=False)
+        with self.assertRaises(OSError) as context:
+            connection.get([10])
+        self.assertEqual(context.exception.errno, errno.ETIMEDOUT)
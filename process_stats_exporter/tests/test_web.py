@@ -0,0 +1,98 @@
+import asyncio
+import gzip
+import threading
+from unittest import (
+    TestCase,
+    mock)
+
+from prometheus_aioexporter.metric import (
+    MetricConfig,
+    MetricsRegistry)
+
+from ..exposition import ExpositionCache
+from ..web import CachedExpositionApplication
+
+
+class CachedExpositionApplicationTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+        self.registry = MetricsRegistry()
+        self.metrics = self.registry.create_metrics(
+            [MetricConfig('sample', 'A sample', 'gauge', {})])
+        self.app = CachedExpositionApplication(
+            'test', 'A test', 'localhost', 9090, self.registry,
+            ExpositionCache(self.registry.registry))
+
+    def get_metrics(self, accept_encoding=''):
+        request = mock.Mock(headers={'Accept-Encoding': accept_encoding})
+        return self.loop.run_until_complete(
+            self.app._handle_metrics(request))
+
+    def test_update_in_executor(self):
+        """Metrics are updated outside the event loop thread."""
+        threads = []
+
+        def update_handler(metrics):
+            threads.append(threading.current_thread())
+            metrics['sample'].set(3)
+
+        self.app.set_metric_update_handler(update_handler)
+        response = self.get_metrics()
+        self.assertIn(b'sample 3.0', response.body)
+        [thread] = threads
+        self.assertIsNot(thread, threading.current_thread())
+
+    def test_update_serialized(self):
+        """Updates for concurrent requests don't overlap."""
+        running = []
+        overlaps = []
+
+        def update_handler(metrics):
+            if running:
+                overlaps.append(True)
+            running.append(True)
+            threading.Event().wait(0.05)
+            running.pop()
+
+        self.app.set_metric_update_handler(update_handler)
+        request = mock.Mock(headers={})
+        self.loop.run_until_complete(
+            asyncio.gather(
+                self.app._handle_metrics(request),
+                self.app._handle_metrics(request)))
+        self.assertEqual(overlaps, [])
+
+    def test_no_update_handler(self):
+        """Without an update handler, the last exposition is served."""
+        self.metrics['sample'].set(5)
+        self.app.exposition.update()
+        self.metrics['sample'].set(6)
+        response = self.get_metrics()
+        self.assertIn(b'sample 5.0', response.body)
+
+    def test_no_update_handler_not_rendered(self):
+        """If not rendered yet, the exposition is rendered in the executor."""
+        threads = []
+        update = self.app.exposition.update
+
+        def render():
+            threads.append(threading.current_thread())
+            update()
+
+        self.metrics['sample'].set(5)
+        with mock.patch.object(self.app.exposition, 'update', render):
+            response = self.get_metrics()
+        self.assertIn(b'sample 5.0', response.body)
+        [thread] = threads
+        self.assertIsNot(thread, threading.current_thread())
+
+    def test_compressed(self):
+        """The exposition is compressed if the client accepts gzip."""
+        response = self.get_metrics(accept_encoding='gzip, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'sample 0.0', gzip.decompress(response.body))
@@ -0,0 +1,146 @@
+from lxstats.process import Process
+from lxstats.testing import TestCase
+
+from ..instrument import Tally
+from ..window import (
+    GaugeWindows,
+    RingBuffer,
+    window_values)
+
+
+class RingBufferTests(TestCase):
+
+    def test_append(self):
+        """Values are added to the buffer."""
+        buffer = RingBuffer(3)
+        buffer.append(10)
+        buffer.append(20)
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(buffer.values(), [10, 20])
+
+    def test_append_full(self):
+        """When the buffer is full, the oldest value is overwritten."""
+        buffer = RingBuffer(3)
+        for value in (100, 1, 2, 3):
+            buffer.append(value)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.values(), [1, 2, 3])
+
+    def test_clear(self):
+        """Values are removed from the buffer."""
+        buffer = RingBuffer(3)
+        buffer.append(10)
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+        buffer.append(5)
+        self.assertEqual(buffer.values(), [5])
+
+    def test_values_empty(self):
+        """An empty buffer has no values."""
+        self.assertEqual(RingBuffer(3).values(), [])
+
+
+class WindowValuesTests(TestCase):
+
+    def test_values(self):
+        """Maximum, minimum and average of sampled values are returned."""
+        samples = {'proc_mem_rss': [(1, 10), (2, 50), (3, 30)]}
+        self.assertEqual(
+            window_values([samples]),
+            {'proc_mem_rss_window_max': 50, 'proc_mem_rss_window_min': 10,
+             'proc_mem_rss_window_avg': 30})
+
+    def test_values_summed_by_tick(self):
+        """Values for multiple processes are summed for each tick."""
+        samples1 = {'proc_mem_rss': [(1, 10), (2, 50)]}
+        samples2 = {'proc_mem_rss': [(2, 30)]}
+        self.assertEqual(
+            window_values([samples1, samples2]),
+            {'proc_mem_rss_window_max': 80, 'proc_mem_rss_window_min': 10,
+             'proc_mem_rss_window_avg': 45})
+
+    def test_values_empty(self):
+        """No values are returned without samples."""
+        self.assertEqual(window_values([{}, {}]), {})
+
+
+class GaugeWindowsTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.process = Process(10, self.tempdir.path / '10')
+        self.windows = GaugeWindows(5, labels=['pid'])
+        self.windows.track([self.process])
+
+    def make_stat(self, pid, rss, start_time=100):
+        """Write the stat file for a process."""
+        fields = [str(i) for i in range(45)]
+        fields[21] = str(start_time)
+        fields[23] = str(rss)
+        self.make_process_file(pid, 'stat', content=' '.join(fields))
+
+    def test_metrics(self):
+        """Metrics are returned for sampled gauges."""
+        self.assertEqual(
+            [config.name for config in self.windows.metrics()],
+            ['proc_mem_rss_window_max', 'proc_mem_rss_window_min',
+             'proc_mem_rss_window_avg'])
+        for config in self.windows.metrics():
+            self.assertEqual(config.type, 'gauge')
+            self.assertEqual(config.config['labels'], ['pid'])
+
+    def test_sample_take(self):
+        """Sampled values are returned with their tick."""
+        for rss in (10, 50, 30):
+            self.make_stat(10, rss)
+            self.windows.sample()
+        self.assertEqual(
+            self.windows.take(10),
+            {'proc_mem_rss': [(1, 10), (2, 50), (3, 30)]})
+
+    def test_take_discards_samples(self):
+        """Samples are discarded when taken."""
+        self.make_stat(10, 10)
+        self.windows.sample()
+        self.windows.take(10)
+        self.assertEqual(self.windows.take(10), {})
+        self.make_stat(10, 20)
+        self.windows.sample()
+        self.assertEqual(self.windows.take(10), {'proc_mem_rss': [(2, 20)]})
+
+    def test_take_not_sampled(self):
+        """No values are returned for processes not sampled."""
+        self.assertEqual(self.windows.take(10), {})
+
+    def test_sample_bounded(self):
+        """At most the window size of samples is kept."""
+        for rss in (100, 1, 2, 3, 4, 5):
+            self.make_stat(10, rss)
+            self.windows.sample()
+        self.assertEqual(
+            self.windows.take(10),
+            {'proc_mem_rss': [(2, 1), (3, 2), (4, 3), (5, 4), (6, 5)]})
+
+    def test_sample_process_gone(self):
+        """Processes that are gone are not sampled."""
+        tally = Tally()
+        windows = GaugeWindows(5, counts=tally)
+        windows.track([self.process])
+        windows.sample()
+        self.assertEqual(windows.take(10), {})
+        self.assertEqual(tally.take()['read_errors'], 1)
+
+    def test_sample_pid_reused(self):
+        """Samples for a different process with the same PID are discarded."""
+        self.make_stat(10, 100)
+        self.windows.sample()
+        self.make_stat(10, 10, start_time=200)
+        self.windows.sample()
+        self.assertEqual(self.windows.take(10), {'proc_mem_rss': [(2, 10)]})
+
+    def test_track_discards_untracked(self):
+        """Samples for processes no longer tracked are discarded."""
+        self.make_stat(10, 100)
+        self.windows.sample()
+        self.windows.track([])
+        self.assertEqual(self.windows.take(10), {})
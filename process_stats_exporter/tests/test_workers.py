@@ -0,0 +1,181 @@
+import logging
+import os
+import signal
+import time
+
+from fixtures import LoggerFixture
+from lxstats.process import Process
+from lxstats.testing import TestCase
+
+from ..workers import (
+    CollectWorkers,
+    pack_values,
+    unpack_values)
+
+
+class PackValuesTests(TestCase):
+
+    def test_pack_unpack(self):
+        """Values packed by pack_values are unpacked by unpack_values."""
+        names = ['foo', 'bar', 'baz']
+        values_list = [
+            {'foo': 1, 'bar': 2.5, 'baz': None},
+            {'foo': -(2 ** 62), 'bar': 3},
+            {}]
+        self.assertEqual(
+            unpack_values(names, pack_values(names, values_list)),
+            values_list)
+
+    def test_pack_types(self):
+        """Integers and floats keep their type."""
+        names = ['foo', 'bar']
+        [values] = unpack_values(
+            names, pack_values(names, [{'foo': 10, 'bar': 10.0}]))
+        self.assertIsInstance(values['foo'], int)
+        self.assertIsInstance(values['bar'], float)
+
+    def test_pack_empty(self):
+        """An empty list of values can be packed."""
+        self.assertEqual(unpack_values(['foo'], pack_values(['foo'], [])), [])
+
+
+def collect_pids(processes):
+    """Return values with the PID of the worker collecting each process."""
+    values = [
+        {'pid': process.pid, 'worker': os.getpid()} for process in processes]
+    return values, len(processes)
+
+
+def collect_slow(processes):
+    """Return values like collect_pids, hanging for PID 1."""
+    if any(process.pid == 1 for process in processes):
+        time.sleep(10)
+    return collect_pids(processes)
+
+
+def process_exists(pid):
+    """Return whether a process exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def read_ppid(pid):
+    """Return the parent PID of a process."""
+    with open('/proc/{}/stat'.format(pid)) as fd:
+        return int(fd.read().rsplit(')', 1)[1].split()[1])
+
+
+class CollectWorkersTests(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.logger = self.useFixture(LoggerFixture(level=logging.DEBUG))
+
+    def make_workers(self, count, collect=collect_pids, **kwargs):
+        workers = CollectWorkers(
+            logging.getLogger('test'), count, ['pid', 'worker'], collect,
+            **kwargs)
+        self.addCleanup(workers.close)
+        return workers
+
+    def make_processes(self, *pids):
+        return [Process(pid, self.tempdir.path / str(pid)) for pid in pids]
+
+    def test_collect(self):
+        """Values are returned for processes, in the same order."""
+        workers = self.make_workers(2)
+        values, infos = workers.collect(self.make_processes(5, 2, 3, 4))
+        self.assertEqual([value['pid'] for value in values], [5, 2, 3, 4])
+        self.assertCountEqual(infos, [2, 2])
+
+    def test_collect_partitions(self):
+        """Each worker collects stats for the same partition of PIDs."""
+        workers = self.make_workers(2)
+        values1, _ = workers.collect(self.make_processes(1, 2, 3, 4))
+        values2, _ = workers.collect(self.make_processes(4, 3))
+        workers1 = {value['pid']: value['worker'] for value in values1}
+        workers2 = {value['pid']: value['worker'] for value in values2}
+        self.assertEqual(workers1[1], workers1[3])
+        self.assertEqual(workers1[2], workers1[4])
+        self.assertNotEqual(workers1[1], workers1[2])
+        self.assertNotIn(os.getpid(), workers1.values())
+        self.assertEqual(workers2, {3: workers1[3], 4: workers1[4]})
+
+    def test_collect_error(self):
+        """Errors collecting stats are logged, and values are empty."""
+        def collect(processes):
+            raise Exception('boom')
+
+        workers = self.make_workers(1, collect=collect)
+        values, infos = workers.collect(self.make_processes(1, 2))
+        self.assertEqual(values, [{}, {}])
+        self.assertEqual(infos, [None])
+        # the worker still runs
+        values, _ = workers.collect(self.make_processes(3))
+        self.assertEqual(values, [{}])
+
+    def test_collect_worker_exited(self):
+        """If a worker has exited, values for its partition are empty.
+
+        The worker is restarted for the next collection.
+
+        """
+        workers = self.make_workers(2)
+        pid, _ = workers._workers[0]
+        os.kill(pid, signal.SIGTERM)
+        values, infos = workers.collect(self.make_processes(1, 2))
+        self.assertEqual(values[0]['pid'], 1)
+        self.assertEqual(values[1], {})
+        self.assertEqual(infos, [1])
+        self.assertIn(
+            'collect worker collect-worker-0 exited, stats for 1 processes '
+            'not collected, restarting it', self.logger.output)
+        new_pid, _ = workers._workers[0]
+        self.assertNotEqual(new_pid, pid)
+        values, infos = workers.collect(self.make_processes(1, 2))
+        self.assertEqual([value['pid'] for value in values], [1, 2])
+        self.assertEqual(infos, [1, 1])
+
+    def test_collect_worker_timeout(self):
+        """Workers not returning results in time are restarted."""
+        workers = self.make_workers(2, collect=collect_slow, timeout=0.5)
+        pid, _ = workers._workers[1]
+        values, infos = workers.collect(self.make_processes(1, 2))
+        self.assertEqual(values[0], {})
+        self.assertEqual(values[1]['pid'], 2)
+        self.assertEqual(infos, [1])
+        self.assertIn('collect-worker-1 timed out', self.logger.output)
+        self.assertFalse(process_exists(pid))
+        values, _ = workers.collect(self.make_processes(3))
+        self.assertEqual(values[0]['pid'], 3)
+
+    def test_collect_pack_error(self):
+        """Errors packing values are logged, and values are empty."""
+        def collect(processes):
+            return [{'pid': 'foo'} for _ in processes], None
+
+        workers = self.make_workers(1, collect=collect)
+        values, infos = workers.collect(self.make_processes(1))
+        self.assertEqual(values, [{}])
+        self.assertEqual(infos, [None])
+
+    def test_workers_not_forked_from_caller(self):
+        """Workers are forked by the spawner, not by the calling process."""
+        workers = self.make_workers(2)
+        values, _ = workers.collect(self.make_processes(1))
+        self.assertEqual(
+            read_ppid(values[0]['worker']), workers._spawner.pid)
+
+    def test_close(self):
+        """Workers are stopped on close."""
+        workers = CollectWorkers(
+            logging.getLogger('test'), 2, ['pid'], collect_pids)
+        pids = [pid for pid, _ in workers._workers]
+        workers.close()
+        self.assertEqual(len(workers), 0)
+        self.assertEqual(workers._spawner.exitcode, 0)
+        for pid in pids:
+            self.assertFalse(process_exists(pid))
@@ -0,0 +1,65 @@
+"""Web application serving a cached metrics exposition."""
+
+import asyncio
+
+from aiohttp.web import Response
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .compat import PrometheusExporterWeb
+
+
+class CachedExpositionApplication(PrometheusExporterWeb):
+    """A web application serving metrics from an :class:`ExpositionCache`.
+
+    If an update handler is set, metrics are updated and the exposition is
+    rendered on each request, in the default executor so that the event loop
+    isn't blocked.  Updates for concurrent requests are serialized.
+    Otherwise, the last rendered exposition is served, and it's only
+    rendered on requests if it hasn't been yet.  It's compressed if the
+    client accepts gzip encoding.
+
+    The base class depends on the prometheus_aioexporter version, see
+    :mod:`compat`.  From 1.4 it's not an application itself, but creates one
+    as its ``app`` attribute.
+
+    """
+
+    _update_handler = None
+
+    def __init__(self, name, description, host, port, registry, exposition,
+                 **kwargs):
+        self.exposition = exposition
+        self._update_lock = asyncio.Lock()
+        super().__init__(name, description, host, port, registry, **kwargs)
+
+    def set_metric_update_handler(self, handler):
+        """Set a function to update metrics before rendering them.
+
+        It's called in the default executor with a dict mapping metric names
+        to metrics.
+
+        """
+        self._update_handler = handler
+
+    async def _handle_metrics(self, request):
+        """Handler for metrics."""
+        compressed = 'gzip' in request.headers.get('Accept-Encoding', '')
+        body = None
+        if not self._update_handler:
+            body = self.exposition.get(compressed=compressed)
+        if body is None:
+            async with self._update_lock:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self._update)
+            body = self.exposition.get(compressed=compressed)
+        response = Response(body=body)
+        response.content_type = CONTENT_TYPE_LATEST
+        if compressed:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    def _update(self):
+        """Update metrics if needed, and render the exposition."""
+        if self._update_handler:
+            self._update_handler(self.registry.get_metrics())
+        self.exposition.update()
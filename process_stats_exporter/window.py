@@ -0,0 +1,194 @@
+"""Sample gauges at a high rate, to report their range between collections."""
+
+from array import array
+import threading
+
+from prometheus_aioexporter.metric import MetricConfig
+
+from .procfs import ProcStatsReader
+
+
+# Suffixes for window metrics, with their description prefix
+WINDOW_SUFFIXES = (
+    ('_window_max', 'Maximum'),
+    ('_window_min', 'Minimum'),
+    ('_window_avg', 'Average'))
+
+# Descriptions for sampled gauges
+_GAUGE_DESCRIPTIONS = {
+    'proc_mem_rss': 'memory resident segment size (RSS)'}
+
+
+# Window metrics which can't be summed across processes
+NON_ADDITIVE_METRICS = frozenset(
+    gauge + suffix
+    for gauge in _GAUGE_DESCRIPTIONS
+    for suffix in ('_window_max', '_window_min'))
+
+
+class RingBuffer:
+    """A fixed-size buffer of integers.
+
+    Values are stored in a compact array.  When the buffer is full, the
+    oldest value is overwritten.
+
+    """
+
+    def __init__(self, size):
+        self._values = array('q', [0]) * size
+        self._size = size
+        self._count = 0
+        self._next = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value):
+        """Add a value, overwriting the oldest one if full."""
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+
+    def clear(self):
+        """Remove all values."""
+        self._count = self._next = 0
+
+    def values(self):
+        """Return a list of values, from the oldest."""
+        if self._count < self._size:
+            return self._values[:self._count].tolist()
+        return (
+            self._values[self._next:] + self._values[:self._next]).tolist()
+
+
+def window_values(samples_list):
+    """Return a dict with window metric values for samples of processes.
+
+    :param samples_list: a list of dicts mapping gauges to lists of (tick,
+        value) samples, as returned by :meth:`GaugeWindows.take`.
+
+    Values sampled in the same tick are summed, and the maximum, minimum and
+    average of the sums are returned, so that values for multiple processes
+    are for their total.  Metrics for gauges without samples are not
+    included.
+
+    """
+    totals = {}
+    for samples in samples_list:
+        for gauge, gauge_samples in samples.items():
+            tick_totals = totals.setdefault(gauge, {})
+            for tick, value in gauge_samples:
+                tick_totals[tick] = tick_totals.get(tick, 0) + value
+
+    values = {}
+    for gauge, tick_totals in totals.items():
+        sums = list(tick_totals.values())
+        summary = max(sums), min(sums), sum(sums) / len(sums)
+        for (suffix, _), value in zip(WINDOW_SUFFIXES, summary):
+            values[gauge + suffix] = value
+    return values
+
+
+class GaugeWindows:
+    """Sample gauges for processes between collections.
+
+    On each :meth:`sample`, the RSS is read for tracked processes from their
+    ``stat`` file only, and stored in a :class:`RingBuffer` of fixed size for
+    each process and gauge, along with the tick (the number of the sampling
+    round).  Samples
+    since the previous collection are returned by :meth:`take`, and
+    summarized with :func:`window_values`.
+
+    If a PID is reused by a different process, samples for the previous one
+    are discarded.
+
+    :param int size: the maximum number of samples kept for each process and
+        gauge.
+    :param labels: label names for metrics.
+    :param Tally counts: an optional tally for counts of files and bytes read,
+        and of read errors.
+
+    """
+
+    def __init__(self, size, labels=(), counts=None):
+        self.labels = list(labels)
+        self._size = size
+        self._reader = ProcStatsReader(
+            ['stat.rss', 'stat.starttime'], counts=counts)
+        self._gauges = ['proc_mem_rss']
+        self._processes = []
+        # map PIDs to tuples with (start time, {gauge: (ticks, values)}),
+        # with RingBuffers for ticks and values
+        self._windows = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def metrics(self):
+        """Return a list of MetricConfigs."""
+        return [
+            MetricConfig(
+                gauge + suffix,
+                '{} {} since the previous collection'.format(
+                    description, _GAUGE_DESCRIPTIONS[gauge]),
+                'gauge', {'labels': self.labels})
+            for gauge in self._gauges
+            for suffix, description in WINDOW_SUFFIXES]
+
+    def track(self, processes):
+        """Set processes to sample, discarding samples for other ones."""
+        processes = list(processes)
+        pids = {process.pid for process in processes}
+        with self._lock:
+            self._processes = processes
+            for pid in set(self._windows).difference(pids):
+                del self._windows[pid]
+
+    def sample(self):
+        """Sample gauges for tracked processes."""
+        with self._lock:
+            processes = list(self._processes)
+            self._tick += 1
+            tick = self._tick
+        for process in processes:
+            stats = self._reader.read(process)
+            start_time = stats['stat.starttime']
+            if start_time is None or stats['stat.rss'] is None:
+                # the process is gone
+                continue
+            values = {'proc_mem_rss': stats['stat.rss']}
+            with self._lock:
+                self._add(process.pid, start_time, tick, values)
+
+    def take(self, pid):
+        """Return a dict mapping gauges to samples for a process.
+
+        Samples are lists of (tick, value) tuples, and are discarded for the
+        process.  Gauges without samples are not included.
+
+        """
+        samples = {}
+        with self._lock:
+            entry = self._windows.get(pid)
+            if entry is None:
+                return samples
+            for gauge, (ticks, values) in entry[1].items():
+                if not ticks:
+                    continue
+                samples[gauge] = list(zip(ticks.values(), values.values()))
+                ticks.clear()
+                values.clear()
+        return samples
+
+    def _add(self, pid, start_time, tick, values):
+        """Add sampled values for a process."""
+        entry = self._windows.get(pid)
+        if entry is None or entry[0] != start_time:
+            entry = self._windows[pid] = (
+                start_time,
+                {gauge: (RingBuffer(self._size), RingBuffer(self._size))
+                 for gauge in self._gauges})
+        for gauge, (ticks, buffer) in entry[1].items():
+            value = values.get(gauge)
+            if value is not None:
+                ticks.append(tick)
+                buffer.append(value)
@@ -0,0 +1,332 @@
+"""Collect stats for processes in a pool of worker processes."""
+
+from array import array
+import multiprocessing
+from multiprocessing.connection import (
+    Connection,
+    Pipe)
+from multiprocessing.reduction import (
+    recv_handle,
+    send_handle)
+import os
+import signal
+import struct
+import time
+
+from lxstats.process import Process
+
+from .procfs import process_dir
+
+
+# Codes for values in packed results
+_MISSING, _NONE, _INT, _FLOAT = range(4)
+
+# Header for packed results, with lengths of codes, ints and floats arrays
+_HEADER = struct.Struct('=III')
+
+# Default timeout for results from workers, in seconds
+RESULTS_TIMEOUT = 60
+
+# Time to wait for workers to exit when stopping, in seconds
+WORKER_STOP_TIMEOUT = 5
+
+
+def pack_values(names, values_list):
+    """Pack metric values for processes in bytes.
+
+    :param list names: names of metrics, in the order they're packed.
+    :param values_list: a list of dicts mapping metric names to values, one
+        for each process.
+
+    Values are packed in arrays, along with a code for each metric which
+    tells whether the value is missing, None, an integer or a float.
+
+    """
+    codes = array('B')
+    ints = array('q')
+    floats = array('d')
+    for values in values_list:
+        for name in names:
+            if name not in values:
+                codes.append(_MISSING)
+                continue
+            value = values[name]
+            if value is None:
+                codes.append(_NONE)
+            elif isinstance(value, int):
+                codes.append(_INT)
+                ints.append(value)
+            else:
+                codes.append(_FLOAT)
+                floats.append(value)
+    return b''.join(
+        (_HEADER.pack(len(codes), len(ints), len(floats)), codes.tobytes(),
+         ints.tobytes(), floats.tobytes()))
+
+
+def unpack_values(names, data):
+    """Unpack metric values for processes, packed by :func:`pack_values`.
+
+    Return a list of dicts mapping metric names to values.
+
+    """
+    codes = array('B')
+    ints = array('q')
+    floats = array('d')
+    offset = _HEADER.size
+    for values, length in zip(
+            (codes, ints, floats), _HEADER.unpack_from(data)):
+        size = length * values.itemsize
+        values.frombytes(data[offset:offset + size])
+        offset += size
+
+    ints = iter(ints)
+    floats = iter(floats)
+    values_list = []
+    for index in range(0, len(codes), len(names)):
+        values = {}
+        for name, code in zip(names, codes[index:index + len(names)]):
+            if code == _NONE:
+                values[name] = None
+            elif code == _INT:
+                values[name] = next(ints)
+            elif code == _FLOAT:
+                values[name] = next(floats)
+        values_list.append(values)
+    return values_list
+
+
+class CollectWorkers:
+    """A pool of long-lived worker processes collecting process stats.
+
+    Each worker owns a partition of the PID space (PIDs are assigned by
+    modulo of the number of workers), so that state kept across
+    collections (e.g. caches and previous values) stays in the same worker.
+
+    Workers call the ``collect`` callable with a list of :class:`Process` to
+    collect stats for.  It must return a tuple with a list of dicts with
+    values for each process, which are sent back to the parent packed with
+    :func:`pack_values`, and a picklable object with additional information.
+
+    Workers are not forked from the calling process, which can have threads
+    running once collection starts.  Instead, a spawner process is forked
+    when the pool is created, and forks workers with a copy of the state at
+    that time.  The pool must be created while the calling process is
+    single-threaded.
+
+    Workers that exit, or don't return results within the timeout, are
+    restarted.
+
+    :param logger: the logger to report errors to.
+    :param int count: the number of worker processes.
+    :param list names: names of metrics for process values.
+    :param callable collect: the callable collecting stats in workers.
+    :param callable initializer: an optional callable to call with no
+        arguments when a worker starts.
+    :param callable finalizer: an optional callable to call with no
+        arguments when a worker stops.
+    :param float timeout: the maximum time to wait for results from workers
+        in each collection, in seconds.
+
+    """
+
+    def __init__(self, logger, count, names, collect, initializer=None,
+                 finalizer=None, timeout=RESULTS_TIMEOUT):
+        self.logger = logger
+        self._names = list(names)
+        self._collect = collect
+        self._initializer = initializer
+        self._finalizer = finalizer
+        self._timeout = timeout
+        context = multiprocessing.get_context('fork')
+        self._spawner_connection, spawner_connection = context.Pipe()
+        self._spawner = context.Process(
+            target=self._run_spawner, args=(spawner_connection,),
+            name='collect-spawner', daemon=True)
+        self._spawner.start()
+        spawner_connection.close()
+        # tuples with (pid, connection), for running workers
+        self._workers = []
+        for index in range(count):
+            self._workers.append(self._start_worker(index))
+
+    def __len__(self):
+        return len(self._workers)
+
+    def collect(self, processes):
+        """Collect stats for processes in workers.
+
+        Return a tuple with a list of dicts with values for each process, in
+        the same order, and a list with additional information from each
+        worker.  Values for processes in partitions of workers that have
+        exited or timed out are empty, and the workers are restarted.
+
+        """
+        partitions = [[] for _ in self._workers]
+        for index, process in enumerate(processes):
+            partitions[process.pid % len(partitions)].append(index)
+
+        # send all requests first, so that workers collect in parallel
+        for (_, connection), partition in zip(self._workers, partitions):
+            request = [
+                (processes[index].pid, str(process_dir(processes[index])))
+                for index in partition]
+            try:
+                connection.send(request)
+            except OSError:
+                pass  # reported when reading results
+
+        values_list = [{} for _ in processes]
+        infos = []
+        deadline = time.monotonic() + self._timeout
+        for worker_index, partition in enumerate(partitions):
+            _, connection = self._workers[worker_index]
+            try:
+                if not connection.poll(max(deadline - time.monotonic(), 0)):
+                    raise TimeoutError()
+                values = unpack_values(self._names, connection.recv_bytes())
+                infos.append(connection.recv())
+            except (EOFError, OSError) as error:
+                self.logger.error(
+                    'collect worker {} {}, stats for {} processes not '
+                    'collected, restarting it'.format(
+                        self._worker_name(worker_index),
+                        'timed out' if isinstance(error, TimeoutError)
+                        else 'exited',
+                        len(partition)))
+                self._restart_worker(worker_index)
+                continue
+            for index, process_values in zip(partition, values):
+                values_list[index] = process_values
+        return values_list, infos
+
+    def close(self):
+        """Stop workers."""
+        for _, connection in self._workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        self._workers = []
+        # the spawner waits for workers to exit
+        try:
+            self._spawner_connection.send(None)
+        except OSError:
+            pass
+        self._spawner.join()
+        self._spawner_connection.close()
+
+    def _worker_name(self, index):
+        """Return the name of a worker."""
+        return 'collect-worker-{}'.format(index)
+
+    def _start_worker(self, index):
+        """Start a worker from the spawner.
+
+        Return a (pid, connection) tuple.  If a worker with the same index is
+        running, it's stopped first.
+
+        """
+        self._spawner_connection.send(index)
+        fd = recv_handle(self._spawner_connection)
+        pid = self._spawner_connection.recv()
+        return pid, Connection(fd)
+
+    def _restart_worker(self, index):
+        """Stop a worker if still running, and start a new one."""
+        _, connection = self._workers[index]
+        connection.close()
+        try:
+            self._workers[index] = self._start_worker(index)
+        except (EOFError, OSError):
+            self.logger.error(
+                'collect spawner exited, worker {} not restarted'.format(
+                    self._worker_name(index)))
+
+    def _run_spawner(self, connection):
+        """Fork workers on request, until told to stop."""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self._spawner_connection.close()
+        # PIDs of workers, by index
+        pids = {}
+        try:
+            while True:
+                try:
+                    index = connection.recv()
+                except EOFError:
+                    break
+                if index is None:
+                    break
+                pid = pids.pop(index, None)
+                if pid is not None:
+                    _stop_worker(pid)
+                parent_connection, worker_connection = Pipe()
+                pid = os.fork()
+                if pid == 0:
+                    connection.close()
+                    parent_connection.close()
+                    self._run_worker(index, worker_connection)
+                worker_connection.close()
+                send_handle(
+                    connection, parent_connection.fileno(), os.getppid())
+                connection.send(pid)
+                parent_connection.close()
+                pids[index] = pid
+        finally:
+            for pid in pids.values():
+                _stop_worker(pid, timeout=WORKER_STOP_TIMEOUT)
+
+    def _run_worker(self, index, connection):
+        """Run a worker in a forked process, and exit."""
+        status = 1
+        try:
+            multiprocessing.current_process().name = self._worker_name(index)
+            self._run(connection)
+            status = 0
+        except Exception:
+            self.logger.exception('collect worker failed')
+        finally:
+            os._exit(status)
+
+    def _run(self, connection):
+        """Collect stats in a worker process, until told to stop."""
+        # interrupts and reloads are handled by the parent, which stops
+        # workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self._initializer is not None:
+            self._initializer()
+        try:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    break
+                if request is None:
+                    break
+                processes = [Process(pid, path) for pid, path in request]
+                try:
+                    values, info = self._collect(processes)
+                    data = pack_values(self._names, values)
+                except Exception:
+                    self.logger.exception('failed collecting stats')
+                    data = pack_values(self._names, [{} for _ in processes])
+                    info = None
+                connection.send_bytes(data)
+                connection.send(info)
+        finally:
+            if self._finalizer is not None:
+                self._finalizer()
+
+
+def _stop_worker(pid, timeout=0):
+    """Wait for a worker process to exit, terminating it after the timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            return
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
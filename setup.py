@@ -30,9 +30,10 @@ config = {
     'test_suite': 'process_stats_exporter',
     'install_requires': [
         'lxstats',
-        'prometheus_aioexporter'],
+        # see process_stats_exporter/compat.py for supported versions
+        'prometheus_aioexporter >= 1.1.0, < 2'],
     'tests_require': tests_require,
-    'extras_require': {'testing': tests_require},
+    'extras_require': {'testing': tests_require, 'yaml': ['PyYAML']},
     'keywords': 'metric prometheus process exporter',
     'classifiers': [
         'Development Status :: 4 - Beta',